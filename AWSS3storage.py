@@ -13,24 +13,51 @@
 # This file stores and retrieves objects from S3.  It is a simple wrapper
 # around S3 with no knowledge of the schema. 
 #
-# We support both reading and writing in simple CRUD fashion.
+# We support both reading and writing in simple CRUD fashion.  Writes return
+# the object's ETag, which callers can pass to read_object_if_changed to avoid
+# downloading an object they already hold, or to write_object as if_match to
+# only overwrite the version of the object they read (raising
+# PreconditionFailed if someone else has written it since).  Passing
+# if_none_match of "*" instead only creates the object, raising
+# PreconditionFailed if it already exists.
+#
+# We use a single S3 client, created on first use: clients are thread safe
+# (unlike creating them) and reusing one keeps its connections alive.  We only
+# check (and if need be create) a bucket on the first write to it.
 #
 # xxx for now, everything is public access.
 
 import boto3, botocore
 import pprint
-from logutilities import log_info, log_debug, log_error
+import threading
+from logutilities import log_info, log_debug, log_error, lazy_pformat
 
 REGION="eu-west-1"
 pp = pprint.PrettyPrinter(indent=2, width = 200)
 
-def write_object(bucket_name, key_name, blob, version):
-	s3 = boto3.client('s3')
+G_CLIENT = None
+G_CLIENT_LOCK = threading.Lock()
 
-	# Check if bucket exists
+# Buckets we know exist
+G_BUCKETS = set()
+
+class PreconditionFailed(Exception):
+	# A conditional write failed as the object has changed.
+	pass
+
+def get_client():
+	global G_CLIENT
+	with G_CLIENT_LOCK:
+		if G_CLIENT is None:
+			G_CLIENT = boto3.client('s3')
+		return G_CLIENT
+
+def check_bucket(s3, bucket_name):
+	# Check if bucket exists, creating it if not
 	try:
 		s3.head_bucket(Bucket = bucket_name)
 		log_debug("Bucket %s exists", bucket_name)
+		G_BUCKETS.add(bucket_name)
 	except botocore.exceptions.ClientError as e:
 		error_code = int(e.response['Error']['Code'])
 		if error_code == 403:
@@ -38,22 +65,41 @@ def write_object(bucket_name, key_name, blob, version):
 		elif error_code == 404:
 			log_debug("Bucket %s does not exist - creating", bucket_name)
 			bucket = s3.create_bucket(ACL = 'public-read-write', Bucket = bucket_name, CreateBucketConfiguration = { 'LocationConstraint': REGION })
+			G_BUCKETS.add(bucket_name)
 		else:
 			log_error("Error %d checking bucket %s", error_code, bucket_name)
 
+def write_object(bucket_name, key_name, blob, version, if_match=None, if_none_match=None):
+	s3 = get_client()
+
+	if bucket_name not in G_BUCKETS:
+		check_bucket(s3, bucket_name)
+
+	etag = None
 	try:
 		metadata = { "schema_version": version}
-		s3.put_object(Bucket = bucket_name, Key = key_name, Body = blob, ACL = 'public-read-write', Metadata = metadata)
+		if if_match:
+			response = s3.put_object(Bucket = bucket_name, Key = key_name, Body = blob, ACL = 'public-read-write', Metadata = metadata, IfMatch = if_match)
+		elif if_none_match:
+			response = s3.put_object(Bucket = bucket_name, Key = key_name, Body = blob, ACL = 'public-read-write', Metadata = metadata, IfNoneMatch = if_none_match)
+		else:
+			response = s3.put_object(Bucket = bucket_name, Key = key_name, Body = blob, ACL = 'public-read-write', Metadata = metadata)
+		etag = response.get('ETag')
 		log_debug("Written object %s to bucket %s", key_name, bucket_name)
 	except botocore.exceptions.ClientError as e:
+		if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+			log_debug("Object %s in bucket %s no longer has ETag %s", key_name, bucket_name, if_match or if_none_match)
+			raise PreconditionFailed(key_name)
 		error_code = int(e.response['Error']['Code'])
 		log_error("Error %d writing object %s to bucket %s", error_code, key_name, bucket_name)
 
+	return etag
+
 
 def read_object(bucket_name, key_name):
 	blob = b''
 	version = ""
-	s3 = boto3.client('s3')
+	s3 = get_client()
 
 	# Check if bucket exists
 	try:
@@ -64,12 +110,55 @@ def read_object(bucket_name, key_name):
 		log_debug("Returned %d bytes of schema version %s reading object %s from bucket %s", len(blob), version, key_name, bucket_name)
 
 	except botocore.exceptions.ClientError as e:
-		log_error("Error %s reading object %s from bucket %s", pp.pformat(e), key_name, bucket_name)
+		if e.response['Error']['Code'] == 'NoSuchKey':
+			log_debug("Object %s not found in bucket %s", key_name, bucket_name)
+		else:
+			log_error("Error %s reading object %s from bucket %s", lazy_pformat(e), key_name, bucket_name)
 		
 	return blob, version
 
 
+def read_object_if_changed(bucket_name, key_name, etag):
+	# Conditional read: if the object still has the given ETag S3 returns 304
+	# and we return a blob of None without downloading anything.
+	blob = b''
+	version = ""
+	new_etag = None
+	s3 = get_client()
+
+	try:
+		if etag:
+			response = s3.get_object(Bucket = bucket_name, Key = key_name, IfNoneMatch = etag)
+		else:
+			response = s3.get_object(Bucket = bucket_name, Key = key_name)
+
+		blob = response['Body'].read()
+		version = response['Metadata']['schema_version']
+		new_etag = response.get('ETag')
+		log_debug("Returned %d bytes of schema version %s reading object %s from bucket %s", len(blob), version, key_name, bucket_name)
+
+	except botocore.exceptions.ClientError as e:
+		if e.response['Error']['Code'] == '304':
+			log_debug("Object %s in bucket %s unchanged since ETag %s", key_name, bucket_name, etag)
+			blob = None
+			new_etag = etag
+		elif e.response['Error']['Code'] == 'NoSuchKey':
+			log_debug("Object %s not found in bucket %s", key_name, bucket_name)
+		else:
+			log_error("Error %s reading object %s from bucket %s", lazy_pformat(e), key_name, bucket_name)
+
+	return blob, version, new_etag
 
 
-	
+def list_keys(bucket_name):
+	keys = []
+	s3 = get_client()
+
+	try:
+		for page in s3.get_paginator('list_objects_v2').paginate(Bucket = bucket_name):
+			keys.extend(o['Key'] for o in page.get('Contents', []))
+		log_debug("Listed %d objects in bucket %s", len(keys), bucket_name)
+	except botocore.exceptions.ClientError as e:
+		log_error("Error %s listing bucket %s", lazy_pformat(e), bucket_name)
 
+	return sorted(keys)
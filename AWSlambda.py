@@ -15,76 +15,251 @@
 # Keene KIRA IR commands for a range of devices.
 
 import os
-import time
 import json
-import pprint
-import requests
-
-from userState import User
-from alexaSchema import DISCOVERY_RESPONSE
-from utilities import verify_static_user, verify_request, get_uuid, get_utc_timestamp
-from AWSutilities import extract_user, unpack_request, is_discovery
-from runCommand import run_command, set_power_states
-from response import construct_response
-from logutilities import log_info, log_debug
-#from validation import validate_message
+import concurrent.futures
+
+from userState import User, warm_up_storage
+from utilities import verify_static_user, verify_request, get_uuid, get_utc_timestamp, find_command_targets
+from AWSutilities import extract_user, extract_token_from_request, unpack_request, is_discovery
+from runCommand import Schedule, plan_command, set_power_states, plan_power_states, plan_power_changes
+from ip import warm_up, release_warm_connections
+from response import construct_response, construct_discovery_response, discovery_response_json, serialize_response
+from logutilities import log_info, log_debug, lazy_pformat, sample_payloads, log_payload
+from timing import start_trace, finish_trace, span, submit
+from profiling import profiled
+from validation import check_response
 
 # Logger boilerplate
 #logger = logging.getLogger()
 #log_setLevel(logging.INFO)
-pp = pprint.PrettyPrinter(indent=2, width = 200)
 
 PAUSE_BETWEEN_COMMANDS = 0.2
 
+# Worker threads for reading user state and warming up targets concurrently.
+# The pool persists across invocations of a warm lambda.
+PREFETCH_WORKERS = 4
+G_PREFETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+@profiled()
 def lambda_handler(request, context):
-    # Main lambda handler.  We simply switch on the directive type.
+    # Main lambda handler.
+    return handle_directive(request)
+
+def handle_directive(request, u=None, serialized=False):
+    # Handle a directive, logging, timing and validating as configured.  We
+    # simply switch on the directive type.  Callers which keep User objects
+    # across directives (see gateway.py) pass in the user; otherwise we look
+    # them up from the token in the directive.  Callers which send the
+    # response on themselves can ask for it serialized, so that the prebuilt
+    # discovery response is returned as is.
+
+    header = request['directive']['header']
+    log_info("Received %s %s directive", header['namespace'], header['name'])
+    sampled = sample_payloads()
+    log_payload("Request", request, sampled)
+
+    trace = start_trace(header['messageId'], Directive=header['namespace'] + "." + header['name'])
+    try:
+        response = handle_request(request, u)
+    finally:
+        finish_trace(trace)
+
+    if isinstance(response, bytes):
+        # The prebuilt discovery response, validated when the model was
+        # compiled
+        log_info("Responding with prebuilt discovery response")
+        if sampled:
+            log_payload("Response", json.loads(response), sampled)
+        return response if serialized else json.loads(response)
+
+    log_info("Responding with %s", response['event']['header']['name'])
+    log_payload("Response", response, sampled)
 
-    log_info("Received request")
-    log_info(json.dumps(request, indent=4))
+    check_response(response)
 
-    user_id = extract_user(request)
-    log_info("Request is for user %s", user_id)
+    return serialize_response(response).encode('utf-8') if serialized else response
 
-    u = User(user_id)
+def handle_request(request, u=None):
+    if u is None:
+        # On a cold start, get storage ready while we look up the user
+        warm_up_storage(G_PREFETCH_POOL)
+
+        with span("extract_user", "network"):
+            user_id = extract_user(request)
+        log_info("Request is for user %s", user_id)
+
+        u = User(user_id)
 
     if is_discovery(request):
-        # On discovery requests we always re-model the user.  This is the 
-        # natural point to model, as it is the only mechanism to report to 
-        # Alexa any changes in a user's devices.
-        # Note that creating the model also resets the device status to
-        # 'all off'.
-        log_debug("Discovery: model the user")
-        u.create_model()
-        model = u.get_model()
-        response = handle_discovery(model['discovery_response'])
+        # The model is compiled offline whenever the user's details or devices
+        # are uploaded, so discovery normally just returns the prebuilt
+        # response.  Only if there is no model yet do we create one here
+        # (which also resets the device status to 'all off').
+        log_debug("Discovery: retrieve the model")
+        with span("get_model", "network"):
+            model = u.get_model()
+        if not model:
+            log_info("No model for user %s - model now", u.user_id)
+            with span("create_model"):
+                u.create_model()
+                model = u.get_model()
+        response = handle_discovery(model)
     else:
-        log_debug("Normal directive: retrieve the model")
-        model = u.get_model()
-        log_debug("Model is %s", pp.pformat(model))
-        device_status = u.get_device_status() 
-        response, new_device_status, status_changed = handle_non_discovery(request, model['command_sequences'], model['device_power_map'], device_status)
+        log_debug("Normal directive: retrieve the model and device status")
+        targets = set()
+        try:
+            model, device_status = prefetch_state(u, [ request ], targets)
+            log_debug("Model is %s", lazy_pformat(model))
+            response, new_device_status, status_changed = handle_non_discovery(request, model['command_sequences'], model['device_power_map'], device_status)
+        finally:
+            release_warm_connections(target for target, protocol in targets)
         if status_changed:
             log_info("Device status changed - updating")
-            u.set_device_status(new_device_status)
+            with span("set_device_status", "network"):
+                u.set_device_status(new_device_status)
 
-    log_info("Response:")
-    log_info(json.dumps(response, indent=4, sort_keys=True))
+    return response
 
-    #validate_message(response)
+@profiled()
+def batch_handler(event, context):
+    # Lambda handler for a batch of directives, given as
+    # { "directives": [ directive, ... ] }.
+    return { 'responses': handle_batch(event['directives']) }
 
-    return response
+def handle_batch(requests, u=None):
+    # Handle an ordered batch of directives for one user (e.g. the steps of a
+    # scene) in one go: we look up the user and read their model and device
+    # status once, combine the IR commands for all the directives into a
+    # single schedule, and write the device status once.  The schedule turns
+    # each device on or off at most once, from its state before the batch to
+    # its state after it, before anything else, so there is at most one wait
+    # for devices to come up.  Returns the list of responses.  Raises
+    # ValueError if the batch can't be handled as one.
+    if not requests:
+        return []
+
+    log_info("Received batch of %d directives", len(requests))
+    sampled = sample_payloads()
+    log_payload("Batch", requests, sampled)
+
+    header = requests[0]['directive']['header']
+    trace = start_trace(header['messageId'], Directive="Batch")
+    try:
+        responses = handle_batch_requests(requests, u)
+    finally:
+        finish_trace(trace)
+
+    log_payload("Batch responses", responses, sampled)
+
+    for response in responses:
+        check_response(response)
+
+    return responses
+
+def handle_batch_requests(requests, u):
+    for request in requests:
+        if is_discovery(request):
+            raise ValueError("Discovery can't be batched")
+
+    if u is None:
+        warm_up_storage(G_PREFETCH_POOL)
+
+        with span("extract_user", "network"):
+            user_id = extract_user(requests[0])
+        log_info("Batch is for user %s", user_id)
+
+        # All the directives must be for the same user.  They normally have
+        # the same token, so we needn't look it up again.
+        token = extract_token_from_request(requests[0])
+        for request in requests[1:]:
+            if extract_token_from_request(request) != token and extract_user(request) != user_id:
+                raise ValueError("Batched directives are for different users")
+
+        u = User(user_id)
+
+    targets = set()
+    try:
+        model, device_status = prefetch_state(u, requests, targets)
+
+        initial_status = device_status
+        commands = Schedule()
+        responses = []
+        status_changed = False
+        for request in requests:
+            response, new_device_status, changed = plan_directive(request, model['command_sequences'], model['device_power_map'], device_status, commands, batched=True)
+            if changed:
+                device_status = new_device_status
+                status_changed = True
+            responses.append(response)
+
+        # Turn devices on and off first, then send everything else, without
+        # pausing after the last command.
+        schedule = Schedule()
+        with span("set_power_states"):
+            plan_power_changes(initial_status, device_status, model['device_power_map'], PAUSE_BETWEEN_COMMANDS, {}, schedule)
+        schedule.extend(commands)
+        schedule.trim()
+
+        with span("run_commands"):
+            schedule.execute()
+    finally:
+        release_warm_connections(target for target, protocol in targets)
+
+    if status_changed:
+        log_info("Device status changed - updating")
+        with span("set_device_status", "network"):
+            u.set_device_status(device_status)
+
+    return responses
+
+def prefetch_state(u, requests, targets):
+    # Read the user's model and device status concurrently.  As soon as we
+    # have the model, start warming up connections to the targets the
+    # directives will send to (adding them to targets), overlapping with the
+    # rest of the status read.
+    status_future = submit(G_PREFETCH_POOL, get_device_status, u)
+    with span("get_model", "network"):
+        model = u.get_model()
+    if model:
+        for request in requests:
+            warm_up_targets(request, model, targets)
+    device_status = status_future.result()
+    return model, device_status
+
+def get_device_status(u):
+    with span("get_device_status", "network"):
+        return u.get_device_status()
+
+def warm_up_targets(request, model, targets):
+    capability, directive, payload, endpoint_id = unpack_request(request)
+
+    try:
+        find_command_targets(model['command_sequences'][endpoint_id][capability][directive], targets)
+    except KeyError:
+        return
+
+    # Power directives may also switch other devices in the endpoint's room
+    # (see set_power_states), but never those in other rooms
+    if capability == "PowerController":
+        device_power_map = model['device_power_map']
+        rooms = { device['room'] for device in device_power_map.values() if endpoint_id in device['endpoints'] }
+        find_command_targets([ device['commands'] for device in device_power_map.values() if device['room'] in rooms ], targets)
 
-def handle_discovery(discovery_response):
+    for target, protocol in targets:
+        warm_up(target, protocol, G_PREFETCH_POOL)
+
+def handle_discovery(model):
     # Handle discovery requests.  This is straightforward: we have already 
     # mapped the users set of devices to an auto-generated list of activities
-    # (endpoints), so just return them.
+    # (endpoints), and serialized the response, so just return its bytes.
+    # (Models compiled before the response was serialized with them only have
+    # the endpoints, so we build the response from those.)
     log_info("Reply to discovery")
 
-    response = DISCOVERY_RESPONSE
-    response['event']['payload']['endpoints'] = discovery_response
-    response['event']['header']['messageId'] = get_uuid()
-                    
-    return response
+    if 'discovery_json' not in model:
+        return construct_discovery_response(model['discovery_response'])
+
+    return discovery_response_json(model['discovery_json'])
 
 def handle_non_discovery(request, command_sequences, device_power_map, device_state):
     # We have received a directive for some capability interface, which we have
@@ -107,6 +282,20 @@ def handle_non_discovery(request, command_sequences, device_power_map, device_st
     # (a) whether to skip any commmands and (b) any additional commands
     # to send for devices that should be switched off.
 
+    schedule = Schedule()
+    response, new_device_status, status_changed = plan_directive(request, command_sequences, device_power_map, device_state, schedule)
+
+    with span("run_commands"):
+        schedule.execute()
+
+    log_info("Did device power on/off status change? %s", status_changed)
+
+    return response, new_device_status, status_changed
+
+def plan_directive(request, command_sequences, device_power_map, device_state, schedule, batched=False):
+    # Work out the commands for a directive, adding them to the schedule.  In
+    # a batch, power directives only work out the new device states, as the
+    # batch plans all power changes together (see handle_batch_requests).
     # Extract the key fields from the request and check it's one we recognise
     capability, directive, payload, endpoint_id = unpack_request(request)
     verify_request(command_sequences, endpoint_id, capability, directive)
@@ -117,7 +306,12 @@ def handle_non_discovery(request, command_sequences, device_power_map, device_st
     # what to turn on/off
     if capability == "PowerController":
         log_debug("Turn things on/off")
-        new_device_status, status_changed = set_power_states(directive, endpoint_id, device_state, device_power_map, PAUSE_BETWEEN_COMMANDS, payload)
+        with span("set_power_states"):
+            if batched:
+                new_device_status = plan_power_states(directive, endpoint_id, device_state, device_power_map)
+                status_changed = new_device_status != device_state
+            else:
+                new_device_status, status_changed = set_power_states(directive, endpoint_id, device_state, device_power_map, PAUSE_BETWEEN_COMMANDS, payload, schedule)
     else:
         new_device_status = {}
         status_changed = False
@@ -127,12 +321,11 @@ def handle_non_discovery(request, command_sequences, device_power_map, device_st
 
     for command_tuple in commands_list:
         for verb in command_tuple:
-            run_command(verb, command_tuple[verb], PAUSE_BETWEEN_COMMANDS, payload)
+            plan_command(verb, command_tuple[verb], PAUSE_BETWEEN_COMMANDS, payload, schedule)
 
-    time.sleep(PAUSE_BETWEEN_COMMANDS)        
-                   
-    response = construct_response(request)
+    if not batched:
+        schedule.pause(PAUSE_BETWEEN_COMMANDS)
 
-    log_info("Did device power on/off status change? %s", status_changed)
+    response = construct_response(request)
 
     return response, new_device_status, status_changed
@@ -38,7 +38,7 @@ def extract_token_from_request(request):
             if 'scope' in request['directive'][l]:
                 token = request['directive'][l]['scope']['token']
 
-    log_debug("Token passed in request = %s", token)
+    log_debug("Token passed in request: %s", "yes" if token else "no")
     return token
 
 def unpack_request(request):
@@ -0,0 +1,153 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements a compact encoding for KIRA IR codes.
+#
+# Raw IR codes captured by the Keene utilities are "K-format" strings: a 'K'
+# followed by a list of 4 digit hex words, the first being the carrier and the
+# rest alternating mark/space pulse lengths e.g.
+#
+#   K 2627 1123 11DD 019D 0244 019D 0244 019E 0243 ...
+#
+# That is 5 bytes per 16 bit word, and these strings are held in every device
+# DB entry and copied again into every model.  Instead we store them packed:
+#
+#   b'K\x01' <varint word count> <varint word> ...
+#
+# where each word is stored as the zigzag-encoded difference from the word two
+# before it (i.e. the previous mark, or previous space), which is almost
+# always small, so most words take a single byte.
+#
+# Codes which aren't in canonical K-format (e.g. the plain text commands some
+# devices take over TCP) are left as strings.  Anything consuming codes should
+# call send_ready(), which accepts either form and returns the bytes to put on
+# the wire; decoding is memoised, so each code is decoded once per process.
+
+import re
+import functools
+
+from logutilities import log_debug
+
+K_FORMAT = re.compile(r'K( [0-9A-F]{4})+')
+PACKED_PREFIX = b'K\x01'
+
+
+def _put_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+@functools.lru_cache(maxsize=4096)
+def encode_IR(code):
+    # Pack a K-format string; return anything else unchanged.  Memoised so
+    # that the same code always packs to the same object, which pickle then
+    # stores only once however many times the model refers to it.
+    if not isinstance(code, str) or not K_FORMAT.fullmatch(code):
+        return code
+
+    words = [int(w, 16) for w in code[2:].split(' ')]
+    out = bytearray(PACKED_PREFIX)
+    _put_varint(out, len(words))
+    for i, w in enumerate(words):
+        delta = w - (words[i - 2] if i >= 2 else 0)
+        _put_varint(out, (delta << 1) ^ (delta >> 63))
+
+    packed = bytes(out)
+    if _decode(packed) != code:
+        log_debug("IR code %s doesn't round trip; storing verbatim", code)
+        return code
+
+    return packed
+
+
+def _decode(packed):
+    count, pos = _get_varint(packed, len(PACKED_PREFIX))
+    words = []
+    for i in range(count):
+        z, pos = _get_varint(packed, pos)
+        delta = (z >> 1) ^ -(z & 1)
+        words.append(delta + (words[i - 2] if i >= 2 else 0))
+    return "K " + " ".join("%04X" % w for w in words)
+
+
+def is_packed(code):
+    return isinstance(code, bytes) and code.startswith(PACKED_PREFIX)
+
+
+@functools.lru_cache(maxsize=4096)
+def decode_IR(code):
+    # Return the string form of a code, packed or not.
+    if is_packed(code):
+        return _decode(code)
+    return code
+
+
+@functools.lru_cache(maxsize=4096)
+def send_ready(code):
+    # Return the bytes to send to the KIRA for a code, packed or not.
+    return decode_IR(code).encode('utf-8')
+
+
+def compact_device(device_details):
+    # Return a copy of a device DB entry with its IR codes packed.
+    if 'IRcodes' not in device_details:
+        return device_details
+    compacted = dict(device_details)
+    compacted['IRcodes'] = { c: encode_IR(device_details['IRcodes'][c]) for c in device_details['IRcodes'] }
+    return compacted
+
+
+def expand_device(device_details):
+    # Return a copy of a device DB entry with its IR codes as strings.
+    if 'IRcodes' not in device_details:
+        return device_details
+    expanded = dict(device_details)
+    expanded['IRcodes'] = { c: decode_IR(device_details['IRcodes'][c]) for c in device_details['IRcodes'] }
+    return expanded
+
+
+def compact_model(obj, memo=None):
+    # Return a copy of a model (or any part of it) with every command's KIRA
+    # code packed.  Objects shared within the model stay shared in the copy.
+    return _map_model(obj, encode_IR, {} if memo is None else memo)
+
+
+def expand_model(obj, memo=None):
+    # The reverse of compact_model, for display.
+    return _map_model(obj, decode_IR, {} if memo is None else memo)
+
+
+def _map_model(obj, fn, memo):
+    if id(obj) in memo:
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        mapped = { k: (fn(v) if k == 'KIRA' else _map_model(v, fn, memo)) for k, v in obj.items() }
+    elif isinstance(obj, list):
+        mapped = [_map_model(v, fn, memo) for v in obj]
+    else:
+        return obj
+    memo[id(obj)] = mapped
+    return mapped
@@ -21,25 +21,37 @@ import os
 from logutilities import log_info, log_debug
 from userState import Device, User
 from ip import SendTCP, SendUDP
+from IRcodec import expand_model, send_ready
+from recompile import recompile_for_devices, rebuild_device_index, DEFAULT_WORKERS
+import bulk as bulk_transfer
+from sendscript import run_script, ScriptError
+from bench import run_bench, DEFAULT_TARGET, DEFAULT_COUNT, BENCH_MESSAGE
 
 pp = pprint.PrettyPrinter(indent=2, width = 200)
 
 def parse_command_line(argv):
-	parser = argparse.ArgumentParser(description='Manage user and device details for Keene IR Alexa skill, and send test commands to devices.')
-	parser.add_argument("command", choices = ['get', 'set', 'send'], help='One of get, set or send')
+	parser = argparse.ArgumentParser(description='Manage user and device details for Keene IR Alexa skill, send test commands to devices, and benchmark sending.')
+	parser.add_argument("command", choices = ['get', 'set', 'send', 'bench', 'reindex'], help='One of get, set, send, bench or reindex')
 	parser.add_argument('-u','--user', type=str, help='Amazon account name of user')
 	parser.add_argument('-m','--manufacturer', type=str, help='Manufacturer name')
 	parser.add_argument('-d','--device', type=str, help='Device name')
-	parser.add_argument('-f','--file', type=str, help='File to read/write object from')
-	parser.add_argument('-b','--bulk', type=str, choices = ['user', 'device'], help='Bulk load')
+	parser.add_argument('-f','--file', type=str, help='File to read/write object from, or script of commands to send')
+	parser.add_argument('-b','--bulk', type=str, choices = ['user', 'device'], help='Bulk upload (set) or export (get) of all users or devices')
 	parser.add_argument('-l','--details', action='store_true', help='Set if wanting to get/set user details')
 	parser.add_argument('-o','--model', action='store_true', help='Set if wanting to get/set user model')
 	parser.add_argument('-s','--status', action='store_true', help='Set if wanting to get/set user device status')
 	parser.add_argument('-t','--target', type=str, help='Target to send KIRA command to; must be of form <IP address>:<port>')
 	parser.add_argument('-i','--IRcommand', type=str, help='Name of IR command to send')
 	parser.add_argument('-r','--repeats', type=int, default=0, help='Number of repeats')
+	parser.add_argument('-w','--workers', type=int, default=DEFAULT_WORKERS, help='Number of workers for bulk transfers, and to recompile affected user models with after setting devices')
 
-	args = vars(parser.parse_args())
+	parser.add_argument('-n','--count', type=int, default=DEFAULT_COUNT, help='Number of commands to send when benchmarking')
+	parser.add_argument('-c','--concurrency', type=int, default=1, help='Number of concurrent senders when benchmarking')
+	parser.add_argument('-p','--protocol', type=str, choices = ['udp', 'tcp'], help='Protocol to benchmark (default that of the device, or udp)')
+	parser.add_argument('--rate', type=float, default=0, help='Commands per second to benchmark at (default as fast as possible)')
+	parser.add_argument('--listen', action='store_true', help='Benchmark against a simulated KIRA (see testKIRAfarm.py) on the target port')
+
+	args = vars(parser.parse_args(argv))
 	return args
 
 def print_user_details(user_details, device_status):
@@ -82,6 +94,88 @@ def print_device(device):
 		print("-\t%-20s %s" % (c, IRcodes[c]))
 
 
+def print_errors(errors):
+	for name, error in errors:
+		print("Error: %s: %s" % ("/".join(name) if isinstance(name, tuple) else name, error))
+
+def bulk_command(args_dict, get_cmd, set_cmd):
+	json_file = args_dict['file']
+	workers = args_dict['workers']
+	if not json_file:
+		print("Error: bulk transfers must specify JSON file")
+		return
+	if not (get_cmd or set_cmd):
+		print("Error: can only get or set in bulk")
+		return
+
+	try:
+		if args_dict['bulk'] == "user":
+			if get_cmd:
+				exported, errors, elapsed = bulk_transfer.export_users(json_file, workers)
+				print("Exported details for %d users to %s in %.2fs" % (len(exported), json_file, elapsed))
+			else:
+				uploaded, errors, elapsed = bulk_transfer.upload_users(json_file, workers)
+				print("Uploaded details for %d users in %.2fs" % (len(uploaded), elapsed))
+		else:
+			if get_cmd:
+				exported, errors, elapsed = bulk_transfer.export_devices(json_file, workers)
+				print("Exported details for %d devices to %s in %.2fs" % (len(exported), json_file, elapsed))
+			else:
+				uploaded, errors, elapsed, affected, failed = bulk_transfer.upload_devices(json_file, workers)
+				print("Uploaded details for %d devices in %.2fs" % (len(uploaded), elapsed))
+				print("Recompiled models for %d users affected by these devices" % (len(affected) - len(failed)))
+				for this_user in failed:
+					print("Error: could not recompile model for user %s" % (this_user))
+	except OSError as e:
+		print("Error: %s" % (e))
+		return
+
+	print_errors(errors)
+
+
+def send_script(args_dict):
+	try:
+		steps, failed = run_script(args_dict['file'], args_dict['target'], args_dict['workers'])
+	except (OSError, ScriptError) as e:
+		print("Error: %s" % (e))
+		return
+	print("Sent %d of %d commands" % (len(steps) - len(failed), len(steps)))
+
+
+def bench_command(args_dict):
+	target = args_dict['target'] or DEFAULT_TARGET
+	protocol = args_dict['protocol']
+	message = BENCH_MESSAGE
+
+	# Send the given device's command if there is one, else a typical code.
+	if args_dict['manufacturer'] and args_dict['device'] and args_dict['IRcommand']:
+		details = Device(args_dict['manufacturer'], args_dict['device']).get()
+		try:
+			message = send_ready(details['IRcodes'][args_dict['IRcommand']])
+		except KeyError:
+			print("Error: could not find command %s for device %s/%s" % (args_dict['IRcommand'], args_dict['manufacturer'], args_dict['device']))
+			return
+		protocol = protocol or details['protocol']
+	protocol = protocol or "udp"
+
+	farm = None
+	if args_dict['listen']:
+		from testKIRAfarm import testKIRAfarm, make_devices
+		host, port = target.split(":")
+		farm = testKIRAfarm(make_devices(int(port), 1, protocol, host=host))
+		farm.spawn()
+
+	try:
+		result = run_bench(target, protocol, message, args_dict['count'], args_dict['concurrency'], args_dict['rate'])
+		for line in result.report():
+			print(line)
+		if farm:
+			print("Simulated KIRA received %d messages" % len(farm.get_records()))
+	finally:
+		if farm:
+			farm.terminate()
+
+
 def main(argv):
 	# Start by parsing the command-line options.
 	args_dict = parse_command_line(argv)
@@ -90,8 +184,23 @@ def main(argv):
 	set_cmd = (args_dict['command'] == "set")
 	send_cmd = (args_dict['command'] == "send")
 
+	if args_dict['command'] == "bench":
+		bench_command(args_dict)
+		return
+
+	if args_dict['command'] == "reindex":
+		indexed = rebuild_device_index(args_dict['workers'])
+		if indexed is None:
+			print("Error: could not rebuild the device index")
+		else:
+			print("Rebuilt the device index from %d users" % (len(indexed)))
+		return
+
 	user = False
-	bulk = False
+
+	if send_cmd and args_dict['file']:
+		send_script(args_dict)
+		return
 
 	if set_cmd:
 		if not args_dict['file']:
@@ -107,9 +216,8 @@ def main(argv):
 		manufacturer = args_dict['manufacturer']
 		device = args_dict['device']
 	elif args_dict['bulk']:
-		bulk = True
-		if args_dict['bulk'] == "user":
-			user = True
+		bulk_command(args_dict, get_cmd, set_cmd)
+		return
 	else:
 		print("Error: must specify one of user or device")
 		return
@@ -120,45 +228,41 @@ def main(argv):
 			if args_dict['details']:
 				print_user_details(u.get_details(), u.get_device_status())
 			elif args_dict['model']:
-				print(pp.pformat(u.get_model()))
+				print(pp.pformat(expand_model(u.get_model())))
 			elif args_dict['status']:
 				print_device_status(u.get_device_status())
 		elif set_cmd:
-			input_dict = json.loads(open(json_file).read())
+			with open(json_file) as f:
+				details = json.load(f)
 
-			if not bulk:
-				this_dict = { user_id: input_dict }
-			else:
-				this_dict = input_dict
-
-			for this_user in this_dict:
-				print("Uploading details for user %s" % (this_user))
-				u = User(this_user)
-				u.set_details(this_dict[this_user])
+			print("Uploading details for user %s" % (user_id))
+			u = User(user_id)
+			u.set_details(details)
+			if not u.compile_model():
+				print("Error: could not compile model for user %s; check their devices are uploaded" % (user_id))
 		else:
 			print("Error: cannot send to a user, only a device")
 	else:
 		if get_cmd:
-			d = Device(manufacturer, device, use_S3=True)
+			d = Device(manufacturer, device)
 			print_device(d.get())
 		elif set_cmd:
-			input_dict = json.loads(open(json_file).read())
+			with open(json_file) as f:
+				details = json.load(f)
 
-			if not bulk:
-				this_dict = { manufacturer: { device: input_dict } }
-			else:
-				this_dict = input_dict
+			print("Uploading details for device %s from manufacturer %s" % (device, manufacturer))
+			Device(manufacturer, device).set(details)
 
-			for this_manufacturer in this_dict:
-				for this_device in this_dict[this_manufacturer]:
-					print("Uploading details for device %s from manufacturer %s" % (this_device, this_manufacturer))
-					d = Device(this_manufacturer, this_device, use_S3=True)
-					d.set(this_dict[this_manufacturer][this_device])
+			# Bring the models of users with this device up to date
+			affected, failed = recompile_for_devices([ (manufacturer, device) ], args_dict['workers'])
+			print("Recompiled models for %d users affected by this device" % (len(affected) - len(failed)))
+			for this_user in failed:
+				print("Error: could not recompile model for user %s" % (this_user))
 		else:
-			if not (args_dict['target'] and args_dict['command']):
+			if not (args_dict['target'] and args_dict['IRcommand']):
 				print("Error: must specify both a target and a command to send to that target")
 			else:
-				d = Device(manufacturer, device, use_S3=True)
+				d = Device(manufacturer, device)
 				details = d.get()
 				IRcommand = args_dict['IRcommand']
 				target = args_dict['target']
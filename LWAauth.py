@@ -1,44 +1,190 @@
 # Copyright 2018 Calum Loudon
 #
-# Licensed under the Apache License, Version 2.0 (the "License"). You may not 
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
 # use this file except in compliance with the License. A copy of the License
 # is located at
 #
 #    http://www.apache.org/licenses/LICENSE-2.0
 #
-# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR 
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
 # CONDITIONS OF ANY KIND, express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
 # This file talks to Amazon LWA (the AWS OAuth2 service) to extract the user
 # corresponding to an access token.
+#
+# The LWA lookup is a network round trip on every directive, so we cache the
+# result, keyed by a hash of the token (so we never hold tokens themselves).
+# A cached user must not outlive the token's lifetime: a token which expires
+# or is revoked must stop working soon after.  If LWA tells us how long the
+# token has left (as 'exp', in seconds, as its tokeninfo endpoint does) we
+# cache the lookup for no longer than that; we never cache it for longer than
+# LWA_CACHE_TTL seconds (default 5 minutes), which bounds how long a revoked
+# token is still accepted.  Failed lookups are cached for
+# LWA_NEGATIVE_CACHE_TTL seconds (default 30) so a bad token can't hammer LWA.
+# The cache holds at most LWA_CACHE_SIZE entries, evicting the least recently
+# used.
+#
+# Lookups which fail for transient reasons (timeouts, connection failures, LWA
+# server errors) are not cached.
+#
+# Lookups share a single requests session, so connections to LWA are kept
+# alive and reused across directives handled by the same process, from a pool
+# of at most LWA_POOL_SIZE connections.  Each request has explicit connect and
+# read timeouts (LWA_CONNECT_TIMEOUT, LWA_READ_TIMEOUT), so a slow LWA makes
+# the lookup fail fast rather than running the lambda into its timeout.
+# Failures to connect and LWA server errors are retried up to LWA_RETRIES
+# times with exponential backoff (LWA_BACKOFF), but read timeouts are not: an
+# LWA which has stopped responding would just time out again, multiplying the
+# time we wait.  So a lookup takes at most about the read timeout, or the
+# connect timeout per attempt.
+#
+# requests is slow to import, so is only imported when first needed.
+#
+# The profile URL can be overridden with LWA_PROFILE_URL e.g. to point at a
+# local stand-in (see testLWA.py).
 
 import os
 import json
-import pprint
-import requests
-import urllib
+import time
+import hashlib
+import threading
+import collections
+import urllib.parse
 
-from logutilities import log_info, log_debug, log_error
+from logutilities import log_info, log_debug, log_error, lazy_json
 
 LWA_PROFILE_URL = 'https://api.amazon.com/user/profile?'
+UNKNOWN_USER = "<unknown>"
+
+LWA_CACHE_TTL = float(os.environ.get('LWA_CACHE_TTL', 300))
+LWA_NEGATIVE_CACHE_TTL = float(os.environ.get('LWA_NEGATIVE_CACHE_TTL', 30))
+LWA_CACHE_SIZE = int(os.environ.get('LWA_CACHE_SIZE', 1024))
+
+LWA_POOL_SIZE = int(os.environ.get('LWA_POOL_SIZE', 4))
+LWA_CONNECT_TIMEOUT = float(os.environ.get('LWA_CONNECT_TIMEOUT', 1.0))
+LWA_READ_TIMEOUT = float(os.environ.get('LWA_READ_TIMEOUT', 2.0))
+LWA_RETRIES = int(os.environ.get('LWA_RETRIES', 2))
+LWA_BACKOFF = float(os.environ.get('LWA_BACKOFF', 0.1))
+
+
+class TokenCache:
+    # Bounded LRU cache of token hash -> (user, expiry time)
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user, expiry = entry
+            if expiry < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return user
+
+    def put(self, key, user, ttl):
+        with self.lock:
+            self.entries[key] = (user, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+user_cache = TokenCache(LWA_CACHE_SIZE)
+
+G_SESSION = None
+G_SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    # Create the shared session on first use.
+    global G_SESSION
+    with G_SESSION_LOCK:
+        if G_SESSION is None:
+            import requests
+            import requests.adapters
+            import urllib3.util.retry
+
+            retry = urllib3.util.retry.Retry(total=LWA_RETRIES,
+                                             read=0,
+                                             backoff_factor=LWA_BACKOFF,
+                                             status_forcelist=(429, 500, 502, 503, 504),
+                                             allowed_methods=frozenset(['GET']),
+                                             raise_on_status=False)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=LWA_POOL_SIZE,
+                                                    max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            G_SESSION = session
+        return G_SESSION
+
+
+def token_key(token):
+    return hashlib.sha256(str(token).encode('utf-8')).hexdigest()
+
 
 def get_user_from_token(token):
-    log_debug("Token is %s", token)
+    key = token_key(token)
+    user = user_cache.get(key)
+    if user is not None:
+        log_debug("Token found in cache; user %s", user)
+        return user
 
-    url = LWA_PROFILE_URL + urllib.parse.urlencode({ 'access_token' : token })
-    r = requests.get(url=url)
+    user, lifetime = lookup_user_from_token(token)
+
+    if user is None:
+        # Transient failure; don't cache
+        user = UNKNOWN_USER
+    elif user == UNKNOWN_USER:
+        user_cache.put(key, user, LWA_NEGATIVE_CACHE_TTL)
+    elif lifetime is None:
+        user_cache.put(key, user, LWA_CACHE_TTL)
+    elif lifetime > 0:
+        user_cache.put(key, user, min(lifetime, LWA_CACHE_TTL))
+
+    return user
+
+
+def lookup_user_from_token(token):
+    # Returns (user, seconds the token has left if known), where user is
+    # UNKNOWN_USER if LWA rejected the token or None if we couldn't get an
+    # answer.
+    import requests
+
+    url = os.environ.get('LWA_PROFILE_URL', LWA_PROFILE_URL) + urllib.parse.urlencode({ 'access_token' : token })
+    try:
+        r = get_session().get(url=url, timeout=(LWA_CONNECT_TIMEOUT, LWA_READ_TIMEOUT))
+    except requests.exceptions.RequestException as e:
+        log_error("Amazon look up failed: %s", type(e).__name__)
+        return None, None
 
     if r.status_code == 200:
         log_debug("Amazon profile returned is:")
-        log_debug(json.dumps(r.json(), indent=4))
+        log_debug("%s", lazy_json(r.json(), indent=4))
 
         body = r.json()
         user = body['user_id']
+        lifetime = body.get('exp')
     else:
         log_error("Amazon look up returned an error %d", r.status_code)
-        log_error(json.dumps(r.json(), indent=4))
+        log_error("%s", r.text)
+        lifetime = None
 
-        user = "<unknown>"
+        if r.status_code >= 500 or r.status_code == 429:
+            user = None
+        else:
+            user = UNKNOWN_USER
 
-    return user
+    return user, lifetime
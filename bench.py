@@ -0,0 +1,125 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements benchmarking of sending IR commands to a KIRA target,
+# for the CLI (see KeeneIRAlexa.py bench), so that changes to the transport
+# can be measured.
+#
+# We send a given number of copies of a message from a number of concurrent
+# workers, each holding one connection to the target (see ip.KIRAConnection),
+# optionally paced to a given overall rate.  We report the sends per second,
+# percentiles of the time taken by each send (excluding connecting) and the
+# errors seen, by exception type.
+#
+# Without hardware, run it against a simulated KIRA (see testKIRAfarm.py,
+# spawned by the CLI with --listen), which also lets us count what was
+# received.
+
+import time
+import threading
+import collections
+import concurrent.futures
+
+from logutilities import log_info, log_error
+from ip import KIRAConnection, sleep_until
+
+DEFAULT_TARGET = "127.0.0.1:65432"
+DEFAULT_COUNT = 100
+
+# A typical KIRA code (Oppo BDP-83 Eject)
+BENCH_MESSAGE = "K 2622 22E7 11A5 0224 068F 0226 0240 0224 0240 0226 068D 0225 0240 0209 0241 0225 068D 0225 0240 0226 023F 020B 06A7 0225 068F 0225 0240 020A 06A8 020C 06A7 0225 0226 0224 068F 0224 0691 0224 068F 0224 0242 0223 068F 0225 068F 0225 0240 020B 0259 020A 0240 0226 023F 0224 0241 020A 06A8 020A 0241 0224 0240 0224 068F 0226 068C 0226 068D 0226 2000"
+
+PERCENTILES = (50, 95, 99)
+
+
+class BenchResult:
+
+	def __init__(self, target, protocol, count, concurrency):
+		self.target = target
+		self.protocol = protocol
+		self.count = count
+		self.concurrency = concurrency
+		self.latencies = []
+		self.errors = collections.Counter()
+		self.elapsed = 0.0
+
+	def percentile(self, p):
+		# Nearest rank percentile of the send times, in seconds.
+		if not self.latencies:
+			return 0.0
+		ordered = sorted(self.latencies)
+		rank = max(1, -(-p * len(ordered) // 100))
+		return ordered[rank - 1]
+
+	def sends_per_second(self):
+		return len(self.latencies) / self.elapsed if self.elapsed > 0 else 0.0
+
+	def report(self):
+		lines = [ "Sent %d of %d messages to %s over %s with %d workers in %.3fs" % (len(self.latencies), self.count, self.target, self.protocol, self.concurrency, self.elapsed),
+		          "Sends/second: %.1f" % self.sends_per_second() ]
+		if self.latencies:
+			lines.append("Send latency (ms): " + "  ".join("p%d %.3f" % (p, self.percentile(p) * 1000) for p in PERCENTILES) + "  max %.3f" % (max(self.latencies) * 1000))
+		lines.append("Errors: %d" % sum(self.errors.values()))
+		for error, n in sorted(self.errors.items()):
+			lines.append("-\t%s: %d" % (error, n))
+		return lines
+
+
+def run_bench(target, protocol, message, count=DEFAULT_COUNT, concurrency=1, rate=0):
+	# Send count copies of the message from concurrency workers, at rate sends
+	# per second overall (or as fast as possible if 0).  Returns a BenchResult.
+	result = BenchResult(target, protocol, count, concurrency)
+	data = message if isinstance(message, bytes) else message.encode('utf-8')
+	next_index = iter(range(count))
+	index_lock = threading.Lock()
+	start = time.perf_counter()
+
+	def worker():
+		latencies = []
+		errors = collections.Counter()
+		connection = None
+		try:
+			while True:
+				with index_lock:
+					i = next(next_index, None)
+				if i is None:
+					break
+				if rate > 0:
+					sleep_until(start + i / rate)
+				try:
+					if connection is None:
+						connection = KIRAConnection(target, protocol)
+					send_start = time.perf_counter()
+					connection.send(data)
+					latencies.append(time.perf_counter() - send_start)
+				except OSError as e:
+					errors[type(e).__name__] += 1
+					if connection is not None:
+						connection.close()
+						connection = None
+		finally:
+			if connection is not None:
+				connection.close()
+		return latencies, errors
+
+	log_info("Benchmark %d sends to %s over %s with %d workers at rate %s", count, target, protocol, concurrency, rate or "unlimited")
+	with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+		futures = [ pool.submit(worker) for i in range(concurrency) ]
+		for future in futures:
+			latencies, errors = future.result()
+			result.latencies.extend(latencies)
+			result.errors.update(errors)
+	result.elapsed = time.perf_counter() - start
+
+	if result.errors:
+		log_error("Benchmark of %s saw errors: %s", target, dict(result.errors))
+	return result
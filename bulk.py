@@ -0,0 +1,298 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements bulk upload and export of user and device details for
+# the CLI (see KeeneIRAlexa.py).
+#
+# Transfers run on a bounded pool of workers, with progress written to stderr
+# and a summary of any errors at the end.  Input files are parsed as a stream
+# of top level entries (one user, or one manufacturer's devices, at a time)
+# rather than loaded whole, and entries are only read ahead of the workers by
+# a bounded amount, so the size of the file doesn't matter.
+#
+# Uploading users updates the device index (see userState.py) once for the
+# whole batch, rather than every worker contending to update it per user.
+#
+# Export lists the objects in the relevant bucket and reads them in parallel.
+# Device keys are of the form <manufacturer>-<device>, so we assume
+# manufacturer names contain no hyphens.
+
+import sys
+import json
+import time
+import threading
+import concurrent.futures
+
+from logutilities import log_info, log_debug, log_error
+from userState import Device, User, get_storage, update_device_index_many, list_users, BUCKET_ROOT, BUCKET_GLOBALDB, KEY_ROOT
+from recompile import recompile_for_devices, DEFAULT_WORKERS
+
+READ_CHUNK_SIZE = 64 * 1024
+PROGRESS_INTERVAL = 1.0
+WHITESPACE = " \t\n\r"
+
+
+class JSONStream:
+	# Incremental reader of a JSON file whose top level is an object, yielding
+	# its entries one at a time.
+
+	def __init__(self, f, chunk_size=READ_CHUNK_SIZE):
+		self.f = f
+		self.chunk_size = chunk_size
+		self.buf = ""
+		self.pos = 0
+		self.eof = False
+		self.decoder = json.JSONDecoder()
+
+	def fill(self):
+		# Read more of the file, dropping what we have consumed.  Reads at least
+		# as much again as we hold, so re-parsing a large value is linear.
+		if self.eof:
+			return False
+		chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+		if not chunk:
+			self.eof = True
+			return False
+		self.buf = self.buf[self.pos:] + chunk
+		self.pos = 0
+		return True
+
+	def next_char(self):
+		# Skip whitespace and return the next character, without consuming it;
+		# empty at the end of the file.
+		while True:
+			while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+				self.pos += 1
+			if self.pos < len(self.buf) or not self.fill():
+				return self.buf[self.pos:self.pos + 1]
+
+	def expect(self, chars):
+		c = self.next_char()
+		if not c or c not in chars:
+			raise ValueError("Expected one of '%s' but found '%s'" % (chars, c))
+		self.pos += 1
+		return c
+
+	def value(self):
+		self.next_char()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buf, self.pos)
+				# A value running to the end of what we've read (e.g. a number)
+				# may continue in the next chunk.
+				if end < len(self.buf) or self.eof:
+					self.pos = end
+					return value
+			except ValueError:
+				if self.eof:
+					raise
+			self.fill()
+
+	def entries(self):
+		self.expect("{")
+		if self.next_char() == "}":
+			self.pos += 1
+			return
+		while True:
+			key = self.value()
+			if not isinstance(key, str):
+				raise ValueError("Expected a key but found %r" % (key,))
+			self.expect(":")
+			yield key, self.value()
+			if self.expect(",}") == "}":
+				return
+
+
+def iter_json_entries(path):
+	with open(path) as f:
+		yield from JSONStream(f).entries()
+
+
+class Progress:
+	# Thread safe count of completed transfers, reported to stderr.  On a
+	# terminal we update one line in place; otherwise we write a line at most
+	# every PROGRESS_INTERVAL.
+
+	def __init__(self, label, out=sys.stderr):
+		self.label = label
+		self.out = out
+		self.tty = out.isatty()
+		self.done = 0
+		self.errors = 0
+		self.start = time.time()
+		self.last = 0
+		self.written = -1
+		self.lock = threading.Lock()
+
+	def update(self, ok):
+		with self.lock:
+			self.done += 1
+			if not ok:
+				self.errors += 1
+			now = time.time()
+			if self.tty or now - self.last >= PROGRESS_INTERVAL:
+				self.last = now
+				self.write()
+
+	def write(self):
+		line = "%s: %d done, %d errors" % (self.label, self.done, self.errors)
+		self.out.write("\r" + line if self.tty else line + "\n")
+		self.out.flush()
+		self.written = self.done
+
+	def finish(self):
+		# Make sure the final count is shown.
+		with self.lock:
+			if self.written != self.done:
+				self.write()
+			if self.tty:
+				self.out.write("\n")
+		return time.time() - self.start
+
+
+def run_bulk(tasks, fn, workers=DEFAULT_WORKERS, label="Transferred"):
+	# Run fn(*args) for each (name, args) from the tasks iterator on a pool of
+	# workers, reading tasks only a little ahead of them.  fn returns a result,
+	# or raises (or returns None) on failure.  Returns ({ name: result },
+	# [ (name, error) ], time taken).
+	results = {}
+	errors = []
+	progress = Progress(label)
+	window = threading.BoundedSemaphore(workers * 2)
+
+	def run(name, args):
+		try:
+			result = fn(*args)
+			if result is None:
+				return False, "failed"
+			return True, result
+		except Exception as e:
+			log_error("Exception %s in bulk transfer of %s", repr(e), name)
+			return False, repr(e)
+		finally:
+			window.release()
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+		futures = {}
+		try:
+			for name, args in tasks:
+				window.acquire()
+				futures[pool.submit(run, name, args)] = name
+		except ValueError as e:
+			errors.append(("input", str(e)))
+
+		for future in concurrent.futures.as_completed(futures):
+			name = futures[future]
+			ok, result = future.result()
+			if ok:
+				results[name] = result
+			else:
+				errors.append((name, result))
+			progress.update(ok)
+
+	elapsed = progress.finish()
+	log_info("%s %d items with %d errors in %.2fs", label, len(results), len(errors), elapsed)
+	return results, sorted(errors, key=str), elapsed
+
+
+def device_tasks(path):
+	for manufacturer, devices in iter_json_entries(path):
+		for device, details in devices.items():
+			yield (manufacturer, device), (manufacturer, device, details)
+
+
+def upload_device(manufacturer, device, details):
+	return Device(manufacturer, device).set(details)
+
+
+def upload_devices(path, workers=DEFAULT_WORKERS):
+	# Upload all devices in the file, then recompile the models of users with
+	# any of them.  Returns (uploaded, errors, time taken, users affected,
+	# users we failed to recompile).
+	get_storage()
+	results, errors, elapsed = run_bulk(device_tasks(path), upload_device, workers, "Uploaded devices")
+	uploaded = sorted(results)
+	affected, failed = recompile_for_devices(uploaded, workers)
+	return uploaded, errors, elapsed, affected, failed
+
+
+def upload_user(user_id, details):
+	# Returns the user's old and new devices, for the index update, and
+	# whether we compiled their model.
+	u = User(user_id)
+	old_devices, new_devices = u.set_details(details, update_index=False)
+	return old_devices, new_devices, u.compile_model()
+
+
+def upload_users(path, workers=DEFAULT_WORKERS):
+	# Upload all users in the file and compile their models.  Returns
+	# (uploaded, errors, time taken).
+	storage = get_storage()
+	tasks = ((user_id, (user_id, details)) for user_id, details in iter_json_entries(path))
+	results, errors, elapsed = run_bulk(tasks, upload_user, workers, "Uploaded users")
+	update_device_index_many(storage, [ (user_id, old, new) for user_id, (old, new, compiled) in results.items() ])
+	for user_id, (old, new, compiled) in results.items():
+		if not compiled:
+			errors.append((user_id, "could not compile model; check their devices are uploaded"))
+	return sorted(results), sorted(errors, key=str), elapsed
+
+
+def export_device(manufacturer, device):
+	details = Device(manufacturer, device).get()
+	return details or None
+
+
+def export_devices(path, workers=DEFAULT_WORKERS):
+	# Export all devices to the file as { manufacturer: { device: details } },
+	# the format upload_devices takes.  Returns (exported, errors, time taken).
+	storage = get_storage()
+	tasks = []
+	for key in storage.list_keys(BUCKET_ROOT + BUCKET_GLOBALDB):
+		if not key.startswith(KEY_ROOT) or "-" not in key[len(KEY_ROOT):]:
+			log_debug("Skipping unexpected object %s", key)
+			continue
+		manufacturer, device = key[len(KEY_ROOT):].split("-", 1)
+		tasks.append(((manufacturer, device), (manufacturer, device)))
+
+	results, errors, elapsed = run_bulk(tasks, export_device, workers, "Exported devices")
+	output = {}
+	for (manufacturer, device), details in sorted(results.items()):
+		output.setdefault(manufacturer, {})[device] = details
+	write_json(path, output)
+	return sorted(results), errors, elapsed
+
+
+def export_user(user_id):
+	return User(user_id).get_details() or None
+
+
+def export_users(path, workers=DEFAULT_WORKERS):
+	# Export all users' details to the file as { user: details }, the format
+	# upload_users takes.  Returns (exported, errors, time taken).
+	tasks = [ (user_id, (user_id,)) for user_id in list_users(get_storage()) ]
+
+	results, errors, elapsed = run_bulk(tasks, export_user, workers, "Exported users")
+	write_json(path, dict(sorted(results.items())))
+	return sorted(results), errors, elapsed
+
+
+def json_default(obj):
+	# Devices seeded from deviceDB.py hold their roles etc. as sets.
+	if isinstance(obj, (set, frozenset)):
+		return sorted(obj)
+	raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+def write_json(path, output):
+	with open(path, "w") as f:
+		json.dump(output, f, indent=2, default=json_default)
+		f.write("\n")
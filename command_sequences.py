@@ -15,7 +15,7 @@
 
 import pprint
 
-from logutilities import log_info, log_debug
+from logutilities import log_info, log_debug, lazy_pformat
 from alexaSchema import CAPABILITY_DISCOVERY_RESPONSES, CAPABILITY_DIRECTIVES_TO_COMMANDS
 from utilities import get_repeats
 
@@ -46,7 +46,7 @@ def construct_specific_IR_command(device_details, command, target, device_name,
 
 
 def SingleIRCommand(device, capability, command_list):
-	log_debug("Have list of single IR commands to check: %s", pp.pformat(command_list))
+	log_debug("Have list of single IR commands to check: %s", lazy_pformat(command_list))
 	cap_to_check = which_capability(capability)
 	log_debug("Checking for capability %s", capability)
 
@@ -57,7 +57,7 @@ def SingleIRCommand(device, capability, command_list):
 
 	output_cmd = {}
 
-	log_debug("Checking device details: %s", pp.pformat(device_details))
+	log_debug("Checking device details: %s", lazy_pformat(device_details))
 
 	if cap_to_check in device_details['supports']:
 		log_debug("Device %s supports the %s capability", device_name, capability)
@@ -178,7 +178,7 @@ def InputChoice(device, capability, command_list):
 	# values.
 	if 'required_input' in device:
 		log_debug("Need to set %s to input %s", device_name, device['required_input'])
-		log_debug("device_details: %s", pp.pformat(device_details['IRcodes']))
+		log_debug("device_details: %s", lazy_pformat(device_details['IRcodes']))
 
 		output_cmd['SingleIRCommand'] = {}
 		output_cmd['SingleIRCommand']['single'] = construct_specific_IR_command(device_details, device['required_input'], target, device_name, device_logname)
@@ -234,7 +234,7 @@ def construct_command_sequence(device_chain, capability, generic_commands):
 	# instructions.
 	commands = []
 
-	log_debug("Converting generic primitives %s to specific commands for capability %s for device chain %s", pp.pformat(generic_commands), capability, pp.pformat(device_chain))
+	log_debug("Converting generic primitives %s to specific commands for capability %s for device chain %s", lazy_pformat(generic_commands), capability, lazy_pformat(device_chain))
 
 	for primitive in generic_commands:
 		log_debug("This primitive is %s", primitive)
@@ -249,6 +249,6 @@ def construct_command_sequence(device_chain, capability, generic_commands):
 
 			commands.append(globals()[primitive](link, capability, generic_commands[primitive]))
 
-	log_debug("Commands for this directive:\n%s", pp.pformat(commands))		
+	log_debug("Commands for this directive:\n%s", lazy_pformat(commands))		
 
 	return commands		
@@ -0,0 +1,262 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements a read cache in front of a storage backend (see
+# storage.py), with two tiers:
+#
+# - an in-memory tier, which lives as long as the process
+# - a disk tier (typically under /tmp), which on Lambda often survives the
+#   process being recycled.
+#
+# Each cached object is held along with the schema version and the stamp (S3
+# ETag) of the write it came from.  On every read we revalidate with the
+# backend using that stamp; if the object is unchanged the backend transfers
+# nothing and we serve the cached copy.  So after a process restart the
+# in-memory tier is repopulated from disk rather than by downloading from S3.
+#
+# The disk tier holds one file per object, named by a hash of bucket and key:
+#
+#   <schema version>\n<stamp>\n<blob>
+#
+# Its total size is capped; when over the cap we evict the least recently used
+# files (we touch a file's mtime each time it is used).
+
+import os
+import hashlib
+import tempfile
+import threading
+import collections
+
+from storage import StorageBackend, WriteConflict
+from logutilities import log_info, log_debug, log_error
+
+DEFAULT_DISK_CACHE_DIR = "/tmp/keeneiralexa-cache"
+DEFAULT_DISK_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMORY_CACHE_ENTRIES = 256
+
+
+class DiskCache:
+	# The disk tier.
+
+	def __init__(self, root, max_bytes=DEFAULT_DISK_CACHE_MAX_BYTES):
+		self.root = root
+		self.max_bytes = max_bytes
+		self.total_bytes = None
+		self.lock = threading.Lock()
+		os.makedirs(root, exist_ok=True)
+
+	def _path(self, bucket_name, key_name):
+		name = hashlib.sha1((bucket_name + "/" + key_name).encode('utf-8')).hexdigest()
+		return os.path.join(self.root, name)
+
+	def get(self, bucket_name, key_name):
+		# Returns (blob, version, stamp), or None if not cached.
+		path = self._path(bucket_name, key_name)
+		try:
+			with open(path, "rb") as f:
+				data = f.read()
+			os.utime(path)
+		except OSError:
+			return None
+
+		parts = data.split(b'\n', 2)
+		if len(parts) != 3:
+			log_error("Discarding malformed disk cache entry %s", path)
+			self._remove(path)
+			return None
+
+		return parts[2], parts[0].decode('utf-8'), parts[1].decode('utf-8')
+
+	def put(self, bucket_name, key_name, blob, version, stamp):
+		path = self._path(bucket_name, key_name)
+		data = version.encode('utf-8') + b'\n' + stamp.encode('utf-8') + b'\n' + blob
+
+		if len(data) > self.max_bytes:
+			log_debug("Object %s/%s too big to cache on disk", bucket_name, key_name)
+			self.invalidate(bucket_name, key_name)
+			return
+
+		try:
+			old_size = os.stat(path).st_size
+		except OSError:
+			old_size = 0
+
+		try:
+			fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+			with os.fdopen(fd, "wb") as f:
+				f.write(data)
+			os.replace(tmp_path, path)
+		except OSError as e:
+			log_error("Error %s writing disk cache entry %s", e, path)
+			return
+
+		with self.lock:
+			if self.total_bytes is not None:
+				self.total_bytes += len(data) - old_size
+
+		self._evict()
+
+	def invalidate(self, bucket_name, key_name):
+		self._remove(self._path(bucket_name, key_name))
+
+	def _remove(self, path):
+		try:
+			size = os.stat(path).st_size
+			os.unlink(path)
+		except OSError:
+			return
+
+		with self.lock:
+			if self.total_bytes is not None:
+				self.total_bytes -= size
+
+	def _entries(self):
+		entries = []
+		for name in os.listdir(self.root):
+			if name.startswith(".tmp-"):
+				continue
+			try:
+				st = os.stat(os.path.join(self.root, name))
+			except OSError:
+				continue
+			entries.append((st.st_mtime_ns, st.st_size, name))
+		return entries
+
+	def _evict(self):
+		# We only scan the directory the first time, or when we might be over
+		# the cap.
+		with self.lock:
+			if self.total_bytes is None:
+				self.total_bytes = sum(size for mtime, size, name in self._entries())
+			if self.total_bytes <= self.max_bytes:
+				return
+
+			entries = sorted(self._entries())
+			self.total_bytes = sum(size for mtime, size, name in entries)
+			for mtime, size, name in entries:
+				if self.total_bytes <= self.max_bytes:
+					break
+				log_debug("Evict %s from disk cache", name)
+				try:
+					os.unlink(os.path.join(self.root, name))
+					self.total_bytes -= size
+				except OSError:
+					pass
+
+
+class CachedStorage(StorageBackend):
+	# A storage backend wrapping another one with the two tier cache.
+
+	def __init__(self, backend, disk_cache, memory_entries=DEFAULT_MEMORY_CACHE_ENTRIES):
+		self.backend = backend
+		self.disk_cache = disk_cache
+		self.memory_entries = memory_entries
+		self.memory = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.name = "cached " + backend.name
+
+	def _memory_get(self, index):
+		with self.lock:
+			entry = self.memory.get(index)
+			if entry is not None:
+				self.memory.move_to_end(index)
+			return entry
+
+	def _memory_put(self, index, entry):
+		with self.lock:
+			self.memory[index] = entry
+			self.memory.move_to_end(index)
+			while len(self.memory) > self.memory_entries:
+				self.memory.popitem(last=False)
+
+	def _memory_invalidate(self, index):
+		with self.lock:
+			self.memory.pop(index, None)
+
+	def write_object(self, bucket_name, key_name, blob, version, if_stamp=None):
+		index = (bucket_name, key_name)
+		try:
+			stamp = self.backend.write_object(bucket_name, key_name, blob, version, if_stamp)
+		except WriteConflict:
+			self._memory_invalidate(index)
+			self.disk_cache.invalidate(bucket_name, key_name)
+			raise
+
+		if stamp:
+			entry = (bytes(blob), version, stamp)
+			self._memory_put(index, entry)
+			self.disk_cache.put(bucket_name, key_name, *entry)
+		else:
+			self._memory_invalidate(index)
+			self.disk_cache.invalidate(bucket_name, key_name)
+
+		return stamp
+
+	def read_object(self, bucket_name, key_name):
+		blob, version, stamp = self.read_object_if_changed(bucket_name, key_name, None)
+		return blob, version
+
+	def read_object_if_changed(self, bucket_name, key_name, stamp):
+		index = (bucket_name, key_name)
+
+		cached = self._memory_get(index)
+		from_disk = False
+		if cached is None:
+			cached = self.disk_cache.get(bucket_name, key_name)
+			from_disk = cached is not None
+
+		if cached is None:
+			blob, version, new_stamp = self.backend.read_object_if_changed(bucket_name, key_name, None)
+		else:
+			blob, version, new_stamp = self.backend.read_object_if_changed(bucket_name, key_name, cached[2])
+
+		if blob is None:
+			log_debug("Object %s/%s served from %s cache", bucket_name, key_name, "disk" if from_disk else "memory")
+			if from_disk:
+				self._memory_put(index, cached)
+			blob, version, new_stamp = cached
+		elif new_stamp:
+			entry = (blob, version, new_stamp)
+			self._memory_put(index, entry)
+			self.disk_cache.put(bucket_name, key_name, *entry)
+		else:
+			self._memory_invalidate(index)
+			self.disk_cache.invalidate(bucket_name, key_name)
+
+		if stamp is not None and new_stamp == stamp:
+			return None, "", stamp
+
+		return blob, version, new_stamp
+
+	def list_keys(self, bucket_name):
+		return self.backend.list_keys(bucket_name)
+
+
+def create_cached_storage(backend):
+	# Wrap a backend with the cache, if configured.
+	if 'DISK_CACHE_DIR' in os.environ:
+		root = os.environ['DISK_CACHE_DIR']
+	elif 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+		root = DEFAULT_DISK_CACHE_DIR
+	else:
+		return backend
+
+	max_bytes = int(os.environ.get('DISK_CACHE_MAX_BYTES', DEFAULT_DISK_CACHE_MAX_BYTES))
+
+	try:
+		disk_cache = DiskCache(root, max_bytes)
+	except OSError as e:
+		log_error("Can't create disk cache under %s (%s); not caching", root, e)
+		return backend
+
+	log_info("Caching %s reads under %s, up to %d bytes", backend.name, root, max_bytes)
+	return CachedStorage(backend, disk_cache)
@@ -12,7 +12,7 @@
 
 import pprint
 
-from logutilities import log_info, log_debug
+from logutilities import log_info, log_debug, lazy_pformat
 from utilities import find_target, get_connected_device, find_user_device_in_DB
 
 pp = pprint.PrettyPrinter(indent=2, width = 200)
@@ -81,6 +81,6 @@ def construct_endpoint_chain(user_details, root_device, global_database):
 
 		chain.append(this_link)
 
-	log_debug("List of capabilities for this activity:\n%s", pp.pformat(capabilities))
-	log_debug("Device chain involved in this activity:\n%s", pp.pformat(chain))
+	log_debug("List of capabilities for this activity:\n%s", lazy_pformat(capabilities))
+	log_debug("Device chain involved in this activity:\n%s", lazy_pformat(chain))
 	return endpoint, capabilities, chain
@@ -0,0 +1,233 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements a standalone HTTP gateway for the skill, for running
+# the handler as a long running process on-prem next to the KIRA targets
+# rather than as a lambda.
+#
+# Directives are POSTed as Alexa-format JSON to any path, and the response
+# returned as JSON.  A batch of directives for one user (e.g. a scene) can be
+# POSTed to /batch as { "directives": [ directive, ... ] }, and is handled as
+# one (see AWSlambda.handle_batch), returning { "responses": [ ... ] }.
+#
+# Requests are handled on a thread each: directives for the same user are
+# handled one at a time, in order, while different users run in parallel.
+#
+# Everything stays hot across requests: we keep a User object per user,
+# holding their model and device status, and only re-read them from storage
+# if they have changed (e.g. because the model has been recompiled from the
+# CLI).  A user's session is dropped once they have sent nothing for
+# GATEWAY_SESSION_IDLE seconds (default 10 minutes), so that users seen once
+# don't hold memory for the life of the process.  LWA lookups are cached (see LWAauth.py), as are resolved KIRA
+# addresses, and TCP connections to KIRA targets are kept open between
+# directives until idle for GATEWAY_KEEP_IDLE seconds (default 30; see
+# ip.py).  Running with STORAGE_BACKEND=file keeps state on local disk, so no
+# directive needs to go to S3.
+#
+# GET /metrics returns the KIRA IO statistics (see ipstats.py) in Prometheus
+# text format, and GET /health a simple OK.
+#
+# Run as
+#
+#   python gateway.py [--host HOST] [--port PORT]
+#
+# GATEWAY_HOST and GATEWAY_PORT give the defaults.
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import http.server
+
+from logutilities import log_info, log_debug, log_error
+from AWSutilities import extract_user
+from LWAauth import UNKNOWN_USER
+from AWSlambda import handle_directive, handle_batch
+from response import serialize_response
+from userState import User
+from ip import keep_connections
+import ipstats
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_KEEP_IDLE = 30
+DEFAULT_SESSION_IDLE = 600
+MAX_REQUEST_BYTES = 1024 * 1024
+
+
+class UserSession:
+    # A user's state, kept across requests, and the lock serialising their
+    # requests.
+
+    def __init__(self, user_id):
+        self.lock = threading.Lock()
+        self.user = User(user_id)
+        self.last_used = time.monotonic()
+
+
+class Sessions:
+    # The sessions of users seen in the last idle_seconds.  Idle sessions are
+    # swept out as new requests arrive, at most every idle_seconds / 2.
+
+    def __init__(self, idle_seconds=DEFAULT_SESSION_IDLE):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.idle_seconds = idle_seconds
+        self.last_sweep = time.monotonic()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_sweep >= self.idle_seconds / 2:
+                self.evict_idle(now)
+            session = self.sessions.get(user_id)
+            if session is None:
+                log_debug("New session for user %s", user_id)
+                session = self.sessions[user_id] = UserSession(user_id)
+            session.last_used = now
+            return session
+
+    def evict_idle(self, now):
+        # Must hold the lock.  Sessions in use are never idle, however long
+        # their request has taken.
+        self.last_sweep = now
+        for user_id, session in list(self.sessions.items()):
+            if now - session.last_used >= self.idle_seconds and not session.lock.locked():
+                log_debug("Drop idle session for user %s", user_id)
+                del self.sessions[user_id]
+
+
+G_SESSIONS = Sessions(float(os.environ.get('GATEWAY_SESSION_IDLE', DEFAULT_SESSION_IDLE)))
+
+
+def handle(request):
+    # Handle a directive for the gateway.  Returns (HTTP status, response).
+    try:
+        request['directive']['header']['name']
+    except (KeyError, TypeError):
+        return 400, { 'error': "Not an Alexa directive" }
+
+    user_id = extract_user(request)
+    if user_id == UNKNOWN_USER:
+        log_info("Rejecting directive for unknown user")
+        return 401, { 'error': "Unknown user" }
+
+    session = G_SESSIONS.get(user_id)
+    with session.lock:
+        session.user.refresh()
+        return 200, handle_directive(request, session.user, serialized=True)
+
+
+def handle_batch_request(batch):
+    # Handle a batch of directives for the gateway.  Returns (HTTP status,
+    # response).
+    try:
+        requests = batch['directives']
+        for request in requests:
+            request['directive']['header']['name']
+    except (KeyError, TypeError):
+        return 400, { 'error': "Not a batch of Alexa directives" }
+
+    if not requests:
+        return 200, { 'responses': [] }
+
+    user_id = extract_user(requests[0])
+    if user_id == UNKNOWN_USER:
+        log_info("Rejecting batch for unknown user")
+        return 401, { 'error': "Unknown user" }
+
+    session = G_SESSIONS.get(user_id)
+    with session.lock:
+        session.user.refresh()
+        try:
+            return 200, { 'responses': handle_batch(requests, session.user) }
+        except ValueError as e:
+            log_error("Rejecting batch: %s", e)
+            return 400, { 'error': str(e) }
+
+
+class GatewayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_REQUEST_BYTES:
+            self.reply(400, json.dumps({ 'error': "Bad Content-Length" }))
+            return
+
+        try:
+            request = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.reply(400, json.dumps({ 'error': "Request is not JSON" }))
+            return
+
+        try:
+            if self.path == "/batch":
+                status, response = handle_batch_request(request)
+            else:
+                status, response = handle(request)
+        except Exception as e:
+            log_error("Exception %s handling directive", repr(e))
+            status, response = 500, { 'error': "Internal error" }
+
+        # Directives come back already serialized
+        self.reply(status, response if isinstance(response, bytes) else serialize_response(response))
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.reply(200, ipstats.to_prometheus(), "text/plain; version=0.0.4")
+        elif self.path == "/health":
+            self.reply(200, "OK", "text/plain")
+        else:
+            self.reply(404, json.dumps({ 'error': "Not found" }))
+
+    def reply(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log_debug("gateway: " + format, *args)
+
+
+def create_server(host, port):
+    keep_connections(float(os.environ.get('GATEWAY_KEEP_IDLE', DEFAULT_KEEP_IDLE)))
+    server = http.server.ThreadingHTTPServer((host, port), GatewayHandler)
+    server.daemon_threads = True
+    return server
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run the skill handler as an HTTP gateway.")
+    parser.add_argument("--host", default=os.environ.get('GATEWAY_HOST', DEFAULT_HOST), help="address to listen on")
+    parser.add_argument("--port", type=int, default=int(os.environ.get('GATEWAY_PORT', DEFAULT_PORT)), help="port to listen on")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    server = create_server(args.host, args.port)
+    log_info("Gateway listening on %s:%d", args.host, args.port)
+    print("Gateway listening on %s:%d" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
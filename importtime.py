@@ -0,0 +1,92 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file reports how long it takes to import the lambda, as a regression
+# check on cold start time.  Run
+#
+#   python importtime.py [module]
+#
+# to import the module (by default AWSlambda) in a fresh interpreter with
+# -X importtime and list the slowest imports.  The check fails if the import
+# takes longer than IMPORT_BUDGET_MS, or pulls in any of the modules which
+# should only be loaded on first use (LAZY_MODULES).
+
+import os
+import sys
+import subprocess
+
+DEFAULT_MODULE = "AWSlambda"
+DEFAULT_BUDGET_MS = 150
+RUNS = 3
+
+# Heavy modules which the lambda should only import when needed: boto3 when
+# S3 is used, requests for LWA lookups, jsonschema when validating, and the
+# model builder when compiling a model.
+LAZY_MODULES = ( "boto3", "botocore", "requests", "jsonschema", "pprint", "AWSS3storage", "model" )
+
+
+def measure(module):
+    # Import the module in a fresh interpreter.  Returns the list of
+    # (self us, cumulative us, depth, name) for it and everything it imported.
+    result = subprocess.run([ sys.executable, "-X", "importtime", "-c", "import " + module ],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True, check=True)
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((self_us, cumulative_us, depth, name.strip()))
+
+    # Imports are listed children first, so the module's imports are those
+    # since the previous top level import (e.g. by site).
+    end = max(i for i, e in enumerate(entries) if e[2] == 0 and e[3] == module)
+    start = end
+    while start > 0 and entries[start - 1][2] > 0:
+        start -= 1
+    return entries[start:end + 1]
+
+
+def check(module=DEFAULT_MODULE, budget_ms=None, runs=RUNS):
+    # Returns (ok, time in ms, lazy modules imported, entries of fastest run).
+    if budget_ms is None:
+        budget_ms = float(os.environ.get('IMPORT_BUDGET_MS', DEFAULT_BUDGET_MS))
+
+    best = min((measure(module) for i in range(runs)), key=lambda entries: entries[-1][1])
+    total_ms = best[-1][1] / 1000
+    eager = sorted(set(name for s, c, d, name in best if name.split(".")[0] in LAZY_MODULES))
+
+    return (total_ms <= budget_ms and not eager), total_ms, eager, best
+
+
+def report(module=DEFAULT_MODULE, top=15):
+    ok, total_ms, eager, entries = check(module)
+    print("Import of %s took %.1f ms" % (module, total_ms))
+    print("Slowest imports (cumulative ms):")
+    for s, c, d, name in sorted(entries, key=lambda e: e[1], reverse=True)[:top]:
+        print("  %8.1f  %s" % (c / 1000, name))
+    if eager:
+        print("Modules which should be imported lazily:", ", ".join(eager))
+    return ok
+
+
+if __name__ == '__main__':
+    ok = report(*sys.argv[1:2])
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
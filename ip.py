@@ -13,51 +13,363 @@
 # This file implements IO to the Keene IR devices, sending a given message
 # to a given target and port.
 
+# The message may be a string or the bytes to send (see IRcodec.send_ready).
+#
+# To take connection set up off the critical path, callers who know which
+# targets they are about to send to can warm them up in the background:
+# target addresses are resolved once and cached for DNS_CACHE_TTL seconds, and
+# for TCP targets a connection is opened ahead of time which the next
+# SendTCP to that target then uses.  Warm connections which end up unused
+# must be released with release_warm_connections, as KIRA targets may only
+# accept a few connections at a time.
+#
+# Targets are typically dynamic DNS names, whose address changes when the home
+# IP address does, and a UDP send to the old address fails silently.  So the
+# DNS cache is short lived (DNS_CACHE_TTL, default 60 seconds, the usual TTL
+# for dynamic DNS records), and we forget a target's address whenever
+# connecting or sending to it fails.
+#
+# Callers sending several messages to the same target (e.g. the CLI running a
+# script of commands) can hold a KIRAConnection open and send each through it,
+# rather than opening a new socket per message with SendUDP / SendTCP.
+#
+# Long running processes (see gateway.py) can instead have SendTCP keep its
+# connections open after sending, for reuse by later sends to the same
+# target, by calling keep_connections.  At most KEEP_PER_TARGET idle
+# connections are kept per target, and each is closed once idle for the
+# given time, as KIRA targets may only accept a few connections at a time.
+# Before reusing a connection we check the target hasn't closed it.
+# Repeats are paced against perf_counter deadlines, so the gap between them
+# doesn't drift with the time taken to send.
+#
+# TCP sockets time out after KIRA_TCP_TIMEOUT seconds (default 2) connecting
+# or sending, so a target which has stopped reading fails the send rather than
+# blocking it forever.
+#
+# Connect and send times, bytes sent and errors are recorded per target (see
+# ipstats.py).
+#
 # XXX We should check for a return of 'OK'.
 
+import os
 import socket
+import threading
 import time
 
-from logutilities import log_info, log_debug, log_error
+from logutilities import log_debug, log_error
+from ipstats import record_connect, record_send, record_error
 
-def SendUDP(target, mesg, repeat, repeatDelay):
-    log_info("Send UDP to %s with repeat %d, delay %.3f; message %s", target, repeat, repeatDelay, mesg)
+DNS_CACHE_TTL = float(os.environ.get('DNS_CACHE_TTL', 60))
+TCP_TIMEOUT = float(os.environ.get('KIRA_TCP_TIMEOUT', 2.0))
 
-    host, port = target.split(":")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('', int(port)))
-    for i in range(repeat+1):
-        log_debug("Sending %s", mesg.encode('utf-8'))
-        sock.sendto(mesg.encode('utf-8'), (host, int(port)))
-        if i < repeat:
-            time.sleep(repeatDelay)
-    sock.close()
+# How close to a deadline we stop sleeping and spin
+SPIN_SECONDS = 0.002
 
+# Resolved addresses: (host, port) -> (address, expiry time)
+G_ADDRESSES = {}
+
+# Warm TCP connections: target -> future for the connected socket
+G_WARM_CONNECTIONS = {}
+G_WARM_LOCK = threading.Lock()
+
+KEEP_PER_TARGET = 2
+
+# Kept TCP connections: target -> list of (KIRAConnection, time it went idle)
+G_KEPT_CONNECTIONS = {}
+G_KEPT_LOCK = threading.Lock()
+
+# How long to keep idle connections for; 0 if we don't keep them
+G_KEEP_IDLE = 0
+G_REAPER = None
+
+def to_bytes(mesg):
+    if isinstance(mesg, bytes):
+        return mesg
+    return mesg.encode('utf-8')
 
-def SendTCP(target, mesg, repeat, repeatDelay):
-    log_info("Send TCP to %s with repeat %d, delay %.3f; message %s", target, repeat, repeatDelay, mesg)
 
+def resolve(host, port):
+    now = time.monotonic()
+    entry = G_ADDRESSES.get((host, port))
+    if entry is not None and entry[1] > now:
+        return entry[0]
+
+    address = socket.getaddrinfo(host, port, socket.AF_INET)[0][4]
+    log_debug("Resolved %s:%d to %s", host, port, address)
+    G_ADDRESSES[(host, port)] = (address, now + DNS_CACHE_TTL)
+    return address
+
+
+def forget_address(target):
     host, port = target.split(":")
+    if G_ADDRESSES.pop((host, int(port)), None) is not None:
+        log_debug("Forgot address of %s", target)
+
+
+def resolve_target(target, protocol, host, port):
+    try:
+        return resolve(host, port)
+    except OSError:
+        record_error(target, protocol, "resolve")
+        raise
+
+
+def connect_TCP(host, port):
+    target = "%s:%d" % (host, port)
+    address = resolve_target(target, "tcp", host, port)
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(TCP_TIMEOUT)
     log_debug("Connecting to remote socket on %s:%s", host, port)
-    sock.connect((host, int(port)))
+    start = time.perf_counter()
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        record_error(target, "tcp", "connect")
+        forget_address(target)
+        raise
+    record_connect(target, "tcp", time.perf_counter() - start)
     log_debug("Connected")
+    return sock
+
+
+def warm_up(target, protocol, executor):
+    # Start resolving (and for TCP, connecting to) a target using the given
+    # executor.
+    host, port = target.split(":")
+    if protocol == "tcp":
+        with G_KEPT_LOCK:
+            if G_KEPT_CONNECTIONS.get(target):
+                log_debug("Already have a connection to %s", target)
+                return
+        with G_WARM_LOCK:
+            if target not in G_WARM_CONNECTIONS:
+                log_debug("Warm up TCP connection to %s", target)
+                G_WARM_CONNECTIONS[target] = executor.submit(connect_TCP, host, int(port))
+    else:
+        log_debug("Warm up address of %s", target)
+        executor.submit(resolve, host, int(port))
+
+
+def take_warm_connection(target):
+    with G_WARM_LOCK:
+        future = G_WARM_CONNECTIONS.pop(target, None)
+    if future is None:
+        return None
+
+    try:
+        sock = future.result()
+        log_debug("Using warm connection to %s", target)
+        return sock
+    except OSError as e:
+        log_error("Warm up of connection to %s failed: %s", target, e)
+        return None
+
+
+def close_warm_connection(future):
+    try:
+        future.result().close()
+    except OSError:
+        pass
 
-    for i in range(repeat+1):
-        log_debug("Sending %s", mesg.encode('utf-8'))
 
+def release_warm_connections(targets=None):
+    # Close any warm connections to the given targets (or to any target)
+    # which weren't used.
+    with G_WARM_LOCK:
+        if targets is None:
+            futures = list(G_WARM_CONNECTIONS.values())
+            G_WARM_CONNECTIONS.clear()
+        else:
+            futures = [G_WARM_CONNECTIONS.pop(target) for target in set(targets) if target in G_WARM_CONNECTIONS]
+    for future in futures:
+        future.add_done_callback(close_warm_connection)
+
+
+def keep_connections(idle_seconds):
+    # Keep TCP connections open after sending, closing them once idle for the
+    # given time (or straight away, if 0).
+    global G_KEEP_IDLE, G_REAPER
+    G_KEEP_IDLE = idle_seconds
+    if idle_seconds > 0 and G_REAPER is None:
+        G_REAPER = threading.Thread(target=reap_kept_connections, daemon=True)
+        G_REAPER.start()
+    elif idle_seconds <= 0:
+        G_REAPER = None
+        close_kept_connections()
+
+
+def take_kept_connection(target):
+    # Returns a kept connection to the target which is still open, or None.
+    while True:
+        with G_KEPT_LOCK:
+            kept = G_KEPT_CONNECTIONS.get(target)
+            if not kept:
+                return None
+            connection, idle_since = kept.pop()
+        if time.monotonic() - idle_since < G_KEEP_IDLE and connection.is_open():
+            log_debug("Reusing connection to %s", target)
+            return connection
+        connection.close()
+
+
+def keep_connection(connection):
+    with G_KEPT_LOCK:
+        kept = G_KEPT_CONNECTIONS.setdefault(connection.target, [])
+        if len(kept) < KEEP_PER_TARGET:
+            kept.append((connection, time.monotonic()))
+            return
+    connection.close()
+
+
+def close_kept_connections(max_idle=0):
+    # Close kept connections which have been idle for at least max_idle
+    # seconds.
+    now = time.monotonic()
+    closing = []
+    with G_KEPT_LOCK:
+        for target in list(G_KEPT_CONNECTIONS):
+            kept = G_KEPT_CONNECTIONS[target]
+            closing.extend(connection for connection, idle_since in kept if now - idle_since >= max_idle)
+            kept[:] = [ (connection, idle_since) for connection, idle_since in kept if now - idle_since < max_idle ]
+            if not kept:
+                del G_KEPT_CONNECTIONS[target]
+    for connection in closing:
+        log_debug("Close idle connection to %s", connection.target)
+        connection.close()
+
+
+def reap_kept_connections():
+    while G_KEEP_IDLE > 0:
+        time.sleep(G_KEEP_IDLE / 2)
+        close_kept_connections(G_KEEP_IDLE)
+
+
+def sleep_until(deadline):
+    # Sleep until the given perf_counter time.  Sleeps can overrun by a
+    # scheduler tick, so we sleep to just short of the deadline then spin.
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        if remaining > SPIN_SECONDS:
+            time.sleep(remaining - SPIN_SECONDS)
+
+
+class KIRAConnection:
+    # A socket to one KIRA target, which may be used for any number of sends.
+    # For TCP the connection is opened on creation (or taken from those warmed
+    # up for the target); for UDP we bind to the target's port, as KIRA
+    # targets reply to it.
+
+    def __init__(self, target, protocol):
+        self.target = target
+        self.protocol = protocol
+        host, port = target.split(":")
+
+        if protocol == "tcp":
+            self.address = None
+            self.sock = take_warm_connection(target)
+            if self.sock is None:
+                self.sock = connect_TCP(host, int(port))
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.sock.bind(('', int(port)))
+                self.address = resolve_target(target, "udp", host, int(port))
+            except OSError:
+                self.sock.close()
+                raise
+
+    def send(self, mesg, repeat=0, repeatDelay=0):
+        # Send the message, then repeat it the given number of times with the
+        # given delay between each start.
+        log_debug("Send %s to %s with repeat %d, delay %.3f; message %s", self.protocol.upper(), self.target, repeat, repeatDelay, mesg)
+
+        data = to_bytes(mesg)
+        deadline = time.perf_counter()
+        for i in range(repeat+1):
+            sleep_until(deadline)
+            log_debug("Sending %s", data)
+
+            start = time.perf_counter()
+            deadline = start + repeatDelay
+            try:
+                if self.address is not None:
+                    sent = self.sock.sendto(data, self.address)
+                else:
+                    sent = self.send_all(data)
+            except OSError:
+                record_error(self.target, self.protocol, "send")
+                forget_address(self.target)
+                raise
+            record_send(self.target, self.protocol, time.perf_counter() - start, sent)
+
+    def send_all(self, data):
         totalsent = 0
-        while totalsent < len(mesg):
-            sent = sock.send(mesg[totalsent:].encode('utf-8'))
+        while totalsent < len(data):
+            sent = self.sock.send(data[totalsent:])
             log_debug("Sent %d bytes", sent)
             if sent == 0:
-                log_error("Couldn't send TCP data to %s", target)
+                log_error("Couldn't send TCP data to %s", self.target)
+                raise OSError("Couldn't send TCP data to %s" % self.target)
             totalsent = totalsent + sent
+        return totalsent
+
+    def is_open(self):
+        # Whether a TCP connection is still open, discarding anything the
+        # target has sent us (e.g. acks) in the meantime.
+        # (MSG_DONTWAIT would save switching the socket to non-blocking, but
+        # doesn't exist on Windows.)
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            while True:
+                data = self.sock.recv(4096)
+                if not data:
+                    log_debug("Connection to %s closed by target", self.target)
+                    return False
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            log_debug("Connection to %s failed: %s", self.target, e)
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
+    def close(self):
+        try:
+            if self.protocol == "tcp":
+                self.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        finally:
+            self.sock.close()
+        log_debug("Closed socket")
 
-        if i < repeat:
-            time.sleep(repeatDelay)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def SendUDP(target, mesg, repeat, repeatDelay):
+    with KIRAConnection(target, "udp") as connection:
+        connection.send(mesg, repeat, repeatDelay)
+
+
+def SendTCP(target, mesg, repeat, repeatDelay):
+    if G_KEEP_IDLE <= 0:
+        with KIRAConnection(target, "tcp") as connection:
+            connection.send(mesg, repeat, repeatDelay)
+        return
 
-    sock.shutdown(socket.SHUT_WR)
-    sock.close()
-    log_debug("Closed socket")
+    connection = take_kept_connection(target) or KIRAConnection(target, "tcp")
+    try:
+        connection.send(mesg, repeat, repeatDelay)
+    except OSError:
+        connection.close()
+        raise
+    keep_connection(connection)
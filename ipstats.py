@@ -0,0 +1,155 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file collects statistics on IO to the KIRA targets (see ip.py), so that
+# in a long running process we can see which targets are slow or flaky.
+#
+# For each target and protocol we count messages, bytes and errors (by stage:
+# resolve, connect or send), and keep histograms of connect and send times
+# with fixed buckets.  The statistics can be exported as a snapshot dict (or
+# JSON) or in Prometheus text format.
+
+import json
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets, in seconds; the last bucket is +Inf.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+STAGES = ("resolve", "connect", "send")
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def snapshot(self):
+        # Buckets are cumulative, as in Prometheus.
+        buckets = []
+        total = 0
+        for bound, n in zip(BUCKETS + ("+Inf",), self.counts):
+            total += n
+            buckets.append([bound, total])
+        return { 'buckets': buckets, 'count': self.count, 'sum': round(self.sum, 6) }
+
+
+class TargetStats:
+
+    def __init__(self):
+        self.connect = Histogram()
+        self.send = Histogram()
+        self.messages = 0
+        self.bytes = 0
+        self.errors = { stage: 0 for stage in STAGES }
+
+    def snapshot(self):
+        return { 'connect': self.connect.snapshot(),
+                 'send': self.send.snapshot(),
+                 'messages': self.messages,
+                 'bytes': self.bytes,
+                 'errors': dict(self.errors) }
+
+
+G_STATS = {}
+G_STATS_LOCK = threading.Lock()
+
+
+def _stats(target, protocol):
+    # Must be called holding the lock.
+    stats = G_STATS.get((target, protocol))
+    if stats is None:
+        stats = G_STATS[(target, protocol)] = TargetStats()
+    return stats
+
+
+def record_connect(target, protocol, seconds):
+    with G_STATS_LOCK:
+        _stats(target, protocol).connect.observe(seconds)
+
+
+def record_send(target, protocol, seconds, nbytes):
+    with G_STATS_LOCK:
+        stats = _stats(target, protocol)
+        stats.send.observe(seconds)
+        stats.messages += 1
+        stats.bytes += nbytes
+
+
+def record_error(target, protocol, stage):
+    with G_STATS_LOCK:
+        _stats(target, protocol).errors[stage] += 1
+
+
+def reset():
+    with G_STATS_LOCK:
+        G_STATS.clear()
+
+
+def snapshot():
+    # Return the stats as { target: { protocol: stats } }.
+    with G_STATS_LOCK:
+        snap = {}
+        for (target, protocol), stats in sorted(G_STATS.items()):
+            snap.setdefault(target, {})[protocol] = stats.snapshot()
+        return snap
+
+
+def to_json():
+    return json.dumps(snapshot(), indent=2, sort_keys=True)
+
+
+def to_prometheus():
+    # Return the stats in the Prometheus text exposition format.
+    snap = snapshot()
+    lines = []
+
+    for name, help_text in (("connect", "Time to connect to a KIRA target"),
+                            ("send", "Time to send a message to a KIRA target")):
+        metric = "kira_%s_seconds" % name
+        lines.append("# HELP %s %s" % (metric, help_text))
+        lines.append("# TYPE %s histogram" % metric)
+        for target in snap:
+            for protocol, stats in snap[target].items():
+                labels = 'target="%s",protocol="%s"' % (target, protocol)
+                hist = stats[name]
+                if hist['count'] == 0:
+                    continue
+                for bound, n in hist['buckets']:
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (metric, labels, bound, n))
+                lines.append("%s_sum{%s} %s" % (metric, labels, hist['sum']))
+                lines.append("%s_count{%s} %d" % (metric, labels, hist['count']))
+
+    for name, help_text in (("messages", "Messages sent to a KIRA target"),
+                            ("bytes", "Bytes sent to a KIRA target")):
+        metric = "kira_sent_%s_total" % name
+        lines.append("# HELP %s %s" % (metric, help_text))
+        lines.append("# TYPE %s counter" % metric)
+        for target in snap:
+            for protocol, stats in snap[target].items():
+                lines.append('%s{target="%s",protocol="%s"} %d' % (metric, target, protocol, stats[name]))
+
+    lines.append("# HELP kira_errors_total Errors talking to a KIRA target")
+    lines.append("# TYPE kira_errors_total counter")
+    for target in snap:
+        for protocol, stats in snap[target].items():
+            for stage in STAGES:
+                lines.append('kira_errors_total{target="%s",protocol="%s",stage="%s"} %d' % (target, protocol, stage, stats['errors'][stage]))
+
+    return "\n".join(lines) + "\n"
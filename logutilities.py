@@ -11,10 +11,30 @@
 # language governing permissions and limitations under the License.
 
 # This file contains a number of utilities.
+#
+# Logging must be close to free when a level is disabled, as there are debug
+# calls throughout the modelling and command paths.  So each log function
+# first checks the level, and only then looks up the caller's details.
+# Arguments which are expensive to format (pretty printing or JSON dumps of
+# whole models or requests) should be wrapped with lazy_pformat/lazy_json,
+# which defer the formatting until a record is actually emitted.
+#
+# Setting LOG_FORMAT=json switches to structured logging: every record is a
+# single line JSON object with the level, caller and message as separate
+# fields, which CloudWatch Logs Insights can query directly.
+#
+# Full dumps of request and response payloads are expensive to serialise and
+# dominate log volume, so log_payload only dumps them for a sample of 1 in
+# LOG_PAYLOAD_SAMPLE requests (default 20; 1 logs every request, 0 none), or
+# always if debug logging is on.  Dumps are single line and truncated to
+# LOG_PAYLOAD_MAX characters (default 4096).
 
 import logging
-import inspect
+import sys
 import os
+import json
+import time
+import itertools
 
 logger = logging.getLogger()
 if 'LOG_LOCAL' in os.environ:
@@ -26,20 +46,119 @@ if 'LOG_LEVEL' in os.environ:
 		log_level = logging.DEBUG
 logger.setLevel(log_level)
 
+log_json = (os.environ.get('LOG_FORMAT') == "json")
+
+LOG_PAYLOAD_SAMPLE = int(os.environ.get('LOG_PAYLOAD_SAMPLE', 20))
+LOG_PAYLOAD_MAX = int(os.environ.get('LOG_PAYLOAD_MAX', 4096))
+payload_counter = itertools.count()
+
+class JSONFormatter(logging.Formatter):
+	# Format records as single line JSON objects.
+	def format(self, record):
+		entry = {
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".%03dZ" % record.msecs,
+			"level": record.levelname,
+			"func": getattr(record, 'caller_func', record.funcName),
+			"file": getattr(record, 'caller_file', record.filename),
+			"line": getattr(record, 'caller_line', record.lineno),
+			"msg": record.getMessage(),
+		}
+		if hasattr(record, 'payload'):
+			entry['payload'] = record.payload
+		if record.exc_info:
+			entry['exc'] = self.formatException(record.exc_info)
+		return json.dumps(entry)
+
 if 'LOG_LOCAL' in os.environ:
 	fh.setLevel(log_level)
 	formatter = logging.Formatter('%(asctime)s %(levelname)5s %(message)s', "%Y-%m-%d %H:%M:%S")
 	fh.setFormatter(formatter)
 	logger.addHandler(fh)
 
+if log_json:
+	# Replace the format of any handlers already installed (e.g. by the lambda
+	# runtime), or log to stderr if there are none.
+	if not logger.handlers:
+		logger.addHandler(logging.StreamHandler())
+	for handler in logger.handlers:
+		handler.setFormatter(JSONFormatter())
+
+# pprint is slow to import, so only import it if we ever pretty print.
+pp = None
+
+def pformat(obj):
+    global pp
+    if pp is None:
+        import pprint
+        pp = pprint.PrettyPrinter(indent=2, width = 200)
+    return pp.pformat(obj)
+
+class LazyFormat:
+    # Defers calling fn(*args, **kwargs) until converted to a string.
+    __slots__ = ('fn', 'args', 'kwargs')
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return self.fn(*self.args, **self.kwargs)
+
+def lazy_pformat(obj):
+    return LazyFormat(pformat, obj)
+
+def lazy_json(obj, **kwargs):
+    return LazyFormat(json.dumps, obj, **kwargs)
+
+def caller_extra(func):
+    return { 'caller_func': func.co_name, 'caller_file': os.path.basename(func.co_filename), 'caller_line': func.co_firstlineno }
+
 def log_info(msg, *arg):
-    func = inspect.currentframe().f_back.f_code
-    logger.info("%27s %15s %3s " + msg, func.co_name, func.co_filename.split('\\')[-1], func.co_firstlineno, *arg)
+    if logger.isEnabledFor(logging.INFO):
+        func = sys._getframe(1).f_code
+        if log_json:
+            logger.info(msg, *arg, extra=caller_extra(func))
+        else:
+            logger.info("%27s %15s %3s " + msg, func.co_name, func.co_filename.split('\\')[-1], func.co_firstlineno, *arg)
 
 def log_debug(msg, *arg):
-    func = inspect.currentframe().f_back.f_code
-    logger.debug("%27s %15s %3s " + msg, func.co_name, func.co_filename.split('\\')[-1], func.co_firstlineno, *arg)
+    if logger.isEnabledFor(logging.DEBUG):
+        func = sys._getframe(1).f_code
+        if log_json:
+            logger.debug(msg, *arg, extra=caller_extra(func))
+        else:
+            logger.debug("%27s %15s %3s " + msg, func.co_name, func.co_filename.split('\\')[-1], func.co_firstlineno, *arg)
 
 def log_error(msg, *arg):
-    func = inspect.currentframe().f_back.f_code
-    logger.error("%27s %15s %3s " + msg, func.co_name, func.co_filename.split('\\')[-1], func.co_firstlineno, *arg)
+    if logger.isEnabledFor(logging.ERROR):
+        func = sys._getframe(1).f_code
+        if log_json:
+            logger.error(msg, *arg, extra=caller_extra(func))
+        else:
+            logger.error("%27s %15s %3s " + msg, func.co_name, func.co_filename.split('\\')[-1], func.co_firstlineno, *arg)
+
+def sample_payloads():
+    # Decide whether to dump the payloads of this request.
+    if logger.isEnabledFor(logging.DEBUG):
+        return True
+    if LOG_PAYLOAD_SAMPLE <= 0 or not logger.isEnabledFor(logging.INFO):
+        return False
+    return next(payload_counter) % LOG_PAYLOAD_SAMPLE == 0
+
+def log_payload(label, payload, sampled):
+    # Dump a request or response payload, if this request was sampled.
+    if not sampled:
+        return
+
+    dump = json.dumps(payload, separators=(',', ':'), default=str)
+    if len(dump) > LOG_PAYLOAD_MAX:
+        dump = dump[:LOG_PAYLOAD_MAX] + "...<%d chars truncated>" % (len(dump) - LOG_PAYLOAD_MAX)
+
+    func = sys._getframe(1).f_code
+    if log_json:
+        extra = caller_extra(func)
+        extra['payload'] = dump
+        logger.info("%s payload", label, extra=extra)
+    else:
+        logger.info("%27s %15s %3s %s payload: %s", func.co_name, func.co_filename.split('\\')[-1], func.co_firstlineno, label, dump)
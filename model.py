@@ -15,12 +15,14 @@
 
 import pprint
 
-from logutilities import log_info, log_debug
+from logutilities import log_info, log_debug, log_error, lazy_pformat
 from alexaSchema import CAPABILITY_DISCOVERY_RESPONSES, CAPABILITY_DIRECTIVES_TO_COMMANDS
 from utilities import verify_devices, find_target, get_connected_device, get_repeats, find_user_device_in_DB, find_device_from_friendly_name
 from endpoint import construct_endpoint_chain
 from power import construct_power_map
 from command_sequences import construct_command_sequence
+from response import discovery_template
+from validation import check_discovery_template
 
 pp = pprint.PrettyPrinter(indent=2, width = 200)
 
@@ -128,11 +130,16 @@ def model_user_and_devices(user_details, device_database):
 	#
 	# Given the above, we model and return the following.
 	#
-	# discovery_response
+	# discovery_json
 	#
-	# This is a dict corresponding to the JSON structure to return to Alexa in
-	# response to Discovery commands, and includes the full set of endpoints 
-	# and their supported capabilities.
+	# The complete response to Discovery commands, including the full set of
+	# endpoints and their supported capabilities, serialized to JSON bytes
+	# with a placeholder for the messageId (see response.py), so that handling
+	# Discovery is just a splice rather than building and serializing a
+	# response with an entry for every endpoint.  It is validated against the
+	# schema here, so needn't be at Discovery time; if it is invalid we
+	# return no model, failing the compile.  (Models compiled before
+	# this instead hold the list of endpoints as discovery_response.)
 	#
 	# command_sequence
 	#
@@ -223,10 +230,15 @@ def model_user_and_devices(user_details, device_database):
 			# Add the constructed endpoint info to what we return
 			discovery_response.append(endpoint)
 
-	log_debug("Device power map = %s", pp.pformat(device_power_map))
+	log_debug("Device power map = %s", lazy_pformat(device_power_map))
+
+	discovery_json = discovery_template(discovery_response)
+	if not check_discovery_template(discovery_json):
+		log_error("Discovery response is invalid - can't model")
+		return {}
 
 	model = {
-				'discovery_response': discovery_response,
+				'discovery_json': discovery_json,
 				'command_sequences': command_sequences,
 				'device_power_map': device_power_map
 			}
@@ -0,0 +1,120 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements opt-in profiling of selected functions, so we can find
+# hot spots (e.g. in building and pickling models for large users) without
+# deploying an instrumented build.
+#
+# Functions are wrapped with the profiled decorator.  Profiling is controlled
+# by env vars read at import time:
+#
+# - PROFILE_MODE: "cpu" (cProfile), "memory" (tracemalloc) or "cpu,memory";
+#   the profilers' own names "cprofile" and "tracemalloc" may be used instead.
+#   If unset, profiled returns functions unchanged, so there is no overhead.
+# - PROFILE_SAMPLE: the fraction of calls to profile (default 1).
+# - PROFILE_DIR: where to write the results (default under /tmp).
+#
+# Each profiled call writes <name>-<time>-<pid>-<n>.prof (cProfile stats, for
+# pstats or snakeviz) and/or <name>-<time>-<pid>-<n>.mem.txt (the top
+# allocation sites).  Only one call is profiled at a time; nested or
+# concurrent calls run unprofiled.
+
+import os
+import time
+import random
+import itertools
+import functools
+import threading
+
+from logutilities import log_info, log_error
+
+DEFAULT_PROFILE_DIR = "/tmp/keeneiralexa-profiles"
+MEMORY_TOP_STATS = 50
+
+MODE_ALIASES = { "cprofile": "cpu", "tracemalloc": "memory" }
+
+PROFILE_MODES = set(MODE_ALIASES.get(m.strip(), m.strip()) for m in os.environ.get('PROFILE_MODE', "").split(",") if m.strip())
+PROFILE_SAMPLE = float(os.environ.get('PROFILE_SAMPLE', 1))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', DEFAULT_PROFILE_DIR)
+
+G_PROFILE_LOCK = threading.Lock()
+G_PROFILE_COUNTER = itertools.count()
+
+
+def profiled(name=None):
+    # Decorator to profile calls of a function, if profiling is enabled.
+    def decorator(fn):
+        if not PROFILE_MODES:
+            return fn
+
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if random.random() >= PROFILE_SAMPLE or not G_PROFILE_LOCK.acquire(blocking=False):
+                return fn(*args, **kwargs)
+            try:
+                return run_profiled(label, fn, args, kwargs)
+            finally:
+                G_PROFILE_LOCK.release()
+
+        return wrapper
+
+    return decorator
+
+
+def run_profiled(label, fn, args, kwargs):
+    profiler = None
+    if "cpu" in PROFILE_MODES:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    tracing = False
+    if "memory" in PROFILE_MODES:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            tracing = True
+
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    finally:
+        snapshot = None
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        write_results(label, profiler, snapshot, peak if tracing else 0)
+
+
+def write_results(label, profiler, snapshot, peak):
+    base = os.path.join(PROFILE_DIR, "%s-%s-%d-%d" % (label, time.strftime("%Y%m%d%H%M%S"), os.getpid(), next(G_PROFILE_COUNTER)))
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if profiler is not None:
+            profiler.dump_stats(base + ".prof")
+        if snapshot is not None:
+            with open(base + ".mem.txt", "w") as f:
+                f.write("Peak traced memory: %d bytes\n" % peak)
+                for stat in snapshot.statistics('lineno')[:MEMORY_TOP_STATS]:
+                    f.write("%s\n" % stat)
+    except OSError as e:
+        log_error("Can't write profile for %s under %s: %s", label, PROFILE_DIR, e)
+        return
+
+    log_info("Wrote profile of %s to %s.*", label, base)
@@ -0,0 +1,96 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements the batch job which recompiles user models after
+# device details change.
+#
+# Every user's model embeds the IR codes and capabilities of their devices, so
+# when someone uploads new details for e.g. Panasonic/DMP-BDT110EB, the models
+# of every user with that device are stale.  Rather than wait for each of them
+# to rediscover, we look the affected users up in the device index (see
+# userState.py) and recompile just their models, in parallel.
+#
+# The index only knows about users uploaded since it was introduced, so it
+# can also be rebuilt from scratch from every user's details.
+
+import concurrent.futures
+
+from storage import WriteConflict, CREATE_ONLY
+from logutilities import log_info, log_debug, log_error
+from userState import User, get_device_users, get_storage, list_users, user_device_set, read_state_stamped, write_state, BUCKET_USERDB, KEY_DEVICE_INDEX, STATUS_WRITE_RETRIES
+
+DEFAULT_WORKERS = 8
+
+
+def recompile_user(user_id):
+	try:
+		return User(user_id).compile_model()
+	except Exception as e:
+		log_error("Exception %s recompiling model for user %s", e, user_id)
+		return False
+
+
+def recompile_users(user_ids, workers=DEFAULT_WORKERS):
+	# Recompile the given users' models using a pool of workers.  Returns the
+	# list of users we failed to recompile.
+	failed = []
+	if not user_ids:
+		return failed
+
+	log_info("Recompile models for %d users with %d workers", len(user_ids), workers)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+		futures = { pool.submit(recompile_user, user_id): user_id for user_id in user_ids }
+		for future in concurrent.futures.as_completed(futures):
+			user_id = futures[future]
+			if future.result():
+				log_debug("Recompiled model for user %s", user_id)
+			else:
+				failed.append(user_id)
+
+	return sorted(failed)
+
+
+def recompile_for_devices(devices, workers=DEFAULT_WORKERS):
+	# Recompile the models of all users with any of the given
+	# (manufacturer, device).  Returns the users affected and those we failed
+	# to recompile.
+	user_ids = sorted(get_device_users(devices))
+	log_info("%d users affected by changes to %d devices", len(user_ids), len(devices))
+	return user_ids, recompile_users(user_ids, workers)
+
+
+def rebuild_device_index(workers=DEFAULT_WORKERS):
+	# Rebuild the device index from the details of every user, reading them in
+	# parallel.  Returns the users indexed, or None if we couldn't write the
+	# index.
+	storage = get_storage()
+
+	for attempt in range(STATUS_WRITE_RETRIES):
+		stamp = read_state_stamped(storage, BUCKET_USERDB, KEY_DEVICE_INDEX)[1]
+		user_ids = list_users(storage)
+		log_info("Rebuild device index from %d users with %d workers", len(user_ids), workers)
+
+		index = {}
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+			for user_id, details in zip(user_ids, pool.map(lambda user_id: User(user_id, storage).get_details(), user_ids)):
+				for device in user_device_set(details):
+					index.setdefault(device, set()).add(user_id)
+
+		try:
+			write_state(storage, BUCKET_USERDB, KEY_DEVICE_INDEX, index, stamp or CREATE_ONLY)
+			return user_ids
+		except WriteConflict:
+			log_info("Device index changed under us - rebuild again")
+
+	log_error("Gave up rebuilding device index after %d attempts", STATUS_WRITE_RETRIES)
+	return None
@@ -10,14 +10,37 @@
 # CONDITIONS OF ANY KIND, express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
-import pprint
+# This file builds the responses to directives.
+#
+# Responses are built from templates taken from alexaSchema.py at import time
+# and filled in per request as new dicts, so nothing shared is modified and
+# requests can be handled concurrently in one process.
+
+import json
 
 from logutilities import log_info, log_debug
 from AWSutilities import unpack_request
-from alexaSchema import DIRECTIVE_RESPONSE, CAPABILITY_DIRECTIVE_PROPERTIES_RESPONSES
+from alexaSchema import DISCOVERY_RESPONSE, DIRECTIVE_RESPONSE, CAPABILITY_DIRECTIVE_PROPERTIES_RESPONSES
 from utilities import get_uuid, get_utc_timestamp
 
-pp = pprint.PrettyPrinter(indent=2, width = 200)
+# Templates, as immutable (key, value) pairs.  Interfaces with no properties
+# have no template.
+DIRECTIVE_HEADER = tuple(DIRECTIVE_RESPONSE['event']['header'].items())
+DISCOVERY_HEADER = tuple(DISCOVERY_RESPONSE['event']['header'].items())
+PROPERTY_TEMPLATES = { interface: tuple(prop.items()) for interface, prop in CAPABILITY_DIRECTIVE_PROPERTIES_RESPONSES.items() if prop }
+
+def property_value(interface, directive, payload):
+    # Depending on the interface/directive, need to construct an appropriate
+    # value field; None means use the template's.
+    if interface == 'PowerController':
+        if directive == 'TurnOn':
+            return "ON"
+        else:
+            return "OFF"
+    elif interface == 'ChannelController':
+        if directive == 'ChangeChannel':
+            return payload['channel']
+    return None
 
 def construct_response(request):
 	# Construct the appropriate response to the received request.
@@ -26,33 +49,50 @@ def construct_response(request):
     # the API is all over the place here.
     interface, directive, payload, endpoint_id = unpack_request(request)
 
-    response = DIRECTIVE_RESPONSE
+    properties = []
+    if interface in PROPERTY_TEMPLATES:
+        prop = dict(PROPERTY_TEMPLATES[interface])
+        value = property_value(interface, directive, payload)
+        if value is not None:
+            prop['value'] = value
+        prop['timeOfSample'] = get_utc_timestamp()
+        properties.append(prop)
 
-    prop = CAPABILITY_DIRECTIVE_PROPERTIES_RESPONSES[interface]
-    prop['timeOfSample'] = get_utc_timestamp()
+    header = dict(DIRECTIVE_HEADER)
+    header['messageId'] = get_uuid()
+    header['correlationToken'] = request['directive']['header']['correlationToken']
 
-    # Depending on the interface/directive, need to construct an appropriate
-    # value field. 
-    if interface == 'PowerController':
-        if directive == 'TurnOn':
-            prop['value'] = "ON"
-        else:
-            prop['value'] = "OFF"
-    elif interface == 'ChannelController':
-        if directive == 'ChangeChannel':
-            prop['value'] = payload['channel']
-    elif interface == 'StepSpeaker':
-        prop = {}
-    elif interface == 'PlaybackController':
-        prop = {}
-
-    if prop == {}:
-        response['context']['properties'] = [ ]
-    else:
-        response['context']['properties'] = [ prop ]
-    
-    response['event']['header']['messageId'] = get_uuid()
-    response['event']['header']['correlationToken'] = request['directive']['header']['correlationToken']
-    response['event']['endpoint'] = request['directive']['endpoint']
-
-    return response
+    return { 'context': { 'properties': properties },
+             'event': { 'header': header,
+                        'endpoint': request['directive']['endpoint'],
+                        'payload': {} } }
+
+def construct_discovery_response(endpoints):
+    # Construct the response to a discovery request, given the endpoints
+    # from the user's model.
+    header = dict(DISCOVERY_HEADER)
+    header['messageId'] = get_uuid()
+
+    return { 'event': { 'header': header,
+                        'payload': { 'endpoints': endpoints } } }
+
+# Placeholder for the messageId in serialized discovery responses; it is
+# serialized before the endpoints, so is always the first occurrence.
+MESSAGE_ID_PLACEHOLDER = "@messageId@"
+
+def discovery_template(endpoints):
+    # Serialize the whole discovery response up front, when the model is
+    # compiled, so that handling Discover need only splice in the messageId.
+    header = dict(DISCOVERY_HEADER)
+    header['messageId'] = MESSAGE_ID_PLACEHOLDER
+    response = { 'event': { 'header': header,
+                            'payload': { 'endpoints': endpoints } } }
+    return serialize_response(response).encode('utf-8')
+
+def discovery_response_json(template):
+    # Returns the serialized discovery response for a template.
+    return template.replace(MESSAGE_ID_PLACEHOLDER.encode('utf-8'), get_uuid().encode('utf-8'), 1)
+
+def serialize_response(response):
+    # Compact JSON for responses which go back over the wire.
+    return json.dumps(response, separators=(',', ':'))
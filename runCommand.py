@@ -11,13 +11,25 @@
 # language governing permissions and limitations under the License.
 
 
-import time
-import pprint
+# Commands are not sent as soon as they are worked out.  Instead they are
+# planned into a Schedule of IR sends and pauses, which is then executed, so
+# that the commands for several directives (see AWSlambda.handle_batch) can be
+# combined into a single schedule.  Adjacent pauses are merged: the longest
+# of them covers all the others.  Sends which turn a device on or off are
+# tagged as such, so that executing the schedule still times each device's
+# power commands as one section (see timing.py).
+#
+# Working out a power directive's new device states (plan_power_states) is
+# separate from planning the commands to get there from the current states
+# (plan_power_changes), so that a batch can turn each device on or off at
+# most once, however many directives it has.
 
-from logutilities import log_info, log_debug
-from ip import SendUDP, SendTCP
+import contextlib
 
-pp = pprint.PrettyPrinter(indent=2, width = 200)
+from logutilities import log_info, log_debug, log_error, lazy_pformat
+from ip import SendUDP, SendTCP
+from IRcodec import send_ready
+from timing import span, timed_sleep
 
 DELAY = 0.02
 DELAY_AFTER_POWER_ON = 4
@@ -25,14 +37,109 @@ DELAY_AFTER_POWER_ON = 4
 protocol_map = { "udp" : "SendUDP", "tcp" : "SendTCP" }
 
 
-def set_power_states(directive, endpoint, device_state, device_power_map, pause, payload):
+class Schedule:
+    # An ordered list of steps, each either
+    #   ("send", target, protocol, KIRA string, repeats, device, power)
+    #   ("pause", seconds, name)
+    # where power is TurnOn or TurnOff for sends which change a device's power
+    # state, and None otherwise.
+
+    def __init__(self):
+        self.steps = []
+
+    def send(self, target, protocol, KIRA_string, repeats, device=None, power=None):
+        self.steps.append(("send", target, protocol, KIRA_string, repeats, device, power))
+
+    def pause(self, seconds, name="sleep"):
+        if self.steps and self.steps[-1][0] == "pause":
+            previous = self.steps[-1]
+            if seconds > previous[1]:
+                self.steps[-1] = ("pause", seconds, name)
+            log_debug("Merge pause of %.3fs into %.3fs", seconds, self.steps[-1][1])
+        else:
+            self.steps.append(("pause", seconds, name))
+
+    def extend(self, other):
+        # Append another schedule's steps, merging pauses where they meet.
+        for step in other.steps:
+            if step[0] == "pause":
+                self.pause(step[1], step[2])
+            else:
+                self.steps.append(step)
+
+    def trim(self):
+        # Drop any pauses at the end, when nothing follows them.
+        while self.steps and self.steps[-1][0] == "pause":
+            log_debug("Drop trailing pause of %.3fs", self.steps[-1][1])
+            self.steps.pop()
+
+    def execute(self):
+        log_debug("Execute schedule of %d steps", len(self.steps))
+        steps, self.steps = self.steps, []
+
+        # A power section runs from its first send to its last, including any
+        # pauses between them but not after.
+        sections = [ (step[5], step[6]) if step[0] == "send" and step[6] else None for step in steps ]
+        next_section = [ None ] * len(steps)
+        following = None
+        for i in reversed(range(len(steps))):
+            next_section[i] = following
+            if steps[i][0] == "send":
+                following = sections[i]
+
+        with contextlib.ExitStack() as stack:
+            section = None
+            for i, step in enumerate(steps):
+                if step[0] == "send":
+                    if sections[i] != section:
+                        stack.close()
+                        section = sections[i]
+                        if section is not None:
+                            stack.enter_context(span(section[1], device=section[0]))
+                    send(*step[1:6])
+                else:
+                    if section is not None and next_section[i] != section:
+                        stack.close()
+                        section = None
+                    timed_sleep(step[1], step[2])
+
+
+def send(target, protocol, KIRA_string, repeats, device=None):
+    if device is None:
+        span_args = { 'target': target, 'protocol': protocol }
+    else:
+        span_args = { 'target': target, 'protocol': protocol, 'device': device }
+    with span("send", "network", **span_args):
+        globals()[protocol_map[protocol]](target, send_ready(KIRA_string), repeats, DELAY)
+
+
+def set_power_states(directive, endpoint, device_state, device_power_map, pause, payload, schedule=None):
     # Set the power state correctly for all devices, taking into account
-    # current state.
-    log_debug("Set power state for all devices given directive %s for endpoint %s", directive, endpoint)
-    log_info("Current device states: %s", pp.pformat(device_state))
+    # current state.  If given a schedule, the commands are added to it;
+    # otherwise they are sent before returning.  Returns the new state as a
+    # new dict: the caller's may be cached across directives (see
+    # gateway.py), so must be left alone in case sending then fails.
+    execute = schedule is None
+    if execute:
+        schedule = Schedule()
 
-    status_changed = False
-    send_power_on = False
+    new_state = plan_power_states(directive, endpoint, device_state, device_power_map)
+    status_changed = plan_power_changes(device_state, new_state, device_power_map, pause, payload, schedule)
+
+    if execute:
+        schedule.execute()
+
+    log_info("Did status change? %s", status_changed)
+
+    return new_state, status_changed
+
+def plan_power_states(directive, endpoint, device_state, device_power_map):
+    # Work out which devices should be on after a power directive.  Returns
+    # the new state as a new dict.
+    device_state = dict(device_state)
+
+    log_debug("Set power state for all devices given directive %s for endpoint %s", directive, endpoint)
+    log_debug("Current device states: %s", lazy_pformat(device_state))
 
     for device in device_power_map:
         # The only circumstances in which a device is desired to be on is if
@@ -50,41 +157,54 @@ def set_power_states(directive, endpoint, device_state, device_power_map, pause,
             desired_on = (endpoint in this_device_map['endpoints']) and (directive == "TurnOn")
             currently_on = device_state[device]
 
-            log_info("Device %s: in correct room, desired on %s; currently on %s", device, pp.pformat(desired_on), pp.pformat(currently_on))
+            log_debug("Device %s: in correct room, desired on %s; currently on %s", device, desired_on, currently_on)
 
-            send_command = None
+            device_state[device] = desired_on
+            log_debug("State of device %s now %s", device, desired_on)
 
-            if desired_on and not currently_on:
-                log_debug("Currently off; should be on")
-                send_command = 'TurnOn'
-                send_power_on = True
+    return device_state
 
-            if not desired_on and currently_on:
-                log_debug("Currently on; should be off")
-                send_command = 'TurnOff'
+def plan_power_changes(old_state, new_state, device_power_map, pause, payload, schedule):
+    # Add to the schedule the commands to turn on or off each device whose
+    # state differs between the two, then if any were turned on, a pause for
+    # them to come up.  Returns whether any state changed.
+    status_changed = False
+    send_power_on = False
 
-            if send_command != None:
-                status_changed = True
-                for command_tuple in this_device_map['commands'][send_command]:
-                    for verb in command_tuple:
-                        log_info("Run verb %s on device %s", verb, device)
-                        run_command(verb, command_tuple[verb], pause, payload)
+    for device in device_power_map:
+        if new_state[device] == old_state[device]:
+            continue
 
-            device_state[device] = desired_on
-            log_debug("State of device %s now %s", device, desired_on)
+        if new_state[device]:
+            log_debug("Device %s currently off; should be on", device)
+            send_command = 'TurnOn'
+            send_power_on = True
+        else:
+            log_debug("Device %s currently on; should be off", device)
+            send_command = 'TurnOff'
+
+        status_changed = True
+        for command_tuple in device_power_map[device]['commands'][send_command]:
+            for verb in command_tuple:
+                log_info("Run verb %s on device %s", verb, device)
+                plan_command(verb, command_tuple[verb], pause, payload, schedule, device, send_command)
 
     # If we've turned anything on, wait for them to come up as e.g. we may be
     # about to set their input channel
     if send_power_on:
         log_info("Turned at least one device on - pause")
-        time.sleep(DELAY_AFTER_POWER_ON)
-
-    log_info("Did status change? %s", status_changed)
+        schedule.pause(DELAY_AFTER_POWER_ON, "power_on_wait")
 
-    return device_state, status_changed
+    return status_changed
 
 def run_command(verb, command_tuple, pause, payload):
-	# This function executes a specific command, one of:
+    # Execute a single command straight away.
+    schedule = Schedule()
+    plan_command(verb, command_tuple, pause, payload, schedule)
+    schedule.execute()
+
+def plan_command(verb, command_tuple, pause, payload, schedule, device=None, power=None):
+	# This function adds to a schedule a specific command, one of:
 	#
 	#   SingleIRCommand     - send a single KIRA command; value is struct with 
 	#                         IR sequence as value
@@ -105,8 +225,8 @@ def run_command(verb, command_tuple, pause, payload):
         if 'log' in command_tuple['single']:
             log_info(command_tuple['single']['log'])
 
-        globals()[protocol_map[protocol]](target, KIRA_string, repeats, DELAY)
-        time.sleep(pause)
+        schedule.send(target, protocol, KIRA_string, repeats, device, power)
+        schedule.pause(pause)
         
     elif verb == 'StepIRCommands':
         # In this case we need to extract the value N in the payload
@@ -130,8 +250,8 @@ def run_command(verb, command_tuple, pause, payload):
             log_info("%s x %d", command_tuple[index]['log'], abs(steps))
 
         for n in range(0, abs(steps)):
-            globals()[protocol_map[protocol]](target, KIRA_string, repeats, DELAY)
-            time.sleep(pause)
+            schedule.send(target, protocol, KIRA_string, repeats, device, power)
+            schedule.pause(pause)
 
     elif verb == 'DigitsIRCommands':
         # In this case we need to extract a decimal number in the 
@@ -164,11 +284,11 @@ def run_command(verb, command_tuple, pause, payload):
                 if 'log' in command_tuple[digit]:
                     log_info(command_tuple[digit]['log'])
 
-                globals()[protocol_map[protocol]](target, KIRA_string, repeats, DELAY)
-                time.sleep(pause)
+                schedule.send(target, protocol, KIRA_string, repeats, device, power)
+                schedule.pause(pause)
 
     elif verb == 'Pause':
         # Simply pause the appropriate period of time.
-        time.sleep(command_tuple)
+        schedule.pause(command_tuple, "pause")
 
     return
\ No newline at end of file
@@ -0,0 +1,166 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements scripts of test IR commands for the CLI (see
+# KeeneIRAlexa.py send -f), so that a new install can be tested in one run.
+#
+# A script has one command per line, as comma separated fields
+#
+#   manufacturer, device, command [, repeats [, delay [, target]]]
+#
+# where delay is the time in seconds from starting to send this command to
+# starting the next (default 0), and target defaults to the one given on the
+# command line.  Blank lines and lines starting with # are ignored.  For
+# example
+#
+#   # Turn the TV on, wait for it, then switch input
+#   Panasonic, TX-L32X10AB, PowerOn, 0, 4
+#   Panasonic, TX-L32X10AB, HDMI1
+#
+# We read each device needed from storage once, up front (in parallel), and
+# check every command exists before sending anything.  We then hold one
+# connection open per target and protocol for the whole script, and start
+# each command against a perf_counter deadline so delays don't drift.
+
+import csv
+import time
+import concurrent.futures
+
+from logutilities import log_info, log_debug, log_error
+from userState import Device
+from ip import KIRAConnection, sleep_until
+from IRcodec import send_ready
+
+REPEAT_DELAY = 0.02
+DEFAULT_WORKERS = 8
+
+
+class ScriptError(Exception):
+	# The script is malformed or refers to devices or commands we don't have.
+	pass
+
+
+class Step:
+
+	def __init__(self, line, manufacturer, device, command, repeats, delay, target):
+		self.line = line
+		self.manufacturer = manufacturer
+		self.device = device
+		self.command = command
+		self.repeats = repeats
+		self.delay = delay
+		self.target = target
+		self.protocol = None
+		self.KIRA = None
+
+	def name(self):
+		return "%s to %s/%s" % (self.command, self.manufacturer, self.device)
+
+
+def parse_script(lines, default_target=None):
+	# Returns the list of Steps, raising ScriptError if any line is invalid.
+	steps = []
+	for number, fields in enumerate(csv.reader(lines, skipinitialspace=True), 1):
+		fields = [ f.strip() for f in fields ]
+		if not fields or not fields[0] or fields[0].startswith("#"):
+			continue
+		if len(fields) < 3 or len(fields) > 6:
+			raise ScriptError("Line %d: expected manufacturer, device, command [, repeats [, delay [, target]]]" % number)
+
+		try:
+			repeats = int(fields[3]) if len(fields) > 3 and fields[3] else 0
+			delay = float(fields[4]) if len(fields) > 4 and fields[4] else 0.0
+		except ValueError:
+			raise ScriptError("Line %d: repeats and delay must be numbers" % number)
+
+		target = fields[5] if len(fields) > 5 and fields[5] else default_target
+		host, sep, port = target.rpartition(":") if target else ("", "", "")
+		if not host or not port.isdigit() or int(port) > 65535:
+			raise ScriptError("Line %d: no target of the form <IP address>:<port>" % number)
+
+		steps.append(Step(number, fields[0], fields[1], fields[2], repeats, delay, target))
+
+	return steps
+
+
+def read_devices(steps, workers=DEFAULT_WORKERS):
+	# Read each device used by the script once.  Returns
+	# { (manufacturer, device): details }.
+	devices = sorted(set((s.manufacturer, s.device) for s in steps))
+	log_info("Read %d devices for script", len(devices))
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(devices)))) as pool:
+		details = pool.map(lambda d: Device(*d).get(), devices)
+		return dict(zip(devices, details))
+
+
+def resolve_steps(steps, devices):
+	# Fill in each step's protocol and IR code, raising ScriptError listing any
+	# devices or commands we don't have.
+	errors = []
+	for step in steps:
+		details = devices.get((step.manufacturer, step.device))
+		if not details:
+			errors.append("Line %d: could not find device %s/%s" % (step.line, step.manufacturer, step.device))
+		elif step.command not in details['IRcodes']:
+			errors.append("Line %d: could not find command %s for device %s/%s" % (step.line, step.command, step.manufacturer, step.device))
+		else:
+			step.protocol = details['protocol']
+			step.KIRA = send_ready(details['IRcodes'][step.command])
+	if errors:
+		raise ScriptError("\n".join(errors))
+
+
+def run_steps(steps, report=print):
+	# Send each step, reusing one connection per target and protocol.  Returns
+	# the list of (step, error) for steps we failed to send.
+	connections = {}
+	failed = []
+	start = time.perf_counter()
+	deadline = start
+
+	try:
+		for step in steps:
+			sleep_until(deadline)
+			step_start = time.perf_counter()
+			deadline = step_start + step.delay
+
+			key = (step.target, step.protocol)
+			try:
+				connection = connections.get(key)
+				if connection is None:
+					connection = connections[key] = KIRAConnection(step.target, step.protocol)
+				connection.send(step.KIRA, step.repeats, REPEAT_DELAY)
+				report("%8.3fs  Sent %s at %s" % (step_start - start, step.name(), step.target))
+			except OSError as e:
+				log_error("Failed to send %s at %s: %s", step.name(), step.target, e)
+				report("%8.3fs  Error: failed to send %s at %s: %s" % (step_start - start, step.name(), step.target, e))
+				failed.append((step, e))
+				# Reconnect for the next command to this target.
+				connection = connections.pop(key, None)
+				if connection is not None:
+					connection.close()
+	finally:
+		for connection in connections.values():
+			connection.close()
+
+	log_info("Ran script of %d commands in %.3fs with %d errors", len(steps), time.perf_counter() - start, len(failed))
+	return failed
+
+
+def run_script(path, default_target=None, workers=DEFAULT_WORKERS, report=print):
+	# Run the script in the given file.  Raises ScriptError (without sending
+	# anything) if it is invalid; otherwise returns the steps and those we
+	# failed to send.
+	with open(path, newline='') as f:
+		steps = parse_script(f, default_target)
+	resolve_steps(steps, read_devices(steps, workers))
+	return steps, run_steps(steps, report)
@@ -0,0 +1,322 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file provides pluggable storage backends for user and device state.
+# Like AWSS3storage, each backend is a simple CRUD store of blobs with no
+# knowledge of the schema:
+#
+#   write_object(bucket, key, blob, version, if_stamp=None) -> stamp
+#   read_object(bucket, key) -> blob, version
+#   read_object_if_changed(bucket, key, stamp) -> blob, version, stamp
+#   list_keys(bucket) -> sorted list of keys
+#
+# where version is the schema version the blob was written with.  Reading an
+# object which doesn't exist returns (b'', ""), which callers treat as empty
+# (e.g. a user being uploaded for the first time), so it isn't logged as an
+# error; failing to read one which does is.  Failing to write raises (OSError
+# for files), so a lost write is never mistaken for one which succeeded.
+#
+# The stamp is an opaque token identifying one particular write of an object
+# (the ETag for S3).  read_object_if_changed returns a blob of None if the
+# object still has the given stamp, which lets a cache revalidate what it
+# holds without transferring the object again (the version returned is then
+# empty; the caller already has it).  Passing if_stamp to write_object makes
+# the write conditional on the object still having that stamp (compare and
+# swap); if it doesn't, WriteConflict is raised and nothing is written.
+# Passing CREATE_ONLY instead makes the write conditional on the object not
+# existing yet, so that two writers creating it can't both succeed.  S3 does
+# this natively; the memory and file backends do it under a lock.
+#
+# We support three backends.
+#
+# - s3      Objects are held in S3 via AWSS3storage.  This is what the lambda
+#           uses.
+# - memory  Objects are held in a process-wide dict.  Used for offline testing
+#           (USE_STATIC_FILES) and for benchmarking the handler without any
+#           storage cost.
+# - file    Objects are held as files under a local directory, one
+#           sub-directory per bucket.  Writes go to a temporary file which is
+#           then atomically renamed into place, so readers never see a
+#           partial object; reads are via mmap.  Used when running as an
+#           on-prem gateway with no S3 round-trips.
+#
+# The backend is selected by the STORAGE_BACKEND env var; if that is not set
+# we use memory if USE_STATIC_FILES is set, otherwise S3.  The file backend
+# stores under STORAGE_DIR (default ./kirastate).
+#
+# S3 reads can additionally go through a two-tier cache (in-memory, then disk -
+# see diskCache.py) enabled by DISK_CACHE_DIR, and enabled by default when
+# running as a lambda, where /tmp often survives a recycled process.
+
+import os
+import abc
+import mmap
+import tempfile
+import threading
+import urllib.parse
+
+from logutilities import log_info, log_debug, log_error
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+DEFAULT_STORAGE_DIR = "kirastate"
+
+# The if_stamp for a write which must create the object
+CREATE_ONLY = "*"
+
+
+class WriteConflict(Exception):
+	# A conditional write failed because the object has been written by
+	# someone else since the caller read it.
+	pass
+
+
+class StorageBackend(abc.ABC):
+	# Base class defining the interface all backends implement.
+	name = "base"
+
+	@abc.abstractmethod
+	def write_object(self, bucket_name, key_name, blob, version, if_stamp=None):
+		pass
+
+	@abc.abstractmethod
+	def read_object(self, bucket_name, key_name):
+		pass
+
+	def read_object_if_changed(self, bucket_name, key_name, stamp):
+		# Backends which can't do better simply always re-read.
+		blob, version = self.read_object(bucket_name, key_name)
+		return blob, version, None
+
+	@abc.abstractmethod
+	def list_keys(self, bucket_name):
+		pass
+
+
+class S3Storage(StorageBackend):
+	# Thin wrapper around AWSS3storage.  That (and so boto3, which is slow to
+	# import) is only imported when an S3 backend is created.
+	name = "s3"
+
+	def __init__(self):
+		import AWSS3storage
+		self.s3 = AWSS3storage
+
+	def write_object(self, bucket_name, key_name, blob, version, if_stamp=None):
+		try:
+			if if_stamp == CREATE_ONLY:
+				return self.s3.write_object(bucket_name, key_name, blob, version, if_none_match=CREATE_ONLY)
+			return self.s3.write_object(bucket_name, key_name, blob, version, if_match=if_stamp)
+		except self.s3.PreconditionFailed:
+			raise WriteConflict(key_name)
+
+	def read_object(self, bucket_name, key_name):
+		return self.s3.read_object(bucket_name, key_name)
+
+	def read_object_if_changed(self, bucket_name, key_name, stamp):
+		return self.s3.read_object_if_changed(bucket_name, key_name, stamp)
+
+	def list_keys(self, bucket_name):
+		return self.s3.list_keys(bucket_name)
+
+
+class MemoryStorage(StorageBackend):
+	# Objects held in a dict indexed by (bucket, key).  We store immutable
+	# bytes, so callers can never alias each other's state.
+	name = "memory"
+
+	def __init__(self):
+		self.objects = {}
+		self.generation = 0
+		self.lock = threading.Lock()
+
+	def write_object(self, bucket_name, key_name, blob, version, if_stamp=None):
+		with self.lock:
+			if if_stamp is not None:
+				entry = self.objects.get((bucket_name, key_name))
+				current_stamp = entry[2] if entry is not None else None
+				if current_stamp != (None if if_stamp == CREATE_ONLY else if_stamp):
+					raise WriteConflict(key_name)
+			self.generation += 1
+			stamp = str(self.generation)
+			self.objects[(bucket_name, key_name)] = (bytes(blob), version, stamp)
+		log_debug("Written object %s to bucket %s in memory", key_name, bucket_name)
+		return stamp
+
+	def read_object(self, bucket_name, key_name):
+		blob, version, stamp = self.read_object_if_changed(bucket_name, key_name, None)
+		return blob, version
+
+	def read_object_if_changed(self, bucket_name, key_name, stamp):
+		with self.lock:
+			entry = self.objects.get((bucket_name, key_name))
+
+		if entry is None:
+			log_debug("Object %s not found in bucket %s in memory", key_name, bucket_name)
+			return b'', "", None
+
+		if stamp is not None and entry[2] == stamp:
+			return None, "", stamp
+
+		return entry
+
+	def list_keys(self, bucket_name):
+		with self.lock:
+			return sorted(key for bucket, key in self.objects if bucket == bucket_name)
+
+
+class FileStorage(StorageBackend):
+	# Objects held as files of the form
+	#
+	#   <schema version>\n<blob>
+	#
+	# under <root>/<bucket>/<key>.  As every write creates a new file, the
+	# stamp is derived from the file's inode, size and modification time.
+	name = "file"
+
+	def __init__(self, root):
+		self.root = root
+		self.lock = threading.Lock()
+
+	def _bucket_dir(self, bucket_name):
+		return os.path.join(self.root, urllib.parse.quote(bucket_name, safe=''))
+
+	def _path(self, bucket_name, key_name):
+		return os.path.join(self._bucket_dir(bucket_name), urllib.parse.quote(key_name, safe=''))
+
+	def write_object(self, bucket_name, key_name, blob, version, if_stamp=None):
+		if if_stamp is None:
+			return self._write_object(bucket_name, key_name, blob, version)
+
+		# Conditional write.  Hold both a thread lock and (where supported) a
+		# file lock on the bucket so the check and the rename are atomic with
+		# respect to other writers in this and other processes.
+		bucket_dir = self._bucket_dir(bucket_name)
+		os.makedirs(bucket_dir, exist_ok=True)
+		with self.lock, open(os.path.join(bucket_dir, ".lock"), "a") as lock_file:
+			if fcntl:
+				fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+			try:
+				current_stamp = self._stamp(os.stat(self._path(bucket_name, key_name)))
+			except OSError:
+				current_stamp = None
+			if current_stamp != (None if if_stamp == CREATE_ONLY else if_stamp):
+				raise WriteConflict(key_name)
+			return self._write_object(bucket_name, key_name, blob, version)
+
+	def _write_object(self, bucket_name, key_name, blob, version):
+		bucket_dir = self._bucket_dir(bucket_name)
+		os.makedirs(bucket_dir, exist_ok=True)
+
+		# Write to a temporary file in the same directory, then rename over
+		# the real one.  The rename is atomic, so a concurrent reader sees
+		# either the old or the new object, never a mixture.
+		fd, tmp_path = tempfile.mkstemp(dir=bucket_dir, prefix=".tmp-")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(version.encode('utf-8') + b'\n')
+				f.write(blob)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmp_path, self._path(bucket_name, key_name))
+			stamp = self._stamp(os.stat(self._path(bucket_name, key_name)))
+		except OSError as e:
+			log_error("Error %s writing object %s to bucket %s under %s", e, key_name, bucket_name, self.root)
+			try:
+				os.unlink(tmp_path)
+			except OSError:
+				pass
+			raise
+
+		log_debug("Written object %s to bucket %s under %s", key_name, bucket_name, self.root)
+		return stamp
+
+	def _stamp(self, st):
+		return "%x-%x-%x" % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+	def read_object(self, bucket_name, key_name):
+		blob, version, stamp = self.read_object_if_changed(bucket_name, key_name, None)
+		return blob, version
+
+	def read_object_if_changed(self, bucket_name, key_name, stamp):
+		blob = b''
+		version = ""
+		new_stamp = None
+		path = self._path(bucket_name, key_name)
+
+		try:
+			with open(path, "rb") as f:
+				st = os.fstat(f.fileno())
+				new_stamp = self._stamp(st)
+				if stamp is not None and new_stamp == stamp:
+					log_debug("Object %s in bucket %s under %s unchanged", key_name, bucket_name, self.root)
+					return None, "", stamp
+
+				if st.st_size == 0:
+					log_error("Object %s in bucket %s under %s is empty", key_name, bucket_name, self.root)
+					return blob, version, None
+
+				with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+					header_end = m.find(b'\n')
+					if header_end < 0:
+						log_error("Object %s in bucket %s under %s has no header", key_name, bucket_name, self.root)
+					else:
+						version = m[:header_end].decode('utf-8')
+						blob = m[header_end + 1:]
+		except FileNotFoundError:
+			log_debug("Object %s not found in bucket %s under %s", key_name, bucket_name, self.root)
+			return blob, version, None
+		except OSError as e:
+			log_error("Error %s reading object %s from bucket %s under %s", e, key_name, bucket_name, self.root)
+
+		log_debug("Returned %d bytes of schema version %s reading object %s from bucket %s", len(blob), version, key_name, bucket_name)
+		return blob, version, new_stamp
+
+	def list_keys(self, bucket_name):
+		# Skip our lock and temporary files, which start with a dot (which
+		# quote leaves alone, but no key we write starts with).
+		try:
+			names = os.listdir(self._bucket_dir(bucket_name))
+		except OSError:
+			return []
+		return sorted(urllib.parse.unquote(name) for name in names if not name.startswith("."))
+
+
+def configured_backend_name():
+	if 'STORAGE_BACKEND' in os.environ:
+		return os.environ['STORAGE_BACKEND']
+	if os.environ.get('USE_STATIC_FILES') == "Y":
+		return "memory"
+	return "s3"
+
+
+def create_storage_backend(name=None):
+	# Create a new backend of the given type (or the configured one).
+	if name is None:
+		name = configured_backend_name()
+
+	if name == "s3":
+		# Imported here as diskCache itself builds on this module.
+		from diskCache import create_cached_storage
+		backend = create_cached_storage(S3Storage())
+	elif name == "memory":
+		backend = MemoryStorage()
+	elif name == "file":
+		backend = FileStorage(os.environ.get('STORAGE_DIR', DEFAULT_STORAGE_DIR))
+	else:
+		raise ValueError("Unknown storage backend %s" % name)
+
+	log_info("Using %s storage backend", backend.name)
+	return backend
@@ -13,14 +13,50 @@
 # This file allows for explicit testing of stuff.
 
 import os
+import sys
 import time
+import socket
 import pprint
+import collections
+import copy
 import json
+import pickle
+import logging
+import logutilities
 import testCases
 
 from testip import testip
-from AWSlambda import lambda_handler
-from testCases import testCases
+from testLWA import testLWA, HANG_TOKEN
+from AWSlambda import lambda_handler, batch_handler
+from userState import User, Device
+import userState
+from testCases import testCases, TurnOnAVSource, TurnOnAVSource_room2, PauseAVSource
+import AWSlambda
+import model as model_builder
+import validation
+from LWAauth import get_user_from_token, user_cache, LWA_READ_TIMEOUT
+import ipstats
+import ip
+import gateway
+import threading
+import urllib.request
+import urllib.error
+import importtime
+import bulk
+import recompile
+import sendscript
+import bench
+from testKIRAfarm import testKIRAfarm, make_devices, summarise
+from ip import KIRAConnection, release_warm_connections, keep_connections
+import concurrent.futures
+from deviceDB import DEVICE_DB
+import io
+import tempfile
+import subprocess
+from storage import MemoryStorage, FileStorage
+from diskCache import DiskCache, CachedStorage
+import IRcodec
+from runCommand import Schedule
 
 
 pp = pprint.PrettyPrinter(indent=2, width = 200)
@@ -29,6 +65,7 @@ def set_test_env():
 	os.environ['TEST_USER'] = 'testuser'
 	os.environ['TEST_TOKEN'] = 'token'
 	os.environ['LOG_LEVEL'] = 'DEBUG'
+	os.environ['VALIDATE_RESPONSES'] = 'strict'
 
 
 def run_test(test, sinkudp, sinktcp):
@@ -54,6 +91,890 @@ def run_test(test, sinkudp, sinktcp):
 		print("TEST FAILED")
 
 
+def set_all_devices(on):
+	u = User(os.environ['TEST_USER'])
+	u.reset_device_status({ device: on for device in u.get_model()['device_power_map'] })
+
+
+def run_batch_test(sinkudp, sinktcp):
+	# Check a batch of directives leaves devices in the same state as the
+	# directives handled one by one, sending no more commands, and is much
+	# quicker: it turns each device on or off at most once, up front, and
+	# waits once for devices to come up.
+	for title, directives, initially_on in [
+			("batch switching source in one room", [ testCases[2]["directive"], testCases[3]["directive"] ], True),
+			("batch turning on sources in two rooms", [ TurnOnAVSource, TurnOnAVSource_room2 ], False) ]:
+		print("\nRunning test case:", title)
+
+		set_all_devices(initially_on)
+		start = time.perf_counter()
+		for directive in directives:
+			lambda_handler(directive, "")
+		separate_time = time.perf_counter() - start
+		separate_commands = sinkudp.get_messages() + sinktcp.get_messages()
+		separate_status = User(os.environ['TEST_USER']).get_device_status()
+
+		set_all_devices(initially_on)
+		start = time.perf_counter()
+		result = batch_handler({ "directives": directives }, "")
+		batch_time = time.perf_counter() - start
+		batch_commands = sinkudp.get_messages() + sinktcp.get_messages()
+		batch_status = User(os.environ['TEST_USER']).get_device_status()
+
+		print("Separately took %.2fs, sent %s" % (separate_time, pp.pformat(separate_commands)))
+		print("Batched took %.2fs, sent %s" % (batch_time, pp.pformat(batch_commands)))
+
+		extra = collections.Counter(batch_commands) - collections.Counter(separate_commands)
+		if batch_status == separate_status and not extra and batch_time < separate_time * 0.75 and len(result["responses"]) == len(directives):
+			print("Test passed")
+		else:
+			print("TEST FAILED")
+
+
+def run_power_span_test(sinkudp):
+	# Check the trace of turning devices on times planning the power changes,
+	# has a section per device turned on covering that device's sends, and
+	# counts storage round trips as network time.
+	print("\nRunning test case: power sections in directive trace")
+	set_all_devices(False)
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, "metrics.jsonl")
+		os.environ['METRICS_SINK'] = path
+		try:
+			lambda_handler(TurnOnAVSource, "")
+		finally:
+			del os.environ['METRICS_SINK']
+		with open(path) as f:
+			record = json.loads(f.readline())
+	spans = record['spans']
+	sinkudp.get_messages()
+
+	end = lambda s: s['start'] + s['duration']
+	sections = [ s for s in spans if s['name'] == "TurnOn" ]
+	sends = [ s for s in spans if s['name'] == "send" ]
+	print("Power sections:", [ (s['args']['device'], s['start'], s['duration']) for s in sections ])
+	pass_test = any(s['name'] == "set_power_states" for s in spans) and sections
+
+	# Storage round trips count as network time
+	storage_spans = [ s for s in spans if s['name'] in ("get_model", "get_device_status", "set_device_status") ]
+	print("Storage spans:", [ (s['name'], s['kind']) for s in storage_spans ], "network %.3fms" % record['network'])
+	pass_test = pass_test and len(storage_spans) == 3 and all(s['kind'] == "network" for s in storage_spans) and \
+	            record['network'] >= sum(s['duration'] for s in storage_spans)
+	for section in sections:
+		device_sends = [ s for s in sends if s['args'].get('device') == section['args']['device'] ]
+		pass_test = pass_test and device_sends and all(section['start'] <= s['start'] and end(s) <= end(section) for s in device_sends)
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_chrome_trace_test(sinkudp):
+	# Check that with TRACE_DIR set a directive writes a Chrome trace whose
+	# events are well formed and nest: on each row spans either don't overlap
+	# or one contains the other (to within the microsecond the times are
+	# rounded to), and each device's power section contains its sends.
+	print("\nRunning test case: directive trace written in Chrome format")
+	set_all_devices(False)
+	with tempfile.TemporaryDirectory() as tmp:
+		os.environ['TRACE_DIR'] = tmp
+		try:
+			lambda_handler(TurnOnAVSource, "")
+		finally:
+			del os.environ['TRACE_DIR']
+		files = os.listdir(tmp)
+		with open(os.path.join(tmp, files[0])) as f:
+			trace = json.load(f)
+	sinkudp.get_messages()
+
+	events = [ e for e in trace['traceEvents'] if e['ph'] == "X" ]
+	rows = { e['tid']: e['args']['name'] for e in trace['traceEvents'] if e['ph'] == "M" and e['name'] == "thread_name" }
+	print("Trace file %s has %d events on rows %s" % (files, len(events), rows))
+	pass_test = (len(files) == 1 and files[0].endswith(".json") and events and
+	             all(isinstance(e['name'], str) and isinstance(e['ts'], int) and isinstance(e['dur'], int) and e['dur'] >= 0 and e['tid'] in rows for e in events) and
+	             { "set_power_states", "run_commands", "TurnOn", "send" } <= set(e['name'] for e in events))
+
+	end = lambda e: e['ts'] + e['dur']
+	contains = lambda outer, inner: outer['ts'] - 1 <= inner['ts'] and end(inner) <= end(outer) + 1
+	for tid in rows:
+		row = sorted((e for e in events if e['tid'] == tid), key=lambda e: (e['ts'], -e['dur']))
+		for i, first in enumerate(row):
+			for second in row[i + 1:]:
+				if second['ts'] < end(first) - 1 and not contains(first, second):
+					print("Badly nested:", first, second)
+					pass_test = False
+
+	for section in (e for e in events if e['name'] == "TurnOn"):
+		sends = [ e for e in events if e['name'] == "send" and e['args'].get('device') == section['args']['device'] ]
+		pass_test = pass_test and sends and all(contains(section, s) for s in sends)
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_script_test(sinkudp):
+	# Check a script of commands sends each command, with its repeats, in
+	# order and no sooner than the delays given.
+	print("\nRunning test case: script of IR commands")
+	script = [ "# Test script",
+	           "Test, TestReceiver, PowerOn, 0, 0.2",
+	           "Test, TestMonitor, InputHDMI1, 1",
+	           "",
+	           "Test, TestASource, Play, 0, 0, 127.0.0.1:60000" ]
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, "script.txt")
+		with open(path, "w") as f:
+			f.write("\n".join(script) + "\n")
+		report = []
+		steps, failed = sendscript.run_script(path, "127.0.0.1:60000", report=report.append)
+	commands = sinkudp.get_messages()
+	print("\n".join(report))
+	print("Received KIRA commands:", pp.pformat(commands))
+
+	expected = [ DEVICE_DB['Test']['TestReceiver']['IRcodes']['PowerOn'] ] + \
+	           [ DEVICE_DB['Test']['TestMonitor']['IRcodes']['InputHDMI1'] ] * 2 + \
+	           [ DEVICE_DB['Test']['TestASource']['IRcodes']['Play'] ]
+	second_start = float(report[1].split("s")[0])
+
+	# Bad targets are rejected before anything is sent
+	rejected = 0
+	for target in [ "127.0.0.1", "127.0.0.1:", "127.0.0.1:port", ":60000", "127.0.0.1:99999" ]:
+		try:
+			sendscript.parse_script([ "Test, TestReceiver, PowerOn, 0, 0, " + target ])
+		except sendscript.ScriptError as e:
+			print("Rejected target %s: %s" % (target, e))
+			rejected += 1
+
+	if commands == expected and not failed and second_start >= 0.2 and rejected == 5:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_IRcodec_test(sinkudp):
+	# Check every K-format code in the device DB packs smaller and unpacks to
+	# the same string, that a model packs and unpacks, and that a packed code
+	# goes out on the wire as the original string.  (The test devices have
+	# only plain text codes, so the tests above never send a packed one.)
+	print("\nRunning test case: packed IR codes round trip and send")
+	with open("deviceDB.json") as f:
+		device_DB = json.load(f)
+	codes = [ code for manufacturer in device_DB.values() for device in manufacturer.values() for code in device.get('IRcodes', {}).values() if IRcodec.K_FORMAT.fullmatch(code) ]
+	packed = [ IRcodec.encode_IR(code) for code in codes ]
+	print("Packed %d codes from %d to %d bytes" % (len(codes), sum(len(c) for c in codes), sum(len(p) for p in packed)))
+	pass_test = (len(codes) > 0 and
+	             all(IRcodec.is_packed(p) and len(p) < len(c) and IRcodec.decode_IR(p) == c for c, p in zip(codes, packed)))
+
+	model = { 'commands': [ { 'single': { 'KIRA': code, 'repeats': 0 } } for code in codes[:3] ] + [ { 'single': { 'KIRA': "PWON\r", 'repeats': 0 } } ] }
+	compacted = IRcodec.compact_model(model)
+	pass_test = pass_test and IRcodec.expand_model(compacted) == model and IRcodec.is_packed(compacted['commands'][0]['single']['KIRA'])
+
+	# A device written by V0.1.0, with its codes unpacked, still reads
+	storage = MemoryStorage()
+	old_device = { 'protocol': "udp", 'IRcodes': { 'PowerOn': codes[0], 'Text': "PWON\r" } }
+	storage.write_object(userState.BUCKET_ROOT + userState.BUCKET_GLOBALDB, userState.KEY_ROOT + "Old-Device", pickle.dumps(old_device), "V0.1.0")
+	pass_test = pass_test and Device("Old", "Device", storage).get() == old_device
+
+	schedule = Schedule()
+	for p in packed[:3]:
+		schedule.send("127.0.0.1:60000", "udp", p, 0)
+	schedule.execute()
+	commands = sinkudp.get_messages()
+	print("Received KIRA commands:", pp.pformat(commands))
+	pass_test = pass_test and commands == codes[:3]
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_warm_up_test():
+	# Check a power directive only warms up the targets of devices in its
+	# endpoint's room.  (Room 2's AV source is the only device sending over
+	# TCP.)
+	print("\nRunning test case: warm up only targets in the endpoint's room")
+	model = User(os.environ['TEST_USER']).get_model()
+	room1, room2 = set(), set()
+	AWSlambda.warm_up_targets(TurnOnAVSource, model, room1)
+	AWSlambda.warm_up_targets(TurnOnAVSource_room2, model, room2)
+	release_warm_connections()
+	print("Room 1 targets:", room1, "room 2 targets:", room2)
+
+	if room1 == { ("127.0.0.1:60000", "udp") } and ("127.0.0.1:60000", "tcp") in room2:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_TCP_timeout_test():
+	# Check a send to a TCP target which has stopped reading times out, and
+	# is counted as a send error, rather than blocking forever.
+	print("\nRunning test case: TCP sends to a stalled target time out")
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+	listener.bind(("127.0.0.1", 60006))
+	listener.listen(1)
+	timeout = ip.TCP_TIMEOUT
+	ip.TCP_TIMEOUT = 0.5
+	start = time.perf_counter()
+	try:
+		connection = KIRAConnection("127.0.0.1:60006", "tcp")
+		try:
+			connection.send(b"K " + b"0123 " * 2000000)
+			error = None
+		except OSError as e:
+			error = e
+		finally:
+			connection.close()
+	finally:
+		ip.TCP_TIMEOUT = timeout
+		listener.close()
+	elapsed = time.perf_counter() - start
+	errors = ipstats.snapshot()["127.0.0.1:60006"]["tcp"]["errors"]
+	print("Send raised %r after %.2fs; errors %s" % (error, elapsed, errors))
+
+	if isinstance(error, socket.timeout) and elapsed < 5 and errors["send"] == 1:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_DNS_cache_test():
+	# Check a target's address is cached, but forgotten when connecting to it
+	# fails (e.g. as its dynamic DNS name now points elsewhere).
+	print("\nRunning test case: DNS cache entries dropped on failure")
+	ip.resolve("localhost", 60005)
+	cached = ("localhost", 60005) in ip.G_ADDRESSES
+	try:
+		KIRAConnection("localhost:60005", "tcp").close()
+		error = None
+	except OSError as e:
+		error = e
+	forgotten = ("localhost", 60005) not in ip.G_ADDRESSES
+	print("Cached %s; connecting raised %r; then forgotten %s" % (cached, error, forgotten))
+
+	if cached and error is not None and forgotten and ip.DNS_CACHE_TTL <= 60:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_lazy_log_test():
+	# Check arguments wrapped for lazy formatting are only formatted when a
+	# record is actually emitted, and then once.
+	print("\nRunning test case: disabled log levels don't format their arguments")
+	calls = []
+	def formatter(obj):
+		calls.append(obj)
+		return str(obj)
+
+	logger = logutilities.logger
+	level = logger.level
+	stream = io.StringIO()
+	handler = logging.StreamHandler(stream)
+	logger.addHandler(handler)
+	try:
+		logger.setLevel(logging.INFO)
+		logutilities.log_debug("Disabled %s", logutilities.LazyFormat(formatter, "debug"))
+		disabled_calls = len(calls)
+		logutilities.log_info("Enabled %s", logutilities.LazyFormat(formatter, "info"))
+	finally:
+		logger.removeHandler(handler)
+		logger.setLevel(level)
+	print("Formatted %s; logged %r" % (calls, stream.getvalue()))
+
+	if disabled_calls == 0 and calls == [ "info" ] and "Enabled info" in stream.getvalue():
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_log_format_test():
+	# Check LOG_FORMAT=json makes every record one JSON object per line, and
+	# that LOG_PAYLOAD_SAMPLE and LOG_PAYLOAD_MAX control which payloads are
+	# dumped and how much of them.  These are read on import, so run in a
+	# fresh process.
+	print("\nRunning test case: JSON log records and payload sampling")
+	script = "\n".join([ "import json, logutilities as l",
+	                     "l.log_info('Hello %s', 'world')",
+	                     "l.log_error('Oops %d', 3)",
+	                     "sampled = [ l.sample_payloads() for i in range(9) ]",
+	                     "for s in sampled: l.log_payload('Request', { 'data': 'x' * 200 }, s)",
+	                     "print(json.dumps(sampled))" ])
+	env = dict(os.environ, LOG_FORMAT="json", LOG_PAYLOAD_SAMPLE="3", LOG_PAYLOAD_MAX="50", LOG_LEVEL="INFO")
+	env.pop('LOG_LOCAL', None)
+	result = subprocess.run([ sys.executable, "-c", script ], env=env, capture_output=True, text=True, timeout=30)
+	try:
+		sampled = json.loads(result.stdout)
+		records = [ json.loads(line) for line in result.stderr.splitlines() ]
+	except ValueError as e:
+		print("Unparseable output %r %r: %s" % (result.stdout, result.stderr, e))
+		sampled, records = None, []
+	print("Sampled %s; records %s" % (sampled, pp.pformat(records)))
+
+	payloads = [ r['payload'] for r in records if 'payload' in r ]
+	pass_test = (sampled == [ True, False, False ] * 3 and len(records) == 5 and
+	             [ (r['level'], r['msg']) for r in records[:2] ] == [ ("INFO", "Hello world"), ("ERROR", "Oops 3") ] and
+	             all(r['func'] == "<module>" for r in records) and
+	             len(payloads) == 3 and all(p.startswith('{"data":"xxx') and p.endswith("...<161 chars truncated>") for p in payloads))
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_profiling_test():
+	# Check each profiling mode writes its results under PROFILE_DIR, and that
+	# with no mode set functions are left unwrapped.  The settings are read on
+	# import, so run in a fresh process.
+	print("\nRunning test case: profiling modes write their results")
+	script = "\n".join([ "import profiling",
+	                     "def build(n): return [ str(i) * 10 for i in range(n) ]",
+	                     "wrapped = profiling.profiled('build')(build)",
+	                     "wrapped(10000)",
+	                     "print(wrapped is build)" ])
+	results = {}
+	with tempfile.TemporaryDirectory() as tmp:
+		for mode in [ "cprofile", "tracemalloc", "" ]:
+			directory = os.path.join(tmp, mode or "none")
+			env = dict(os.environ, PROFILE_MODE=mode, PROFILE_SAMPLE="1", PROFILE_DIR=directory)
+			result = subprocess.run([ sys.executable, "-c", script ], env=env, capture_output=True, text=True, timeout=30)
+			files = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+			results[mode] = (result.stdout.strip(), [ f.split(".", 1)[1] for f in files if f.startswith("build-") ])
+	print("Unwrapped and profiles written by mode:", results)
+
+	if results == { "cprofile": ("False", [ "prof" ]), "tracemalloc": ("False", [ "mem.txt" ]), "": ("True", []) }:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_stats_test():
+	# Check the IO statistics gathered while running the test cases
+	print("\nRunning test case: IO statistics recorded for each target")
+	snap = ipstats.snapshot()
+	print(ipstats.to_prometheus())
+
+	messages = 0
+	pass_test = True
+	for target in snap:
+		for protocol, stats in snap[target].items():
+			messages += stats['messages']
+			if stats['send']['count'] != stats['messages'] or stats['send']['buckets'][-1][1] != stats['messages'] or stats['bytes'] < stats['messages']:
+				pass_test = False
+	if messages == 0:
+		pass_test = False
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def post_to_gateway(port, body):
+	req = urllib.request.Request("http://127.0.0.1:%d/" % port, data=body, headers={ 'Content-Type': 'application/json' })
+	try:
+		with urllib.request.urlopen(req, timeout=10) as r:
+			return r.status, json.loads(r.read())
+	except urllib.error.HTTPError as e:
+		return e.code, json.loads(e.read())
+
+
+def run_gateway_test():
+	# Check directives are handled over HTTP by the gateway
+	print("\nRunning test case: gateway handles directives over HTTP")
+	server = gateway.create_server("127.0.0.1", 60002)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	discover = [ t for t in testCases if t["directive"]["directive"]["header"]["name"] == "Discover" ][0]
+	expected = lambda_handler(discover["directive"], "")
+
+	try:
+		status, response = post_to_gateway(60002, json.dumps(discover["directive"]).encode('utf-8'))
+		print("Discover returned", status, response["event"]["header"]["name"])
+		pass_test = (status == 200 and
+					 response["event"]["header"]["name"] == "Discover.Response" and
+					 response["event"]["payload"] == expected["event"]["payload"])
+
+		# New models hold only the serialized response; older ones only the
+		# endpoints, from which we still respond
+		model = User(os.environ['TEST_USER']).get_model()
+		old_model = { 'discovery_response': json.loads(model['discovery_json'])['event']['payload']['endpoints'] }
+		old_response = AWSlambda.handle_discovery(old_model)
+		pass_test = pass_test and 'discovery_response' not in model and old_response["event"]["payload"] == expected["event"]["payload"]
+
+		status, response = post_to_gateway(60002, b'{ "not": "a directive" }')
+		print("Bad request returned", status, response)
+		pass_test = pass_test and (status == 400)
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_gateway_send_test():
+	# Check the gateway keeps its TCP connection to a KIRA open between
+	# directives, and that when sending fails the user's cached device status
+	# is left as it was.
+	print("\nRunning test case: gateway reuses connections and survives failed sends")
+	farm = testKIRAfarm(make_devices(60000, 1, "udp") + make_devices(60000, 1, "tcp"))
+	farm.spawn()
+	set_all_devices(False)
+	gateway.G_SESSIONS = gateway.Sessions()
+	server = gateway.create_server("127.0.0.1", 60002)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	pause = copy.deepcopy(PauseAVSource)
+	pause["directive"]["endpoint"]["endpointId"] = "AVsource_room2"
+	connects = lambda: ipstats.snapshot().get("127.0.0.1:60000", {}).get("tcp", {}).get("connect", {}).get("count", 0)
+
+	try:
+		before = connects()
+		statuses = [ post_to_gateway(60002, json.dumps(pause).encode('utf-8'))[0] for i in range(2) ]
+		received = [ r['payload'] for r in farm.get_records(1) if r['protocol'] == "tcp" ]
+		new_connects = connects() - before
+		print("Pauses returned %s; KIRA received %s over %d connections" % (statuses, received, new_connects))
+		pass_test = (statuses == [ 200, 200 ] and new_connects == 1 and
+		             received == [ DEVICE_DB['Test']['TestAVSource_room2']['IRcodes']['Pause'] ] * 2)
+
+		# Now the KIRA has gone, turning on room 2 fails
+		farm.terminate()
+		status, response = post_to_gateway(60002, json.dumps(TurnOnAVSource_room2).encode('utf-8'))
+		cached = gateway.G_SESSIONS.get(os.environ['TEST_USER']).user.device_status
+		stored = User(os.environ['TEST_USER']).get_device_status()
+		print("Turn on with the KIRA gone returned", status, response, "; cached status", cached)
+		pass_test = pass_test and status == 500 and not any(cached.values()) and cached == stored
+	finally:
+		server.shutdown()
+		server.server_close()
+		farm.terminate()
+		keep_connections(0)
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_session_eviction_test():
+	# Check the gateway drops the sessions of users who have gone idle, but
+	# not of one whose request is still running.
+	print("\nRunning test case: gateway drops idle user sessions")
+	sessions = gateway.Sessions(0.2)
+	sessions.get("idleuser")
+	busy = sessions.get("busyuser")
+	with busy.lock:
+		time.sleep(0.3)
+		sessions.get("newuser")
+		remaining = sorted(sessions.sessions)
+	print("Sessions after going idle:", remaining)
+
+	if remaining == [ "busyuser", "newuser" ]:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_bulk_test():
+	# Export all devices and users, upload them again and check a second
+	# export matches; and that streaming a file in small chunks reads it as a
+	# whole.
+	print("\nRunning test case: bulk export and upload round trip")
+	with tempfile.TemporaryDirectory() as tmp:
+		exports = []
+		for run in range(2):
+			devices_file = os.path.join(tmp, "devices%d.json" % run)
+			users_file = os.path.join(tmp, "users%d.json" % run)
+			devices, device_errors, elapsed = bulk.export_devices(devices_file, 4)
+			users, user_errors, elapsed = bulk.export_users(users_file, 4)
+			exports.append((json.load(open(devices_file)), json.load(open(users_file)), device_errors + user_errors))
+			print("Exported %d devices and %d users" % (len(devices), len(users)))
+			if run == 0:
+				uploaded, errors, elapsed, affected, failed = bulk.upload_devices(devices_file, 4)
+				print("Uploaded %d devices, recompiled %d users" % (len(uploaded), len(affected)))
+				uploaded, errors, elapsed = bulk.upload_users(users_file, 4)
+				print("Uploaded %d users" % len(uploaded))
+
+		text = open(os.path.join(tmp, "devices0.json")).read()
+		streamed = dict(bulk.JSONStream(io.StringIO(text), 7).entries())
+
+	if exports[0] == exports[1] and exports[0][0] and exports[0][1] and not exports[0][2] and streamed == json.loads(text):
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+class CountingStorage(MemoryStorage):
+	# Memory backend counting the objects it actually transfers on read.
+
+	def __init__(self):
+		MemoryStorage.__init__(self)
+		self.transfers = 0
+
+	def read_object_if_changed(self, bucket_name, key_name, stamp):
+		blob, version, new_stamp = MemoryStorage.read_object_if_changed(self, bucket_name, key_name, stamp)
+		if blob is not None:
+			self.transfers += 1
+		return blob, version, new_stamp
+
+
+def run_cache_test():
+	# Check the two tier cache revalidates against the backend, serves a
+	# recycled process from disk without transferring anything, and evicts the
+	# least recently used disk entries when over its cap.
+	print("\nRunning test case: two tier storage cache")
+	backend = CountingStorage()
+	with tempfile.TemporaryDirectory() as tmp:
+		cached = CachedStorage(backend, DiskCache(tmp))
+		cached.write_object("bucket", "a", b'first', "V1")
+		reads = [ cached.read_object("bucket", "a") ]
+		unchanged_transfers = backend.transfers
+
+		# Someone else writes straight to the backend
+		backend.write_object("bucket", "a", b'second', "V1")
+		reads.append(cached.read_object("bucket", "a"))
+		changed_transfers = backend.transfers - unchanged_transfers
+
+		# A recycled process has an empty memory tier but the same disk
+		recycled = CachedStorage(backend, DiskCache(tmp))
+		before = backend.transfers
+		reads.append(recycled.read_object("bucket", "a"))
+		recycled_transfers = backend.transfers - before
+		print("Reads:", reads, "transfers: unchanged %d, changed %d, recycled %d" % (unchanged_transfers, changed_transfers, recycled_transfers))
+		pass_test = (reads == [ (b'first', "V1"), (b'second', "V1"), (b'second', "V1") ] and
+		             unchanged_transfers == 0 and changed_transfers == 1 and recycled_transfers == 0)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		# Room for three entries of this size
+		entry_size = len(b'V1\n1\n' + b'x' * 100)
+		disk_cache = DiskCache(tmp, 3 * entry_size)
+		for key in [ "a", "b", "c" ]:
+			disk_cache.put("bucket", key, b'x' * 100, "V1", "1")
+			time.sleep(0.01)
+		disk_cache.get("bucket", "a")
+		time.sleep(0.01)
+		disk_cache.put("bucket", "d", b'x' * 100, "V1", "1")
+		present = [ key for key in [ "a", "b", "c", "d" ] if disk_cache.get("bucket", key) is not None ]
+		print("Disk cache entries after eviction:", present)
+		pass_test = pass_test and present == [ "a", "c", "d" ]
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_status_merge_test(storage):
+	# Two User objects for one user read the same status, then each turns on
+	# a different device.  The second write conflicts and must merge rather
+	# than undo the first; and the same must hold with several writers at
+	# once, and when there was no status to read.
+	print("\nRunning test case: concurrent device status writes merge on %s storage" % storage.name)
+	devices = [ "TV", "Amp", "Blu-ray", "Sky" ]
+	first = User("statususer", storage)
+	first.reset_device_status({ device: False for device in devices })
+	second = User("statususer", storage)
+	second.get_device_status()
+
+	first.set_device_status(dict(first.get_device_status(), TV=True))
+	second.set_device_status(dict(second.get_device_status(), Amp=True))
+	merged = User("statususer", storage).get_device_status()
+	print("After two writers:", merged)
+	pass_test = merged == { "TV": True, "Amp": True, "Blu-ray": False, "Sky": False } and second.get_device_status() == merged
+
+	first.reset_device_status({ device: False for device in devices })
+	users = [ User("statususer", storage) for device in devices ]
+	for u in users:
+		u.get_device_status()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(devices)) as pool:
+		list(pool.map(lambda u, device: u.set_device_status(dict(u.get_device_status(), **{ device: True })), users, devices))
+	merged = User("statususer", storage).get_device_status()
+	print("After %d concurrent writers:" % len(devices), merged)
+	pass_test = pass_test and merged == { device: True for device in devices }
+
+	# Nor must two writers both creating the status
+	first = User("newstatususer", storage)
+	second = User("newstatususer", storage)
+	first.get_device_status()
+	second.get_device_status()
+	first.set_device_status({ "TV": True })
+	second.set_device_status({ "Amp": True })
+	merged = User("newstatususer", storage).get_device_status()
+	print("After two writers creating the status:", merged)
+	pass_test = pass_test and merged == { "TV": True, "Amp": True }
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_recompile_status_test():
+	# Check recompiling a user's model keeps their device status, without
+	# rewriting it (which could undo a directive's concurrent write).
+	print("\nRunning test case: recompiling a model keeps device status")
+	set_all_devices(True)
+	before = User(os.environ['TEST_USER'])
+	before.get_device_status()
+	compiled = User(os.environ['TEST_USER']).compile_model()
+	after = User(os.environ['TEST_USER'])
+	status = after.get_device_status()
+	print("Device status after recompiling:", status)
+
+	if compiled and status == before.device_status and all(status.values()) and after.status_stamp == before.status_stamp:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+class ErrorRecorder(logging.Handler):
+	# Records the errors logged while installed.
+
+	def __init__(self):
+		logging.Handler.__init__(self, logging.ERROR)
+		self.errors = []
+
+	def emit(self, record):
+		self.errors.append(record.getMessage())
+
+
+def run_device_index_test():
+	# Check a new user is added to the device index without any errors being
+	# logged, that rebuilding the index adds users uploaded before it existed,
+	# and that uploading a device then recompiles their models.
+	print("\nRunning test case: device index rebuild and recompile")
+	storage = userState.get_storage()
+	details = json.loads(json.dumps(User(os.environ['TEST_USER']).get_details()))
+	device = ('Test', 'TestMonitor')
+
+	recorder = ErrorRecorder()
+	logging.getLogger().addHandler(recorder)
+	try:
+		new_user = User("newuser")
+		new_user.set_details(details)
+		compiled = new_user.compile_model()
+	finally:
+		logging.getLogger().removeHandler(recorder)
+	print("Errors uploading a new user:", recorder.errors)
+	pass_test = compiled and not recorder.errors and "newuser" in userState.get_device_users([ device ])
+
+	# A user uploaded before there was an index
+	userState.write_state(storage, userState.BUCKET_USERDB, "olduser" + userState.KEY_USER_DETAILS, details)
+	old_user = User("olduser")
+	old_user.compile_model()
+	pass_test = pass_test and "olduser" not in userState.get_device_users([ device ])
+
+	indexed = recompile.rebuild_device_index(4)
+	users = userState.get_device_users([ device ])
+	print("Rebuilt index from %s; users with %s: %s" % (indexed, device, sorted(users)))
+	pass_test = pass_test and { "olduser", "newuser", os.environ['TEST_USER'] } <= users
+
+	Device(*device).set(DEVICE_DB[device[0]][device[1]])
+	affected, failed = recompile.recompile_for_devices([ device ], 4)
+	recompiled = User("olduser")
+	recompiled.get_model()
+	print("Recompiled %s, failed %s" % (affected, failed))
+	pass_test = pass_test and "olduser" in affected and not failed and recompiled.model_stamp != old_user.model_stamp
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_status_merge_tests():
+	run_status_merge_test(MemoryStorage())
+	with tempfile.TemporaryDirectory() as tmp:
+		run_status_merge_test(FileStorage(tmp))
+
+
+def run_file_storage_test():
+	# Check a failed write to the file backend raises, rather than looking
+	# to compare and swap callers like a write with no stamp, and leaves no
+	# temporary file behind.
+	print("\nRunning test case: failed file storage writes raise")
+	with tempfile.TemporaryDirectory() as tmp:
+		storage = FileStorage(tmp)
+		storage.write_object("bucket", "a", b'first', "V1")
+		try:
+			storage.write_object("bucket", "x" * 300, b'too long a name', "V1")
+			error = None
+		except OSError as e:
+			error = e
+		leftovers = [ f for f in os.listdir(os.path.join(tmp, "bucket")) if f.startswith(".tmp-") ]
+		print("Write raised %r, left %s" % (error, leftovers))
+		pass_test = error is not None and not leftovers and storage.read_object("bucket", "a") == (b'first', "V1")
+
+	if pass_test:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_bench_test():
+	# Benchmark paced sends to a simulated KIRA, checking everything arrives
+	# and the pacing holds.
+	print("\nRunning test case: benchmark of IR sends")
+	farm = testKIRAfarm(make_devices(60003, 1, "udp"))
+	farm.spawn()
+	result = bench.run_bench("127.0.0.1:60003", "udp", bench.BENCH_MESSAGE, 200, 4, 2000)
+	received = farm.get_records()
+	farm.terminate()
+	print("\n".join(result.report()))
+	print("Simulated KIRA received %d messages" % len(received))
+
+	percentiles = [ result.percentile(p) for p in bench.PERCENTILES ]
+	if len(received) == 200 and not result.errors and result.elapsed >= 199 / 2000 and percentiles == sorted(percentiles):
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_farm_test():
+	# Send to many simulated KIRAs at once, over UDP with loss and TCP with
+	# latency, and check each received every message intact (and that
+	# roughly the expected fraction of UDP messages were dropped).
+	print("\nRunning test case: concurrent sends to a farm of simulated KIRAs")
+	specs = make_devices(60500, 10, "udp", loss=0.2, ack=True) + make_devices(60600, 5, "tcp", latency=0.01, ack=True)
+	farm = testKIRAfarm(specs, seed=1)
+	farm.spawn()
+
+	# A long code, which testip used to truncate, and a text command
+	messages = [ bench.BENCH_MESSAGE + " 0224 068F" * 100, "PWON\r" ] * 10
+
+	def send_all(spec):
+		with KIRAConnection("127.0.0.1:%d" % spec['port'], spec['protocol']) as connection:
+			for message in messages:
+				connection.send(message)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(specs)) as pool:
+		list(pool.map(send_all, specs))
+	records = farm.get_records()
+	farm.terminate()
+
+	summary = summarise(records)
+	print("Messages received (and dropped) by each KIRA:", pp.pformat(summary))
+	dropped = sum(d for n, d in summary.values())
+	intact = all([ r['payload'] for r in records if r['port'] == spec['port'] ] == messages for spec in specs)
+
+	if intact and 0 < dropped < 0.4 * len(messages) * 10:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_validation_test():
+	# Check an invalid discovery response fails the compile, leaving the
+	# stored model alone, and that response sampling doesn't start from the
+	# first response.
+	print("\nRunning test case: invalid discovery response fails the compile")
+	os.environ['VALIDATE_RESPONSES'] = 'sample'
+	before = User(os.environ['TEST_USER'])
+	before.get_model()
+	check = model_builder.check_discovery_template
+	model_builder.check_discovery_template = lambda template: False
+	stream = io.StringIO()
+	handler = logging.StreamHandler(stream)
+	try:
+		compiled = User(os.environ['TEST_USER']).compile_model()
+		logutilities.logger.addHandler(handler)
+		invalid = validation.check_discovery_template(b'{"event":{"header":{"messageId":"@messageId@"}}}')
+	finally:
+		logutilities.logger.removeHandler(handler)
+		model_builder.check_discovery_template = check
+		os.environ['VALIDATE_RESPONSES'] = 'strict'
+	after = User(os.environ['TEST_USER'])
+	after.get_model()
+	print("Compiled:", compiled)
+
+	first_sample = next(validation.G_SAMPLE_COUNTER)
+	print("Invalid template accepted:", invalid, "first sample count:", first_sample)
+	errors = [ line for line in stream.getvalue().splitlines() if "Invalid discovery response" in line ]
+	print("Logged:", errors, "in %d characters" % len(stream.getvalue()))
+
+	if not compiled and after.model_stamp == before.model_stamp and invalid is False and first_sample != 0 and \
+	   len(errors) == 1 and len(stream.getvalue()) < 1000:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_import_test():
+	# Check the lambda is still quick to import
+	print("\nRunning test case: import time within budget, heavy modules lazy")
+	if importtime.report():
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_LWA_test(title, lwa, tokens, expected_users, expected_lookups, max_time=None):
+	print("\nRunning test case:", title)
+	start = time.perf_counter()
+	users = [ get_user_from_token(t) for t in tokens ]
+	elapsed = time.perf_counter() - start
+	lookups = lwa.get_lookups()
+	print("Users returned:", pp.pformat(users))
+	print("LWA lookups made:", pp.pformat(lookups))
+	print("Took %.2fs" % elapsed)
+
+	if users == expected_users and lookups == expected_lookups and (max_time is None or elapsed < max_time):
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_LWA_expiry_test(lwa):
+	# A token with one second left is cached, but not past its expiry.
+	print("\nRunning test case: LWA: lookups are cached for no longer than the token has left")
+	users = [ get_user_from_token('expiring-token') for i in range(2) ]
+	time.sleep(1.2)
+	users.append(get_user_from_token('expiring-token'))
+	lookups = lwa.get_lookups()
+	print("Users returned:", pp.pformat(users))
+	print("LWA lookups made:", pp.pformat(lookups))
+
+	if users == [ 'amzn1.account.TESTUSER' ] * 3 and lookups == [ 'expiring-token' ] * 2:
+		print("Test passed")
+	else:
+		print("TEST FAILED")
+
+
+def run_LWA_tests():
+	# Check the token cache against a local LWA stand-in
+	lwa = testLWA(60001, { 'good-token': 'amzn1.account.TESTUSER', 'expiring-token': 'amzn1.account.TESTUSER' }, { 'expiring-token': 1 })
+	lwa.spawn()
+	os.environ['LWA_PROFILE_URL'] = lwa.url()
+	user_cache.clear()
+
+	try:
+		run_LWA_test("LWA: repeat lookups of a valid token are cached", lwa,
+					 [ 'good-token', 'good-token', 'good-token' ],
+					 [ 'amzn1.account.TESTUSER' ] * 3, [ 'good-token' ])
+		run_LWA_test("LWA: failed lookups are negatively cached", lwa,
+					 [ 'bad-token', 'bad-token' ],
+					 [ '<unknown>' ] * 2, [ 'bad-token' ])
+		run_LWA_test("LWA: a hung lookup fails after one read timeout", lwa,
+					 [ HANG_TOKEN ],
+					 [ '<unknown>' ], [ HANG_TOKEN ], LWA_READ_TIMEOUT + 0.5)
+		run_LWA_expiry_test(lwa)
+	except KeyboardInterrupt:
+		print("Interrupted")
+
+	del os.environ['LWA_PROFILE_URL']
+	lwa.terminate()
+
+
 def run_tests():
 	set_test_env()
 	sinkudp = testip(60000, "udp")
@@ -61,16 +982,70 @@ def run_tests():
 	sinkudp.spawn()
 	sinktcp.spawn()
 
+	ipstats.reset()
+
 	try:
 		for test in testCases:
 			run_test(test, sinkudp, sinktcp)
 
+		run_batch_test(sinkudp, sinktcp)
+
+		run_script_test(sinkudp)
+
+		run_power_span_test(sinkudp)
+
+		run_chrome_trace_test(sinkudp)
+
+		run_IRcodec_test(sinkudp)
+
+		run_warm_up_test()
+
 	except KeyboardInterrupt:
 		print("Interrupted")
 
 	sinkudp.terminate()
 	sinktcp.terminate()
 
+	run_stats_test()
+
+	run_DNS_cache_test()
+
+	run_TCP_timeout_test()
+
+	run_lazy_log_test()
+
+	run_log_format_test()
+
+	run_profiling_test()
+
+	run_gateway_test()
+
+	run_gateway_send_test()
+
+	run_session_eviction_test()
+
+	run_bulk_test()
+
+	run_cache_test()
+
+	run_status_merge_tests()
+
+	run_file_storage_test()
+
+	run_recompile_status_test()
+
+	run_device_index_test()
+
+	run_validation_test()
+
+	run_bench_test()
+
+	run_farm_test()
+
+	run_LWA_tests()
+
+	run_import_test()
+
 
 if __name__ == '__main__':
 	run_tests()
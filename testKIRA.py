@@ -18,6 +18,9 @@ from logutilities import log_info, log_debug
 
 pp = pprint.PrettyPrinter(indent=2, width = 200)
 
+# Big enough for any UDP datagram, so long codes aren't truncated
+MAX_MESSAGE = 65535
+
 class testKIRA:
 	# This class implements a background process simulating a KIRA endpoint.
 
@@ -65,5 +68,5 @@ def listener(q, port):
 	sock.bind(('127.0.0.1', int(port)))
 
 	while(True):
-		(message, address) = sock.recvfrom(1024)
+		(message, address) = sock.recvfrom(MAX_MESSAGE)
 		q.put(message)
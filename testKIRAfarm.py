@@ -0,0 +1,293 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements a farm of simulated KIRA targets, for load testing
+# sending to many targets at once locally.  Unlike testip, which listens on
+# one port and accepts one TCP connection, the farm runs any number of
+# virtual KIRAs, each on its own port, in one process using asyncio.
+#
+# Each virtual KIRA has
+# - a name, host, port and protocol (udp or tcp; TCP KIRAs accept any number
+#   of connections)
+# - a latency: how long it takes to process each message before acking
+# - a loss rate: the probability that a message is dropped (it is recorded,
+#   marked as dropped, but not acked)
+# - whether it acks each message by replying "OK", as real KIRAs do.
+#
+# Every message received is recorded as a dict with the KIRA's name, port and
+# protocol, the time it arrived, the payload and whether it was dropped.
+#
+# TCP is a byte stream, so we split what we read into messages: a K-format
+# code ("K " then hex groups) ends at the first character which can't be part
+# of one, and any other message (such as PWON\r) at a carriage return, or
+# where the next K-format code begins.  A message still pending when
+# the connection goes idle for FRAME_IDLE seconds, or is closed, is taken to
+# be complete.
+#
+# Use from tests like testip:
+#
+#   farm = testKIRAfarm(make_devices(60100, 50, "udp", latency=0.01))
+#   farm.spawn()
+#   ... send to 127.0.0.1:60100-60149 ...
+#   records = farm.get_records()
+#   farm.terminate()
+#
+# or run standalone, recording to a file of one JSON record per line:
+#
+#   python testKIRAfarm.py --port 60100 --count 50 --protocol tcp --loss 0.1 --ack --record farm.jsonl
+
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import random
+import asyncio
+import argparse
+import multiprocessing
+
+from logutilities import log_info, log_debug, log_error
+
+DEFAULT_HOST = "127.0.0.1"
+ACK = b"OK"
+FRAME_IDLE = 0.05
+READ_SIZE = 65536
+
+
+def make_devices(first_port, count, protocol="udp", latency=0.0, loss=0.0, ack=False, host=DEFAULT_HOST):
+	# Return the specs of count identical virtual KIRAs on consecutive ports.
+	return [ { 'name': "kira%d" % (first_port + i), 'host': host, 'port': first_port + i, 'protocol': protocol,
+	           'latency': latency, 'loss': loss, 'ack': ack } for i in range(count) ]
+
+
+# Characters which can follow the "K " starting a K-format code
+K_CODE_CHARS = frozenset(b"0123456789ABCDEFabcdef ")
+
+
+def split_messages(buf):
+	# Split a TCP buffer into complete messages and whatever is left over.  A
+	# K-format code runs until the first character which can't be part of it;
+	# anything else runs to a carriage return, or the start of a K-format code.
+	messages = []
+	start = 0
+	while start < len(buf):
+		if buf.startswith(b"K ", start):
+			end = start + 2
+			while end < len(buf) and buf[end] in K_CODE_CHARS:
+				end += 1
+			if end == len(buf):
+				break
+		else:
+			cr = buf.find(b"\r", start)
+			code = buf.find(b"K ", start + 1)
+			if cr < 0 and code < 0:
+				break
+			end = cr + 1 if cr >= 0 and (code < 0 or cr < code) else code
+		messages.append(buf[start:end])
+		start = end
+	return messages, buf[start:]
+
+
+class VirtualKIRA:
+
+	def __init__(self, spec, record, rng):
+		self.name = spec.get('name', "kira%d" % spec['port'])
+		self.host = spec.get('host', DEFAULT_HOST)
+		self.port = spec['port']
+		self.protocol = spec.get('protocol', "udp")
+		self.latency = spec.get('latency', 0.0)
+		self.loss = spec.get('loss', 0.0)
+		self.ack = spec.get('ack', False)
+		self.record = record
+		self.rng = rng
+
+	def received(self, payload, reply):
+		# Record a message, then (unless we drop it) ack it after our latency
+		# using the reply function.
+		dropped = self.loss > 0 and self.rng.random() < self.loss
+		self.record({ 'name': self.name, 'port': self.port, 'protocol': self.protocol, 'time': time.time(),
+		              'payload': payload.decode('utf-8', errors='replace'), 'dropped': dropped })
+		if self.ack and not dropped:
+			if self.latency > 0:
+				asyncio.get_running_loop().call_later(self.latency, reply, ACK)
+			else:
+				reply(ACK)
+
+	async def start(self):
+		loop = asyncio.get_running_loop()
+		if self.protocol == "udp":
+			# Senders bind to the port too (see ip.py), so share it as testip
+			# does.
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			sock.bind((self.host, self.port))
+			self.transport, protocol = await loop.create_datagram_endpoint(lambda: UDPProtocol(self), sock=sock)
+			self.server = None
+		else:
+			self.server = await asyncio.start_server(self.serve_connection, self.host, self.port, reuse_address=True)
+		log_debug("Virtual KIRA %s listening on %s:%d over %s", self.name, self.host, self.port, self.protocol)
+
+	async def serve_connection(self, reader, writer):
+		def reply(data):
+			if not writer.is_closing():
+				writer.write(data)
+
+		pending = b''
+		try:
+			while True:
+				try:
+					data = await asyncio.wait_for(reader.read(READ_SIZE), FRAME_IDLE if pending else None)
+				except asyncio.TimeoutError:
+					self.received(pending, reply)
+					pending = b''
+					continue
+				if not data:
+					break
+				messages, pending = split_messages(pending + data)
+				for message in messages:
+					self.received(message, reply)
+		except ConnectionError:
+			pass
+		finally:
+			if pending:
+				self.received(pending, reply)
+			writer.close()
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+
+	def __init__(self, kira):
+		self.kira = kira
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.address = transport.get_extra_info('sockname')
+
+	def datagram_received(self, data, address):
+		# Senders bind to the KIRA's port (see ip.py), so come from the same
+		# address as us, and our acks to them can come back to us; ignore
+		# those.
+		if address == self.address and data == ACK:
+			return
+		self.kira.received(data, lambda reply: self.transport.sendto(reply, address))
+
+
+async def run_farm(specs, record, started=None, seed=None):
+	# Run the virtual KIRAs until cancelled.
+	rng = random.Random(seed)
+	kiras = [ VirtualKIRA(spec, record, rng) for spec in specs ]
+	for kira in kiras:
+		await kira.start()
+	log_info("KIRA farm running %d virtual KIRAs", len(kiras))
+	if started:
+		started()
+	await asyncio.Event().wait()
+
+
+def farm_process(q, specs, seed):
+	# Signal that we have started then run until terminated, putting a record
+	# of each message received onto the queue.
+	asyncio.run(run_farm(specs, q.put, lambda: q.put("Started"), seed))
+
+
+class testKIRAfarm:
+	# This class implements a background process simulating a farm of KIRA
+	# endpoints.
+
+	def __init__(self, specs, seed=None):
+		self.specs = specs
+		self.seed = seed
+		self.q = multiprocessing.Queue()
+		self.jobs = []
+
+	def spawn(self):
+		p = multiprocessing.Process(target=farm_process, args = (self.q, self.specs, self.seed))
+		self.jobs.append(p)
+		p.daemon = True
+		p.start()
+
+		# Wait till started
+		message = self.q.get()
+		print(message)
+
+	def terminate(self):
+		for p in self.jobs:
+			p.terminate()
+			p.join()
+
+	def get_records(self, timeout=2):
+		# Return the records of messages received since the last call, waiting
+		# until none have arrived for the given time.
+		records = []
+		while True:
+			try:
+				records.append(self.q.get(timeout = timeout))
+			except queue.Empty:
+				return records
+
+
+def summarise(records):
+	# Return { name: (messages, dropped) }.
+	summary = {}
+	for r in records:
+		messages, dropped = summary.get(r['name'], (0, 0))
+		summary[r['name']] = (messages + 1, dropped + r['dropped'])
+	return summary
+
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(description="Run a farm of simulated KIRA targets.")
+	parser.add_argument("--config", help="JSON file of virtual KIRA specs (a list of dicts with name, host, port, protocol, latency, loss and ack)")
+	parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on")
+	parser.add_argument("--port", type=int, default=65432, help="first port to listen on")
+	parser.add_argument("--count", type=int, default=1, help="number of virtual KIRAs, on consecutive ports")
+	parser.add_argument("--protocol", choices=["udp", "tcp"], default="udp", help="protocol to listen on")
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds to process each message before acking")
+	parser.add_argument("--loss", type=float, default=0.0, help="probability of dropping each message")
+	parser.add_argument("--ack", action="store_true", help="reply OK to each message")
+	parser.add_argument("--seed", type=int, help="seed for the random choice of messages to drop")
+	parser.add_argument("--record", help="file to append a JSON record of each message received to (default stdout)")
+	return parser.parse_args(argv)
+
+
+def main(argv):
+	args = parse_args(argv)
+	if args.config:
+		with open(args.config) as f:
+			specs = json.load(f)
+	else:
+		specs = make_devices(args.port, args.count, args.protocol, args.latency, args.loss, args.ack, args.host)
+
+	out = open(args.record, "a", buffering=1) if args.record else sys.stdout
+	counts = {}
+
+	def record(r):
+		out.write(json.dumps(r) + "\n")
+		counts[r['dropped']] = counts.get(r['dropped'], 0) + 1
+
+	# Stop cleanly when terminated, as when interrupted.
+	signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+	print("KIRA farm running %d virtual KIRAs" % len(specs), file=sys.stderr)
+	try:
+		asyncio.run(run_farm(specs, record, seed=args.seed))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if args.record:
+			out.close()
+	print("Received %d messages, dropped %d" % (sum(counts.values()), counts.get(True, 0)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,101 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+import time
+import multiprocessing
+import http.server
+import urllib.parse
+import json
+import pprint
+
+from logutilities import log_info, log_debug
+
+pp = pprint.PrettyPrinter(indent=2, width = 200)
+
+HANG_TOKEN = "hang-token"
+HANG_TIME = 5
+
+class testLWA:
+	# This class implements a background process simulating the LWA user
+	# profile endpoint.  Tokens in the given dict map to user IDs; the token
+	# HANG_TOKEN gets no response for HANG_TIME seconds, as from an LWA which
+	# has stopped responding; any other token gets a 400 error, as from LWA.
+	# Tokens in the optional dict of lifetimes report that many seconds left.
+
+	def __init__(self, port, users, lifetimes={}):
+		self.port = port
+		self.users = users
+		self.lifetimes = lifetimes
+		self.q = multiprocessing.Queue()
+		self.jobs = []
+
+	def url(self):
+		return "http://127.0.0.1:%d/user/profile?" % self.port
+
+	def spawn(self):
+		p = multiprocessing.Process(target=server, args = (self.q, self.port, self.users, self.lifetimes))
+		self.jobs.append(p)
+		p.daemon = True
+		p.start()
+
+		# Wait till started
+		message = self.q.get()
+		print(message)
+
+	def terminate(self):
+		for p in self.jobs:
+			p.terminate()
+
+	def get_lookups(self):
+		# Return the list of tokens looked up since last called.
+		tokens = []
+		empty = False
+		while not empty:
+			try:
+				tokens.append(self.q.get(timeout = 1))
+			except:
+				empty = True
+		return tokens
+
+
+def server(q, port, users, lifetimes):
+	class ProfileHandler(http.server.BaseHTTPRequestHandler):
+		def do_GET(self):
+			query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+			token = query.get('access_token', [''])[0]
+			q.put(token)
+
+			if token == HANG_TOKEN:
+				time.sleep(HANG_TIME)
+				return
+
+			if token in users:
+				self.send_response(200)
+				body = { 'user_id': users[token], 'name': 'Test', 'email': 'test@example.com' }
+				if token in lifetimes:
+					body['exp'] = lifetimes[token]
+			else:
+				self.send_response(400)
+				body = { 'error': 'invalid_token', 'error_description': 'The request has an invalid parameter : access_token' }
+
+			data = json.dumps(body).encode('utf-8')
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def log_message(self, format, *args):
+			log_debug("testLWA: " + format, *args)
+
+	httpd = http.server.HTTPServer(('127.0.0.1', int(port)), ProfileHandler)
+	q.put("Started")
+	httpd.serve_forever()
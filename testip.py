@@ -18,6 +18,9 @@ from logutilities import log_info, log_debug
 
 pp = pprint.PrettyPrinter(indent=2, width = 200)
 
+# Big enough for any UDP datagram, so long codes aren't truncated
+MAX_MESSAGE = 65535
+
 class testip:
 	# This class implements a background process simulating a KIRA endpoint.
 
@@ -73,12 +76,19 @@ def listener(q, port, protocol):
 	if protocol == "tcp":
 		log_debug("Set socket to listen")
 		sock.listen(1)
-		(sock, address) = sock.accept()
+		listen_sock = sock
+		(sock, address) = listen_sock.accept()
 		log_debug("Accepted incoming connection from address %s on protocol %s", pp.pformat(address), protocol)
 
 	while(True):
 		log_debug("Waiting for data on protocol %s", protocol)
-		(message, address) = sock.recvfrom(1024)
+		(message, address) = sock.recvfrom(MAX_MESSAGE)
+		if protocol == "tcp" and not message:
+			# The sender has closed the connection; wait for the next one.
+			sock.close()
+			(sock, address) = listen_sock.accept()
+			log_debug("Accepted incoming connection from address %s on protocol %s", pp.pformat(address), protocol)
+			continue
 		log_debug("Received data %s from address %s on protocol %s", message, pp.pformat(address), protocol)
 		q.put(message)
 
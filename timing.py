@@ -0,0 +1,213 @@
+# Copyright 2018 Calum Loudon
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
+# use this file except in compliance with the License. A copy of the License
+# is located at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file implements lightweight timing of the phases of handling a
+# directive.
+#
+# The handler starts a trace for each invocation; code wraps each phase in a
+# span, e.g.
+#
+#   with span("get_model", "network"):
+#       model = u.get_model()
+#
+# Spans have a kind, so we can separate time spent on the network ("network")
+# from deliberate sleeps between commands ("sleep") from everything else
+# ("phase").  Sleeps should go through timed_sleep.  The current trace is held
+# in a context variable; work handed to a thread pool should be submitted
+# with submit so that its spans are recorded against the right trace.
+#
+# When the trace finishes we emit a single summary record in CloudWatch
+# Embedded Metric Format, with the total time per phase and per kind plus the
+# CPU time used, and the individual spans.  The CPU time is that of the thread
+# which started the trace: the gateway handles several directives at once, so
+# the process's CPU time would include theirs.  (Work handed to a thread pool
+# is therefore not counted.)  Records go to METRICS_SINK: either
+# "stdout" (from where Lambda ships EMF records to CloudWatch) or the path of
+# a file to append them to.
+#
+# If TRACE_DIR is set, each trace is also written there, as
+# <timestamp>-<trace name>.json in Chrome trace event format, for loading into
+# a trace viewer (e.g. chrome://tracing or Perfetto) to see the gaps and
+# overlaps between sends and pauses.  Sends are shown on a row per KIRA
+# target, labelled with the device they are for.
+#
+# If neither METRICS_SINK nor TRACE_DIR is set, no traces are started and
+# spans cost next to nothing.
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+import contextlib
+import contextvars
+
+from logutilities import log_error
+
+METRICS_NAMESPACE = "KeeneIRAlexa"
+
+G_TRACE = contextvars.ContextVar('trace', default=None)
+G_SINK_LOCK = threading.Lock()
+
+
+class Trace:
+    # The spans recorded while handling one directive.
+
+    def __init__(self, name, dimensions):
+        self.name = name
+        self.dimensions = dimensions
+        self.spans = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        self.timestamp = int(time.time() * 1000)
+        self.thread = threading.get_ident()
+
+    def add(self, name, kind, start, end, args):
+        entry = { 'name': name,
+                  'kind': kind,
+                  'start': round((start - self.start) * 1000, 3),
+                  'duration': round((end - start) * 1000, 3),
+                  'thread': threading.get_ident() }
+        if args:
+            entry['args'] = args
+        with self.lock:
+            self.spans.append(entry)
+
+    def summary(self):
+        # Build the EMF record.  Phases nest (e.g. set_power_states includes
+        # sends and sleeps), so we total network and sleep time by kind, and
+        # count the rest as "other".
+        total = round((time.perf_counter() - self.start) * 1000, 3)
+        cpu = round((time.thread_time() - self.start_cpu) * 1000, 3)
+
+        metrics = { 'total': total, 'cpu': cpu, 'network': 0, 'sleep': 0 }
+        for s in self.spans:
+            metrics[s['name']] = round(metrics.get(s['name'], 0) + s['duration'], 3)
+            if s['kind'] != "phase" and s['kind'] != s['name']:
+                metrics[s['kind']] = round(metrics[s['kind']] + s['duration'], 3)
+        metrics['other'] = round(max(total - metrics['network'] - metrics['sleep'], 0), 3)
+
+        record = { '_aws': { 'Timestamp': self.timestamp,
+                             'CloudWatchMetrics': [ { 'Namespace': METRICS_NAMESPACE,
+                                                      'Dimensions': [ sorted(self.dimensions) ],
+                                                      'Metrics': [ { 'Name': m, 'Unit': 'Milliseconds' } for m in sorted(metrics) ] } ] },
+                   'trace': self.name,
+                   'spans': self.spans }
+        record.update(self.dimensions)
+        record.update(metrics)
+        return record
+
+
+def start_trace(name, **dimensions):
+    # Start a trace for this invocation, if metrics are enabled.  Returns the
+    # trace, to be passed to finish_trace.
+    if not os.environ.get('METRICS_SINK') and not os.environ.get('TRACE_DIR'):
+        return None
+    trace = Trace(name, dimensions)
+    G_TRACE.set(trace)
+    return trace
+
+
+def finish_trace(trace):
+    if trace is None:
+        return None
+    G_TRACE.set(None)
+    record = trace.summary()
+    if os.environ.get('METRICS_SINK'):
+        emit(record)
+    if os.environ.get('TRACE_DIR'):
+        write_chrome_trace(trace, os.environ['TRACE_DIR'])
+    return record
+
+
+def emit(record):
+    sink = os.environ.get('METRICS_SINK')
+    line = json.dumps(record, separators=(',', ':')) + "\n"
+    with G_SINK_LOCK:
+        try:
+            if sink == "stdout":
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            else:
+                with open(sink, "a") as f:
+                    f.write(line)
+        except OSError as e:
+            log_error("Can't write metrics to %s: %s", sink, e)
+
+
+def chrome_trace(trace):
+    # Convert a trace to Chrome trace events.  Each thread gets a row, as
+    # does each target we send to.
+    rows = {}
+    events = []
+
+    def row(name):
+        if name not in rows:
+            rows[name] = len(rows) + 1
+            events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': rows[name], 'args': { 'name': name } })
+        return rows[name]
+
+    row("handler")
+    base = trace.timestamp * 1000
+    for s in trace.spans:
+        args = s.get('args', {})
+        if s['kind'] == "network" and 'target' in args:
+            tid = row(args['target'])
+        elif s['thread'] == trace.thread:
+            tid = row("handler")
+        else:
+            tid = row("thread %d" % s['thread'])
+        events.append({ 'name': s['name'],
+                        'cat': s['kind'],
+                        'ph': 'X',
+                        'ts': base + round(s['start'] * 1000),
+                        'dur': round(s['duration'] * 1000),
+                        'pid': 1,
+                        'tid': tid,
+                        'args': args })
+
+    return { 'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': dict(trace.dimensions, trace=trace.name) }
+
+
+def write_chrome_trace(trace, directory):
+    path = os.path.join(directory, "%d-%s.json" % (trace.timestamp, re.sub(r'[^\w.-]', '_', trace.name)))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(chrome_trace(trace), f)
+    except OSError as e:
+        log_error("Can't write trace to %s: %s", path, e)
+
+
+@contextlib.contextmanager
+def span(name, kind="phase", **args):
+    trace = G_TRACE.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, kind, start, time.perf_counter(), args)
+
+
+def timed_sleep(seconds, name="sleep"):
+    with span(name, "sleep", seconds=seconds):
+        time.sleep(seconds)
+
+
+def submit(executor, fn, *args):
+    # Submit work to an executor so that it runs in the current trace.
+    return executor.submit(contextvars.copy_context().run, fn, *args)
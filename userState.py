@@ -13,17 +13,20 @@
 # This file maintains state for a user and devices.  It exposes:
 # - public methods to set and get user and device details (used by the CLI to
 #   provision users)
-# - public methods to trigger model creation (used by the discovery handler)
-#   and read the model (used by the request handler)
+# - public methods to trigger model creation (used by the CLI whenever user
+#   details are uploaded, and by the discovery handler as a fallback if there
+#   is no model yet) and read the model (used by the request handler)
 # - public methods to get and set device status for a user (used by the request
 #   handler)
 #
 # It implements a write-through cache i.e. all sets of user and device details
-# plus device status and the model are secured to S3 (unless using static
-# files for offline test purposes, in which case they are secured to global
-# vars).
+# plus device status and the model are secured to a storage backend (see
+# storage.py).  That is S3 for the lambda, an in-memory store for offline test
+# purposes (USE_STATIC_FILES, in which case the store is seeded from the static
+# device DB and test user details) or the local filesystem for an on-prem
+# gateway.
 #
-# The set of S3 objects used is as follows.
+# The set of objects used is as follows.
 #
 # - bucket = <BUCKET_ROOT><BUCKET_GLOBALDB>
 #       + key = <KEY_ROOT><manufacturer name>-<device name>
@@ -35,29 +38,49 @@
 #                 and targets
 #       + key = <KEY_ROOT><Amazon user account name>-<KEY_USER_MODEL>
 #         value = serialised dict of user's modelled devices
+#       + key = <KEY_ROOT><KEY_DEVICE_INDEX>
+#         value = serialised dict mapping (manufacturer, device) to the set of
+#                 users who have that device, so that when a device's details
+#                 change we know whose models to recompile (see recompile.py)
 #       + key = <KEY_ROOT><Amazon user account name>-<KEY_USER_STATUS>
-#         value = serialised dict of user's device status
+#         value = serialised dict of user's device status, mapping each
+#                 device's friendly name to whether it is on
+#
+# The device index is maintained whenever user details are set.  Like device
+# status (below) it is updated via compare and swap, as different users may be
+# uploaded concurrently.  Users uploaded before there was an index are only
+# added to it by rebuilding it from all users' details (see recompile.py).
+#
+# Device status is written often and concurrently (e.g. two directives for
+# different rooms of one user), so we only write it if something actually
+# changed, and do so via compare and swap: the write is conditional on the
+# object being unchanged since we read it (or, if there was none, on it still
+# not existing).  If someone else got in first we re-read, re-apply just the
+# devices we changed on top of theirs, and retry.
 #
 # This schema (key structure plus object data) are versioned using semver.
-# The S3 values are simply Python objects serialised via pickle.
+# The stored values are simply Python objects serialised via pickle, except
+# that IR codes in device details and models are stored packed (see
+# IRcodec.py).  Device details are unpacked on read; models are left packed,
+# and codes are only decoded when sent.
 
 import pickle
-import pprint
 import os
-import copy
+import json
+import threading
 
-from AWSS3storage import write_object, read_object
-from logutilities import log_info, log_debug, log_error
+from storage import create_storage_backend, WriteConflict, CREATE_ONLY
+from logutilities import log_info, log_debug, log_error, lazy_pformat
 from deviceDB import DEVICE_DB
 from utilities import verify_devices
-from model import model_user_and_devices
-from userDetails import USER_DETAILS
+from IRcodec import compact_device, expand_device, compact_model
+from profiling import profiled
 
-pp = pprint.PrettyPrinter(indent=2, width = 200)
 
-
-# Semver schema version
-S3_SCHEMA_VERSION="V0.1.0"
+# Semver schema version, and older versions we can still read.  V0.1.0 held
+# IR codes as K-format strings rather than packed; readers accept either.
+S3_SCHEMA_VERSION="V0.2.0"
+READABLE_SCHEMA_VERSIONS = (S3_SCHEMA_VERSION, "V0.1.0")
 
 BUCKET_ROOT = "keeneiralexaskill-"
 BUCKET_GLOBALDB = "globaldevicedb"
@@ -66,147 +89,354 @@ KEY_ROOT = "keeneiralexaskill-"
 KEY_USER_DETAILS = "-details"
 KEY_USER_MODEL = "-model"
 KEY_USER_DEVICE_STATUS = "-device-status"
+KEY_DEVICE_INDEX = "device-index"
+
+# How many times to retry a conflicting device status or index write
+STATUS_WRITE_RETRIES = 5
+
+# User details used to seed the in-memory store when using static files
+STATIC_USER_DETAILS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testUserDetails.json")
+
+# The storage backend, created on first use
+G_STORAGE = None
+G_STORAGE_LOCK = threading.RLock()
+
+def get_storage():
+	global G_STORAGE
+	with G_STORAGE_LOCK:
+		if G_STORAGE is None:
+			G_STORAGE = create_storage_backend()
+			if os.environ.get('USE_STATIC_FILES') == "Y" and G_STORAGE.name == "memory":
+				seed_static_state(G_STORAGE)
+		return G_STORAGE
 
+def warm_up_storage(executor):
+	# On first use, start creating the storage backend in the background
+	# (for S3 this imports boto3, which is slow).
+	if G_STORAGE is None:
+		executor.submit(get_storage)
 
-# Global vars for the non-S3 case
-G_MODEL = {}
-G_DEVICE_STATUS = {}
 
-def write_S3state(bucket, key, state):
+def seed_static_state(storage):
+	# Populate the store from the static device DB and test user details, for
+	# offline testing.
+	log_debug("Seed storage from static files")
+	for manufacturer in DEVICE_DB:
+		for device in DEVICE_DB[manufacturer]:
+			Device(manufacturer, device, storage).set(DEVICE_DB[manufacturer][device])
+
+	with open(os.environ.get('STATIC_USER_DETAILS', STATIC_USER_DETAILS)) as f:
+		user_details = json.load(f)
+	for user_id in user_details:
+		u = User(user_id, storage)
+		u.set_details(user_details[user_id])
+		u.compile_model()
+
+
+def write_state(storage, bucket, key, state, if_stamp=None):
+	# Returns the stamp of the write; raises WriteConflict if if_stamp is given
+	# and no longer matches.
 	blob = pickle.dumps(state)
-	write_object(BUCKET_ROOT + bucket, KEY_ROOT + key, blob, S3_SCHEMA_VERSION)
-	log_debug("Wrote %s/%s state to S3: %s", bucket, key, pp.pformat(state))
+	stamp = storage.write_object(BUCKET_ROOT + bucket, KEY_ROOT + key, blob, S3_SCHEMA_VERSION, if_stamp)
+	log_debug("Wrote %s/%s state to %s: %s", bucket, key, storage.name, lazy_pformat(state))
+	return stamp
 
 
-def read_S3state(bucket, key):
+def read_state_stamped(storage, bucket, key):
 	state = {}
 
-	blob, version = read_object(BUCKET_ROOT + bucket, KEY_ROOT + key)
+	blob, version, stamp = storage.read_object_if_changed(BUCKET_ROOT + bucket, KEY_ROOT + key, None)
 
-	if version != S3_SCHEMA_VERSION:
+	if not version:
+		# Missing (or unreadable, which the backend has logged)
+		log_debug("No %s/%s state in %s", bucket, key, storage.name)
+	elif version not in READABLE_SCHEMA_VERSIONS:
 		log_error("Schema mismatch: read %s, code at %s", version, S3_SCHEMA_VERSION)
 	else:
 		state = pickle.loads(blob)
-		log_debug("Read %s/%s state from S3: %s", bucket, key, pp.pformat(state))
+		log_debug("Read %s/%s state from %s: %s", bucket, key, storage.name, lazy_pformat(state))
+
+	return state, stamp
 
+
+def read_state(storage, bucket, key):
+	state, stamp = read_state_stamped(storage, bucket, key)
 	return state
 
+
+def read_state_if_changed(storage, bucket, key, stamp):
+	# Returns (None, stamp) if the state still has the given stamp, else the
+	# new state and its stamp.
+	blob, version, new_stamp = storage.read_object_if_changed(BUCKET_ROOT + bucket, KEY_ROOT + key, stamp)
+
+	if blob is None:
+		log_debug("State %s/%s unchanged in %s", bucket, key, storage.name)
+		return None, stamp
+
+	if not version:
+		log_debug("No %s/%s state in %s", bucket, key, storage.name)
+		return {}, new_stamp
+
+	if version not in READABLE_SCHEMA_VERSIONS:
+		log_error("Schema mismatch: read %s, code at %s", version, S3_SCHEMA_VERSION)
+		return {}, new_stamp
+
+	return pickle.loads(blob), new_stamp
+
+def user_device_set(user_details):
+	# The set of (manufacturer, device) a user has
+	if not user_details:
+		return set()
+	return { (d['manufacturer'], d['model']) for d in user_details['devices'] }
+
+
+def update_device_index(storage, user_id, old_devices, new_devices):
+	# Move the user from the index entries for devices they no longer have to
+	# those for devices they now have.
+	update_device_index_many(storage, [ (user_id, old_devices, new_devices) ])
+
+
+def update_device_index_many(storage, changes):
+	# As update_device_index, for a list of (user, old devices, new devices),
+	# in one update of the index.
+	changes = [ (user_id, old_devices - new_devices, new_devices - old_devices) for user_id, old_devices, new_devices in changes ]
+	changes = [ (user_id, removed, added) for user_id, removed, added in changes if removed or added ]
+	if not changes:
+		return
+
+	for user_id, removed, added in changes:
+		log_debug("Update device index for user %s: add %s, remove %s", user_id, added, removed)
+
+	for attempt in range(STATUS_WRITE_RETRIES):
+		index, stamp = read_state_stamped(storage, BUCKET_USERDB, KEY_DEVICE_INDEX)
+		for user_id, removed, added in changes:
+			for device in removed:
+				index.get(device, set()).discard(user_id)
+				if device in index and not index[device]:
+					del index[device]
+			for device in added:
+				index.setdefault(device, set()).add(user_id)
+		try:
+			write_state(storage, BUCKET_USERDB, KEY_DEVICE_INDEX, index, stamp or CREATE_ONLY)
+			return
+		except WriteConflict:
+			log_info("Device index changed under us - retry")
+
+	log_error("Gave up updating device index for users %s after %d attempts", ", ".join(sorted(c[0] for c in changes)), STATUS_WRITE_RETRIES)
+
+
+def list_users(storage):
+	# The users whose details have been uploaded, from the keys in the users
+	# bucket.
+	return [ key[len(KEY_ROOT):-len(KEY_USER_DETAILS)] for key in storage.list_keys(BUCKET_ROOT + BUCKET_USERDB)
+	         if key.startswith(KEY_ROOT) and key.endswith(KEY_USER_DETAILS) ]
+
+
+def get_device_users(devices, storage=None):
+	# Return the set of users who have any of the given (manufacturer, device)
+	if storage is None:
+		storage = get_storage()
+	index = read_state(storage, BUCKET_USERDB, KEY_DEVICE_INDEX)
+	users = set()
+	for device in devices:
+		users |= index.get(device, set())
+	return users
+
+
 class Device:
 	# This class models a device in the global DB
 
-	def __init__(self, manufacturer, device, use_S3):
+	def __init__(self, manufacturer, device, storage=None):
 		self.manufacturer = manufacturer
 		self.device = device
 		self.device_details = {} 
-		self.use_S3 = use_S3
+		self.storage = storage if storage is not None else get_storage()
 		log_debug("Creating Device object for manufacturer %s/device %s", manufacturer, device)
-		log_debug("Using S3 rather than static files? %s", self.use_S3)
 
 	def set(self, details):
-		if self.use_S3:
-			write_S3state(BUCKET_GLOBALDB, self.manufacturer + "-" + self.device, details)
-		else: 
-			log_error("Called to write device details but using static files")
+		# Returns the stamp of the write, or None if it failed.
+		return write_state(self.storage, BUCKET_GLOBALDB, self.manufacturer + "-" + self.device, compact_device(details))
 
 	def get(self):
-		if self.use_S3:
-			self.device_details = read_S3state(BUCKET_GLOBALDB, self.manufacturer + "-" + self.device)
-		else:
-			try:
-				self.device_details = DEVICE_DB[self.manufacturer][self.device]
-			except KeyError:
-				log_error("Could not find device %s from manufacturer %s in static files", self.device, self.manufacturer)
+		self.device_details = expand_device(read_state(self.storage, BUCKET_GLOBALDB, self.manufacturer + "-" + self.device))
+		if not self.device_details:
+			log_error("Could not find device %s from manufacturer %s", self.device, self.manufacturer)
 		return self.device_details
 	
 class User:
 	# This class models the details uploaded by a user about their own setup.
 
-	def __init__(self, user_id):
-		try:
-			self.use_S3 = not (os.environ['USE_STATIC_FILES'] == "Y")
-		except KeyError:
-			self.use_S3 = True
+	def __init__(self, user_id, storage=None):
+		self.storage = storage if storage is not None else get_storage()
 		self.user_id = user_id
 		self.user_details = {}
 		self.model = {}
+		self.model_stamp = None
 		self.device_status = {}
+		self.status_base = {}
+		self.status_stamp = None
 		self.devicesDB = {}
 		log_debug("Create a User object for user %s", user_id)
-		log_debug("Using S3 for storage? %s", self.use_S3)
+		log_debug("Using %s for storage", self.storage.name)
 
-	def set_details(self, details):
+	def set_details(self, details, update_index=True):
+		# Returns the devices the user had before and has now.  Bulk uploads
+		# pass update_index False and update the index once for all users.
 		log_debug("Set user details for user %s", self.user_id)
+		old_details = read_state(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_DETAILS)
 		self.user_details = details
-		if self.use_S3:
-			write_S3state(BUCKET_USERDB, self.user_id + KEY_USER_DETAILS, details)
+		write_state(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_DETAILS, details)
+		old_devices, new_devices = user_device_set(old_details), user_device_set(details)
+		if update_index:
+			update_device_index(self.storage, self.user_id, old_devices, new_devices)
+		return old_devices, new_devices
 
 	def get_details(self):
-		if self.use_S3:
-			if not self.user_details:
-				self.user_details = read_S3state(BUCKET_USERDB, self.user_id + KEY_USER_DETAILS)
-		else:
-			try:
-				self.user_details = USER_DETAILS[self.user_id]
-			except KeyError:
-				log_error("Could not find user %s in static files", self.user_id)
+		if not self.user_details:
+			self.user_details = read_state(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_DETAILS)
 		return self.user_details
 	
-	def create_model(self):
-		# Create a model for this user, plus initialise the device status to
-		# 'all devices off'
+	@profiled()
+	def create_model(self, reset_status=True):
+		# Create a model for this user, plus initialise the device status -
+		# either to 'all devices off' or, if not resetting, preserving the
+		# status of any devices the user already had.  Returns whether we
+		# managed to create the model.
 		log_debug("Create model for user %s", self.user_id)
 		self.get_details()
+		if not self.user_details:
+			log_error("No details for user %s - can't model", self.user_id)
+			return False
+
 		user_devices = self.user_details['devices']
-		device_state = {}
 
 		for user_device in user_devices:
 			manufacturer = user_device['manufacturer']
 			model = user_device['model']
-			d = Device(manufacturer, model, self.use_S3)
+			d = Device(manufacturer, model, self.storage)
 			if manufacturer not in self.devicesDB:
 				self.devicesDB[manufacturer] = {}
 			self.devicesDB[manufacturer][model] = d.get()
-			device_state[user_device['friendly_name']] = False
+			if not self.devicesDB[manufacturer][model]:
+				log_error("User %s has device %s/%s not in the DB - can't model", self.user_id, manufacturer, model)
+				return False
 
+		# The model builder is only needed here, so only imported here
+		from model import model_user_and_devices
 		self.model = model_user_and_devices(self.user_details, self.devicesDB)
-		if self.use_S3:
-			log_debug("Secure model to S3")
-			write_S3state(BUCKET_USERDB, self.user_id + KEY_USER_MODEL, self.model)
+		if not self.model:
+			log_error("Could not model user %s", self.user_id)
+			return False
+		log_debug("Secure model to %s", self.storage.name)
+		self.model_stamp = write_state(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_MODEL, compact_model(self.model))
+		friendly_names = [ user_device['friendly_name'] for user_device in user_devices ]
+		if reset_status:
+			self.reset_device_status({ name: False for name in friendly_names })
 		else:
-			global G_MODEL
-			G_MODEL = copy.deepcopy(self.model)
-			log_debug("Secured model to memory: %s", pp.pformat(G_MODEL))
-		self.set_device_status(device_state)
+			self.set_status_devices(friendly_names)
+		return True
+
+	def compile_model(self):
+		# Offline model compilation, run whenever the user's details (or the
+		# devices they reference) are uploaded, so that Discover need only
+		# read back the result.
+		log_info("Compile model for user %s", self.user_id)
+		return self.create_model(reset_status=False)
 
 	def get_model(self):
 		if not self.model:
-			if self.use_S3:
-				log_debug("Retrieve model from S3")
-				self.model = read_S3state(BUCKET_USERDB, self.user_id + KEY_USER_MODEL)
-			else:
-				global G_MODEL
-				self.model = copy.deepcopy(G_MODEL)
-				log_debug("Retrieved model from memory: %s", pp.pformat(self.model))
+			log_debug("Retrieve model from %s", self.storage.name)
+			self.model, self.model_stamp = read_state_stamped(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_MODEL)
 		return self.model
 
+	def refresh(self):
+		# For User objects kept across requests: re-read the model and device
+		# status if they have changed in storage since we last read them.
+		if self.model:
+			model, stamp = read_state_if_changed(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_MODEL, self.model_stamp)
+			if model is not None:
+				log_debug("Model for user %s has changed", self.user_id)
+				self.model, self.model_stamp = model, stamp
+
+		if self.device_status:
+			state, stamp = read_state_if_changed(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_DEVICE_STATUS, self.status_stamp)
+			if state is not None:
+				log_debug("Device status for user %s has changed", self.user_id)
+				self.set_status_state(state, stamp)
+
+	def reset_device_status(self, device_status):
+		# Unconditionally overwrite the device status e.g. after remodelling.
+		log_info("Reset device status for user %s to be %s", self.user_id, lazy_pformat(device_status))
+		self.status_stamp = write_state(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_DEVICE_STATUS, device_status)
+		self.device_status = device_status
+		self.status_base = dict(device_status)
+
+	def set_status_devices(self, devices):
+		# Make the device status cover exactly the given devices, keeping the
+		# status of those the user already had and adding any new ones as off.
+		# Directives may be writing the status concurrently, so this is a
+		# compare and swap too, and we write nothing if the devices are the
+		# same.
+		for attempt in range(STATUS_WRITE_RETRIES):
+			self.read_device_status()
+			device_state = { device: self.status_base.get(device, False) for device in devices }
+			if device_state == self.status_base:
+				log_debug("Devices for user %s unchanged - keep device status", self.user_id)
+				return
+			try:
+				self.status_stamp = write_state(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_DEVICE_STATUS, device_state, self.status_stamp or CREATE_ONLY)
+				log_info("Set devices in status for user %s: %s", self.user_id, lazy_pformat(device_state))
+				self.status_base = device_state
+				self.device_status = dict(device_state)
+				return
+			except WriteConflict:
+				log_info("Device status for user %s changed under us - retry", self.user_id)
+
+		log_error("Gave up setting devices in status for user %s after %d attempts", self.user_id, STATUS_WRITE_RETRIES)
+
 	def set_device_status(self, device_status):
-		log_info("Set device status for user %s to be %s", self.user_id, pp.pformat(device_status))
+		# Secure the devices whose status differs from what we last read or
+		# wrote, merging with any concurrent changes.
+		delta = { device: device_status[device] for device in device_status if self.status_base.get(device) != device_status[device] }
 		self.device_status = device_status
-		if self.use_S3:
-			log_debug("Secure device status to S3")
-			write_S3state(BUCKET_USERDB, self.user_id + KEY_USER_DEVICE_STATUS, device_status)
-		else:
-			global G_DEVICE_STATUS
-			G_DEVICE_STATUS = copy.deepcopy(device_status)
-			log_debug("Secured device status to memory: %s", pp.pformat(G_DEVICE_STATUS))
+
+		if not delta:
+			log_debug("Device status for user %s unchanged - nothing to write", self.user_id)
+			return
+
+		log_info("Set device status for user %s: %s", self.user_id, lazy_pformat(delta))
+
+		for attempt in range(STATUS_WRITE_RETRIES):
+			merged = dict(self.status_base)
+			merged.update(delta)
+			try:
+				self.status_stamp = write_state(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_DEVICE_STATUS, merged, self.status_stamp or CREATE_ONLY)
+				self.status_base = merged
+				self.device_status = dict(merged)
+				log_debug("Secured device status to %s", self.storage.name)
+				return
+			except WriteConflict:
+				log_info("Device status for user %s changed under us - merge and retry", self.user_id)
+				self.read_device_status()
+				delta = { device: delta[device] for device in delta if self.status_base.get(device) != delta[device] }
+				if not delta:
+					log_debug("Concurrent write already made our changes")
+					self.device_status = dict(self.status_base)
+					return
+
+		log_error("Gave up writing device status for user %s after %d attempts", self.user_id, STATUS_WRITE_RETRIES)
+
+	def read_device_status(self):
+		log_debug("Retrieve device status from %s", self.storage.name)
+		state, stamp = read_state_stamped(self.storage, BUCKET_USERDB, self.user_id + KEY_USER_DEVICE_STATUS)
+		self.set_status_state(state, stamp)
+
+	def set_status_state(self, state, stamp):
+		self.status_stamp = stamp
+		self.status_base = state
+		self.device_status = dict(self.status_base)
 
 	def get_device_status(self):
 		if not self.device_status:
-			if self.use_S3:
-				log_debug("Retrieve device status from S3")
-				self.device_status = read_S3state(BUCKET_USERDB, self.user_id + KEY_USER_DEVICE_STATUS)
-			else:
-				global G_DEVICE_STATUS
-				self.device_status = copy.deepcopy(G_DEVICE_STATUS)
-				log_debug("Retrieved device status from memory: %s", pp.pformat(self.device_status))
-		return self.device_status
\ No newline at end of file
+			self.read_device_status()
+		return self.device_status
@@ -84,6 +84,25 @@ def find_target(device, targets):
 
     return t
 
+def find_command_targets(commands, targets=None):
+    # Return the set of (target, protocol) that the IR commands in some part of
+    # a model send to.
+    if targets is None:
+        targets = set()
+
+    if isinstance(commands, dict):
+        if 'target' in commands and 'protocol' in commands:
+            if commands['target'] is not None:
+                targets.add((commands['target'], commands['protocol']))
+        else:
+            for value in commands.values():
+                find_command_targets(value, targets)
+    elif isinstance(commands, list):
+        for value in commands:
+            find_command_targets(value, targets)
+
+    return targets
+
 def get_repeats(device_details):
     if 'IRrepeats' in device_details:
         repeats = device_details['IRrepeats']
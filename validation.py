@@ -1,26 +1,170 @@
 # Copyright 2018 Calum Loudon
 #
-# Licensed under the Apache License, Version 2.0 (the "License"). You may not 
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not
 # use this file except in compliance with the License. A copy of the License
 # is located at
 #
 #    http://www.apache.org/licenses/LICENSE-2.0
 #
-# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR 
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
 # CONDITIONS OF ANY KIND, express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
 # This file implements schema validation against the schema published at
 # https://github.com/alexa/alexa-smarthome/tree/master/validation_schemas
+#
+# The schema is big, so it is loaded and compiled into a validator once per
+# process, on first use.  The lambda validates its responses according to
+# VALIDATE_RESPONSES:
+#
+# - "strict": validate every response, raising an exception if invalid (used
+#   by the UTs)
+# - "sample": validate 1 in VALIDATE_SAMPLE_RATE responses (default 100),
+#   logging any that are invalid (the default)
+# - "off": don't validate.
+#
+# Serialized discovery responses (see response.py) are instead validated when
+# the model is compiled, unless VALIDATE_RESPONSES is "off".
+#
+# The published schema we hold predates the PlaybackController and
+# StepSpeaker interfaces, so we add their discovery capabilities to it when
+# loading it.
 
+import os
 import json
+import random
+import itertools
+import threading
+
+from logutilities import log_error
+from response import discovery_response_json
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alexa_smart_home_message_schema.json")
+DEFAULT_SAMPLE_RATE = 100
+MAX_ERROR_MESSAGE = 500
+
+# Capabilities missing from the published schema, keyed by interface
+SUPPLEMENTARY_CAPABILITIES = {
+    'PlaybackController': {
+        "type": "object",
+        "required": [ "type", "interface", "version", "supportedOperations" ],
+        "additionalProperties": False,
+        "properties": {
+            "type": { "enum": [ "AlexaInterface" ] },
+            "interface": { "enum": [ "Alexa.PlaybackController" ] },
+            "version": { "$ref": "#/definitions/common.properties/version" },
+            "supportedOperations": {
+                "type": "array",
+                "uniqueItems": True,
+                "items": { "enum": [ "Play", "Pause", "Stop", "StartOver", "Previous", "Next", "Rewind", "FastForward" ] }
+            }
+        }
+    },
+    'StepSpeaker': {
+        "type": "object",
+        "required": [ "type", "interface", "version" ],
+        "additionalProperties": False,
+        "properties": {
+            "type": { "enum": [ "AlexaInterface" ] },
+            "interface": { "enum": [ "Alexa.StepSpeaker" ] },
+            "version": { "$ref": "#/definitions/common.properties/version" }
+        }
+    },
+}
+
+CAPABILITIES_REF = "#/definitions/common.properties/interfaces/%s/capabilities"
+
+G_VALIDATOR = None
+G_VALIDATOR_LOCK = threading.Lock()
+# Starts at a random point, so that it isn't always the first response after
+# a cold start (which is slowed most by loading the schema) that we validate.
+G_SAMPLE_COUNTER = itertools.count(random.getrandbits(32))
+
+
+def get_validator():
+    global G_VALIDATOR
+    with G_VALIDATOR_LOCK:
+        if G_VALIDATOR is None:
+            import jsonschema.validators
+
+            with open(SCHEMA_PATH) as json_file:
+                schema = json.load(json_file)
+            supplement_schema(schema)
+            cls = jsonschema.validators.validator_for(schema)
+            G_VALIDATOR = cls(schema)
+        return G_VALIDATOR
+
+
+def supplement_schema(schema):
+    # Add our supplementary capabilities to the interface definitions, and
+    # wherever the schema lists the allowed capabilities.
+    interfaces = schema['definitions']['common.properties']['interfaces']
+    for interface, capabilities in SUPPLEMENTARY_CAPABILITIES.items():
+        interfaces.setdefault(interface, {})['capabilities'] = capabilities
+
+    known = { "$ref": CAPABILITIES_REF % "ChannelController" }
+    extra = [ { "$ref": CAPABILITIES_REF % interface } for interface in SUPPLEMENTARY_CAPABILITIES ]
+
+    def walk(node):
+        if isinstance(node, dict):
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            if known in node:
+                node.extend(e for e in extra if e not in node)
+            for value in node:
+                walk(value)
+
+    walk(schema)
 
-from jsonschema import validate
 
 def validate_message(response):
+    # Raises jsonschema.ValidationError if the response is invalid.
+    get_validator().validate(response)
+
+
+def describe_error(e):
+    # A ValidationError's string includes the whole schema subtree which
+    # failed, which can run to thousands of lines; log just what failed and
+    # where.  The message quotes the failing instance, which may be a whole
+    # response, so is cut short.
+    if hasattr(e, 'absolute_path'):
+        message = e.message
+        if len(message) > MAX_ERROR_MESSAGE:
+            message = message[:MAX_ERROR_MESSAGE] + "..."
+        return "%s at %s (%s)" % (message, list(e.absolute_path), e.validator)
+    return repr(e)
+
+
+def check_response(response):
+    # Validate a response as configured by VALIDATE_RESPONSES.
+    mode = os.environ.get('VALIDATE_RESPONSES', "sample")
+    if mode == "strict":
+        validate_message(response)
+    elif mode == "sample":
+        rate = int(os.environ.get('VALIDATE_SAMPLE_RATE', DEFAULT_SAMPLE_RATE))
+        if rate > 0 and next(G_SAMPLE_COUNTER) % rate == 0:
+            try:
+                validate_message(response)
+            except ImportError as e:
+                log_error("Can't validate responses: %s", e)
+            except Exception as e:
+                log_error("Invalid response: %s", describe_error(e))
 
-    path_to_validation_schema = "alexa_smart_home_message_schema.json"
 
-    with open(path_to_validation_schema) as json_file:
-        schema = json.load(json_file)
-    validate(response, schema)
+def check_discovery_template(template):
+    # Validate a serialized discovery response when compiling a model.
+    # Returns whether it is valid (or we didn't check).
+    mode = os.environ.get('VALIDATE_RESPONSES', "sample")
+    if mode == "off":
+        return True
+    try:
+        validate_message(json.loads(discovery_response_json(template)))
+    except ImportError as e:
+        log_error("Can't validate discovery response: %s", e)
+    except Exception as e:
+        if mode == "strict":
+            raise
+        log_error("Invalid discovery response: %s", describe_error(e))
+        return False
+    return True